@@ -0,0 +1,195 @@
+import threading
+import sqlite3
+import struct
+import zlib
+import json
+import time
+import os
+
+#Each record in the data file is its compressed length followed by the compressed record: a line of JSON describing the response and then the response text
+RECORD_HEADER = struct.Struct(">I")
+
+def encode_record(record, text):
+    """ Compresses a record dictionary and its response text into the body stored in the data file """
+    if isinstance(text, unicode):
+        text = text.encode("utf-8")
+    return zlib.compress(json.dumps(record) + "\n" + text)
+
+def decode_record(body):
+    """ Gets the record dictionary and the response text from a body stored in the data file """
+    meta, text = zlib.decompress(body).split("\n", 1)
+    return json.loads(meta), text
+
+class ResponseArchive(object):
+    """ An append-only archive of the raw text of every API response, so new columns can be worked out later by replaying the responses rather than requesting every journey again.
+
+    The responses are appended, compressed, to a data file and indexed in a SQLite file next to it by request key (see Directions.get_cache_key), by the UniqueID of the row that made the request and by mode of transport. Records are never changed or removed: if a request is archived more than once the latest response is used. The data file holds everything needed to rebuild the index, so if a run stops after writing a response but before indexing it the index is brought up to date when the archive is next opened. The archive can be shared between threads but not between processes.
+    """
+
+    def __init__(self, filename, commit_interval = 1000):
+        """ Opens (creating if needed) the archive.
+
+        Arguments:
+            filename - String - Path of the data file, the index is kept in the same path with .idx added
+            commit_interval - Integer - The index is saved to disk after this many responses have been added
+        """
+        self.filename = filename
+        self.commit_interval = commit_interval
+
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+
+        self._db = sqlite3.connect(filename + ".idx", check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses (offset INTEGER PRIMARY KEY, length INTEGER, key TEXT, unique_id TEXT, api TEXT, mode TEXT, status TEXT, created REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_key ON responses (key)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_unique_id ON responses (unique_id, mode)")
+
+        self._file = open(filename, "a+b")
+        self._recover()
+
+    def _recover(self):
+        """ Indexes any records at the end of the data file that are missing from the index, and cuts off a record that was only partly written """
+        self._file.seek(0, os.SEEK_END)
+        size = self._file.tell()
+
+        end = self._db.execute("SELECT offset + length FROM responses ORDER BY offset DESC LIMIT 1").fetchone()
+        offset = end[0] if end else 0
+
+        while offset < size:
+            self._file.seek(offset)
+            header = self._file.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            body = self._file.read(RECORD_HEADER.unpack(header)[0])
+            try:
+                record = decode_record(body)[0]
+            except (zlib.error, ValueError):
+                break
+            length = RECORD_HEADER.size + len(body)
+            self._index(offset, length, record)
+            offset = offset + length
+
+        if offset < size:
+            self._file.truncate(offset)
+        self._db.commit()
+
+    def _index(self, offset, length, record):
+        self._db.execute("INSERT OR REPLACE INTO responses (offset, length, key, unique_id, api, mode, status, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (offset, length, record["key"], record.get("unique_id"), record.get("api"), record.get("mode"), record.get("status"), record.get("created")))
+
+    def put(self, key, text, unique_id = None, api = None, mode = None, status = None):
+        """ Appends a response to the archive.
+
+        Arguments:
+            key - String - The normalised request key
+            text - String - The raw response text
+            unique_id - String - The UniqueID of the row the request was made for, None if it was not made for a single row (eg a Distance Matrix request)
+            api - String - The API requested, eg 'directions'
+            mode - String - The mode of transport requested, None if the API does not have one
+            status - String - The API status of the response
+        """
+        record = {"key": key, "unique_id": unique_id, "api": api, "mode": mode, "status": status, "created": time.time()}
+        body = encode_record(record, text)
+
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            offset = self._file.tell()
+            self._file.write(RECORD_HEADER.pack(len(body)) + body)
+            self._index(offset, RECORD_HEADER.size + len(body), record)
+
+            self._uncommitted = self._uncommitted + 1
+            if self._uncommitted >= self.commit_interval:
+                self._commit()
+
+    def _commit(self):
+        """ Saves the data file and then the index, in that order so the index never points past the end of the data. Must be called with the lock held. """
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._db.commit()
+        self._uncommitted = 0
+
+    def _read(self, offset, length):
+        """ Reads the still compressed body of the record at an offset in the data file. Must be called with the lock held. """
+        self._file.seek(offset)
+        return self._file.read(length)[RECORD_HEADER.size:]
+
+    def get(self, key):
+        """ Gets the latest archived response text for a request.
+
+        Arguments:
+            key - String - The normalised request key
+
+        Returns:
+            The response text, or None if the request is not in the archive
+        """
+        with self._lock:
+            row = self._db.execute("SELECT offset, length FROM responses WHERE key = ? ORDER BY offset DESC LIMIT 1", (key,)).fetchone()
+            if row is None:
+                return None
+            body = self._read(row[0], row[1])
+
+        #Decompress outside the lock so several threads can replay at once
+        return decode_record(body)[1]
+
+    def find(self, unique_id, mode = None):
+        """ Gets every response archived for a row, eg to work out a new column for it.
+
+        Arguments:
+            unique_id - String - The UniqueID of the row
+            mode - String - Only get the responses for this mode of transport, None for every mode
+
+        Returns:
+            A list of record dictionaries (with the keys key, unique_id, api, mode, status, created and text) in the order they were archived
+        """
+        with self._lock:
+            if mode is None:
+                rows = self._db.execute("SELECT offset, length FROM responses WHERE unique_id = ? ORDER BY offset", (unique_id,)).fetchall()
+            else:
+                rows = self._db.execute("SELECT offset, length FROM responses WHERE unique_id = ? AND mode = ? ORDER BY offset", (unique_id, mode)).fetchall()
+            bodies = [self._read(offset, length) for offset, length in rows]
+
+        records = list()
+        for body in bodies:
+            record, text = decode_record(body)
+            record["text"] = text
+            records.append(record)
+        return records
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._db.execute("SELECT 1 FROM responses WHERE key = ? LIMIT 1", (key,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def close(self):
+        """ Saves any outstanding responses and closes the archive. """
+        with self._lock:
+            self._commit()
+            self._db.close()
+            self._file.close()
+
+def archive_from_settings(config, filename = None):
+    """ Opens the response archive described by the [Archive] section of the settings file.
+
+    Arguments:
+        config - ConfigParser - The parsed settings file
+        filename - String - Data file to use instead of the path setting, eg a separate archive for each shard
+
+    Returns:
+        A ResponseArchive, or None if the settings file has no [Archive] section
+    """
+    if not config.has_section('Archive'):
+        return None
+
+    if filename is None:
+        filename = config.get('Archive', 'path')
+
+    commit_interval = 1000
+    if config.has_option('Archive', 'commit_interval'):
+        commit_interval = config.getint('Archive', 'commit_interval')
+
+    return ResponseArchive(filename, commit_interval)
@@ -0,0 +1,178 @@
+import sys
+import threading
+import collections
+import Queue
+
+def ordered_map(function, items, workers = 4, buffer_size = 100):
+    """ Applies the supplied function to each item using a pool of worker threads and yields the results in the same order as the items were supplied.
+
+    Items are read from the iterable lazily and no more than buffer_size items are ever waiting to be yielded (being processed or finished but held back by a slower item ahead of them), so memory use stays flat however long the input is.
+
+    Arguments:
+        function - Function - Called with a single item, its return value is yielded
+        items - Iterable - The items to be processed, this may be a generator
+        workers - Integer - The number of worker threads
+        buffer_size - Integer - The maximum number of items that may be in progress or waiting to be written at any one time
+
+    Returns:
+        A generator yielding the result of function(item) for each item, in input order. If the function raises an exception for an item it is re-raised when that item's result is reached.
+    """
+    #The buffer size must be at least the number of workers otherwise some workers can never be given anything to do
+    buffer_size = max(buffer_size, workers)
+
+    #Each slot represents space in the reorder buffer, a slot is taken when an item is queued and given back when its result is yielded
+    slots = threading.Semaphore(buffer_size)
+    tasks = Queue.Queue()
+
+    #Results that have finished but not yet been yielded, keyed by their position in the input
+    finished = dict()
+    finished_changed = threading.Condition()
+
+    #Shared state between the feeder thread and the generator
+    state = {"total": None, "stop": False}
+
+    def feed():
+        count = 0
+        try:
+            for item in items:
+                slots.acquire()
+                if state["stop"]:
+                    break
+                tasks.put((count, item))
+                count = count + 1
+        except Exception:
+            #Pass the error from the input iterable back to the generator in the position it occurred
+            with finished_changed:
+                finished[count] = (False, sys.exc_info())
+                count = count + 1
+                finished_changed.notify()
+
+        with finished_changed:
+            state["total"] = count
+            finished_changed.notify()
+
+        #Tell each of the workers that there is nothing more to do
+        for i in range(workers):
+            tasks.put(None)
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+
+            index, item = task
+            try:
+                result = (True, function(item))
+            except Exception:
+                result = (False, sys.exc_info())
+
+            with finished_changed:
+                finished[index] = result
+                finished_changed.notify()
+
+    threads = [threading.Thread(target=feed)]
+    for i in range(workers):
+        threads.append(threading.Thread(target=work))
+
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    next_index = 0
+    try:
+        while True:
+            with finished_changed:
+                while next_index not in finished and (state["total"] is None or next_index < state["total"]):
+                    finished_changed.wait(1.0)
+
+                if next_index not in finished:
+                    return
+
+                ok, result = finished.pop(next_index)
+
+            next_index = next_index + 1
+            slots.release()
+
+            if ok:
+                yield result
+            else:
+                raise result[0], result[1], result[2]
+    finally:
+        #If the caller stops early make sure the feeder does not block forever waiting for a free slot
+        state["stop"] = True
+        slots.release()
+
+class SingleFlight(object):
+    """ Makes sure a function is only called once for each key, however many threads ask for it. Threads asking for a key that is already being worked out wait for that call to finish and share its result rather than making another. """
+
+    def __init__(self, remember = True, max_results = None):
+        """ Creates an empty set of results.
+
+        Arguments:
+            remember - Boolean - If True results are kept so later calls for the same key reuse them, if False only calls that overlap in time are shared
+            max_results - Integer - The most results kept when remembering them, the least recently used are forgotten first. None keeps every result
+        """
+        self.remember = remember
+        self.max_results = max_results
+        self.calls = 0
+        self.shared = 0
+
+        self._results = collections.OrderedDict()
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    def get(self, key, function):
+        """ Gets the result for a key, calling function() only if no other call has already done so (or is doing so).
+
+        Arguments:
+            key - Hashable - Identifies calls that give the same result
+            function - Function - Called with no arguments to get the result
+
+        Returns:
+            The result of the function for this key. If the call made for this key raises an exception it is raised in the calling thread only, waiting threads then try again themselves.
+        """
+        while True:
+            with self._lock:
+                if key in self._results:
+                    self.shared = self.shared + 1
+                    #Move the result to the most recently used end
+                    result = self._results.pop(key)
+                    self._results[key] = result
+                    return result
+
+                event = self._pending.get(key)
+                if event is None:
+                    event = threading.Event()
+                    self._pending[key] = event
+                    self.calls = self.calls + 1
+                    break
+
+            event.wait()
+
+            #A call that is not remembered hands its result over through the pending entry
+            with self._lock:
+                if not self.remember and getattr(event, "done", False):
+                    self.shared = self.shared + 1
+                    return event.result
+
+        try:
+            result = function()
+        except Exception:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+            raise
+
+        with self._lock:
+            if self.remember:
+                self._results[key] = result
+                if self.max_results is not None and len(self._results) > self.max_results:
+                    self._results.popitem(last=False)
+            else:
+                event.result = result
+                event.done = True
+            del self._pending[key]
+        event.set()
+
+        return result
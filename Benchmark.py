@@ -0,0 +1,183 @@
+import ConfigParser
+import multiprocessing
+import threading
+import functools
+import resource
+import random
+import array
+import Queue
+import time
+import sys
+
+from Directions import *
+from Batch import ordered_map
+from Transport import transport_from_settings
+from RateLimit import limiter_from_settings
+from MockServer import server_from_settings
+
+#Get the settings from the config file
+config = ConfigParser.SafeConfigParser()
+config.read("Settings.cfg")
+
+#Which code path to measure, 'directions' (get_directions, as used by GetData.py) or 'geocode' (reverse_geocode, as used by GetPostCodes.py)
+api = get_setting(config, 'Benchmark', 'api', 'directions')
+
+#The numbers of input rows to time, each is run in a fresh process so the peak memory of each run is measured separately
+sizes = [int(size) for size in get_setting(config, 'Benchmark', 'sizes', '100,1000,10000').split(",")]
+
+#How the rows are processed, matching the [Run] settings used by GetData.py
+workers = get_setting(config, 'Benchmark', 'workers', 8)
+buffer_size = get_setting(config, 'Benchmark', 'buffer_size', 100)
+parallel = get_setting(config, 'Benchmark', 'parallel_requests', True)
+
+#The synthetic input: how many different postcodes journeys are made between and the fraction of rows with a waypoint
+unique_postcodes = get_setting(config, 'Benchmark', 'unique_postcodes', 1000)
+waypoint_rate = get_setting(config, 'Benchmark', 'waypoint_rate', 0.1)
+
+#Wait on the [RateLimit] rate limiter as GetData.py does. By default requests are not limited, so the throughput measured is that of the code rather than of the limiter
+rate_limit = get_setting(config, 'Benchmark', 'rate_limit', False)
+
+#Start a MockServer.py using the [MockServer] settings, otherwise requests go to the base_url in the [API] section
+start_server = get_setting(config, 'Benchmark', 'start_server', True)
+
+class TimingTransport(object):
+    """ Passes requests on to another transport, recording how long each one takes, not counting any time spent waiting for the rate limiter """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.latencies = array.array('d')
+        self.lock = threading.Lock()
+
+    def get(self, url, params, decode, limiter = None):
+        start = time.time()
+        response = self.transport.get(url, params, decode, limiter)
+        elapsed = time.time() - start - response.throttle
+
+        with self.lock:
+            self.latencies.append(elapsed)
+
+        return response
+
+def get_percentile(values, percentile):
+    """ Gets the supplied percentile (0 to 100) of a sorted sequence of values, None if it is empty """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percentile / 100.0))]
+
+def random_postcode(rng):
+    """ Creates a random postcode in the North East in the standard format """
+    return "NE{} {}{}{}".format(rng.randint(1, 99), rng.randint(0, 9), rng.choice("ABDEFGHJLNPQRSTUWXYZ"), rng.choice("ABDEFGHJLNPQRSTUWXYZ"))
+
+def synthetic_rows(count, seed = 1):
+    """ Yields count synthetic input rows for get_directions, journeys are between a fixed set of unique_postcodes postcodes """
+    rng = random.Random(seed)
+    postcodes = [random_postcode(rng) for i in range(unique_postcodes)]
+
+    for i in xrange(count):
+        row = {"UniqueID": str(i), "OriginPostcode": rng.choice(postcodes), "DestinationPostcode": rng.choice(postcodes), "Waypoint1": "99"}
+        if rng.random() < waypoint_rate:
+            row["Waypoint1"] = rng.choice(postcodes)
+        yield row
+
+def synthetic_points(count, seed = 1):
+    """ Yields count synthetic (latitude, longitude) tuples for reverse_geocode, spread over the North East """
+    rng = random.Random(seed)
+    for i in xrange(count):
+        yield ("{:.6f}".format(rng.uniform(54.8, 55.1)), "{:.6f}".format(rng.uniform(-1.8, -1.4)))
+
+def run_size(count, base_url, results):
+    """ Processes count synthetic rows through the real code path and puts a dictionary of measurements on the results queue. Run in its own process. """
+    #The per-request console output would swamp the results and slow the run down
+    set_verbose(False)
+
+    set_base_url(base_url)
+    set_rate_limiter(limiter_from_settings(config) if rate_limit else None)
+
+    transport = TimingTransport(transport_from_settings(config))
+    set_transport(transport)
+
+    if api == 'geocode':
+        function = functools.partial(reverse_geocode, api_key="benchmark")
+        items = synthetic_points(count)
+    else:
+        function = functools.partial(get_directions, api_key="benchmark", departure_time=get_departure_time("09:00:00", 2), parallel=parallel)
+        items = synthetic_rows(count)
+
+    start = time.time()
+    rows = 0
+    for result in ordered_map(function, items, workers, buffer_size):
+        rows = rows + 1
+    elapsed = max(time.time() - start, 1e-6)
+
+    latencies = sorted(transport.latencies)
+
+    results.put({
+        "rows": rows,
+        "seconds": elapsed,
+        "requests": len(latencies),
+        "p50": get_percentile(latencies, 50),
+        "p99": get_percentile(latencies, 99),
+        "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    })
+
+def wait_for_result(process, results, poll = 1.0):
+    """ Waits for a run_size process to put its measurements on the results queue.
+
+    Arguments:
+        process - multiprocessing.Process - The process running run_size
+        results - multiprocessing.Queue - The queue it puts its measurements on
+        poll - Float - Seconds between checks that the process is still running
+
+    Returns:
+        The dictionary of measurements, or None if the process ended without putting any there (eg it raised an exception)
+    """
+    while True:
+        try:
+            return results.get(timeout=poll)
+        except Queue.Empty:
+            if not process.is_alive():
+                #The process may have put its result just before it ended
+                try:
+                    return results.get(timeout=poll)
+                except Queue.Empty:
+                    return None
+
+def format_ms(seconds):
+    """ Formats a latency in seconds as milliseconds, NA if there were no requests """
+    if seconds is None:
+        return "NA"
+    return "{:.1f}".format(seconds * 1000)
+
+if __name__ == "__main__":
+    server = None
+    base_url = get_setting(config, 'API', 'base_url', DEFAULT_BASE_URL)
+
+    if start_server:
+        #Run the mock server in a separate process so its work is not counted against the code being measured
+        mock = server_from_settings(config)
+        base_url = "http://localhost:{}".format(mock.server_address[1])
+        server = multiprocessing.Process(target=mock.serve_forever)
+        server.daemon = True
+        server.start()
+        mock.server_close()
+    elif base_url == DEFAULT_BASE_URL:
+        sys.exit("Refusing to benchmark against the Google APIs, set start_server = true or point base_url at a mock server")
+
+    print "Benchmarking {} against {} with {} workers".format(api, base_url, workers)
+    print "{:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format("Rows", "Seconds", "Rows/s", "Requests/s", "p50 (ms)", "p99 (ms)", "Peak (MB)")
+
+    try:
+        for count in sizes:
+            results = multiprocessing.Queue()
+            process = multiprocessing.Process(target=run_size, args=(count, base_url, results))
+            process.start()
+            result = wait_for_result(process, results)
+            process.join()
+
+            if result is None:
+                sys.exit("The benchmark of {} rows failed (exit code {}), see the error above".format(count, process.exitcode))
+
+            print "{:>10} {:>10.1f} {:>10.1f} {:>10.1f} {:>10} {:>10} {:>10.1f}".format(result["rows"], result["seconds"], result["rows"] / result["seconds"], result["requests"] / result["seconds"], format_ms(result["p50"]), format_ms(result["p99"]), result["peak_memory_mb"])
+    finally:
+        if server is not None:
+            server.terminate()
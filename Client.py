@@ -0,0 +1,361 @@
+import functools
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from Directions import DIRECTIONS_URL, GEOCODE_URL, DEFAULT_BASE_URL, CACHEABLE_STATUSES, ALL_MODES, MODE_COLUMNS
+from Directions import get_cache_key, get_waypoint_string, create_waypoint_pairs, normalize_postcode, check_postcode, get_mode_values, get_transit_values, combine_transit_legs, get_geocode_postcodes
+from Transport import HttpTransport, get_status, transport_from_settings
+from RateLimit import limiter_from_settings
+from ResponseCache import cache_from_settings
+from Responses import decode_json, decode_directions
+
+class InvalidPostcode(ValueError):
+    """ Raised when a postcode passed to a DirectionsClient does not match the postcode pattern, before any request is made """
+    pass
+
+class ModeResult(object):
+    """ The directions for a journey by driving, bicycling or walking.
+
+    Attributes:
+        mode - String - The mode of transport
+        status - String - The API status, or why the request failed
+        distance - Float - The distance in metres, None unless the status is OK
+        duration - Float - The duration in seconds, None unless the status is OK
+        retries - Integer - The number of times the request was retried
+    """
+    __slots__ = ("mode", "status", "distance", "duration", "retries")
+
+    def __init__(self, mode, status, distance, duration, retries):
+        self.mode = mode
+        self.status = status
+        self.distance = distance
+        self.duration = duration
+        self.retries = retries
+
+class TransitResult(object):
+    """ The directions for a journey by public transport, through any waypoints.
+
+    Attributes:
+        status - String - The API status, or why the request failed (the last failure if a leg between waypoints failed)
+        distance - Float - The distance in metres, None unless the status is OK
+        duration - Float - The duration in seconds, None unless the status is OK
+        nodes - Integer - The number of steps in the directions, None unless the status is OK
+        walking_to_first_stop - Float - The walking distance to the first stop in metres, None unless the status is OK
+        walking_from_last_stop - Float - The walking distance from the last stop in metres, None unless the status is OK
+        total_walking - Float - The total walking distance in metres, None unless the status is OK
+        lines - List - The short names of the transit lines used, in order
+        departure_time - datetime - The departure time the directions were requested for
+        retries - Integer - The number of times the requests were retried
+    """
+    __slots__ = ("status", "distance", "duration", "nodes", "walking_to_first_stop", "walking_from_last_stop", "total_walking", "lines", "departure_time", "retries")
+
+    def __init__(self, status, distance, duration, nodes, walking_to_first_stop, walking_from_last_stop, total_walking, lines, departure_time, retries):
+        self.status = status
+        self.distance = distance
+        self.duration = duration
+        self.nodes = nodes
+        self.walking_to_first_stop = walking_to_first_stop
+        self.walking_from_last_stop = walking_from_last_stop
+        self.total_walking = total_walking
+        self.lines = lines
+        self.departure_time = departure_time
+        self.retries = retries
+
+class JourneyResult(object):
+    """ The directions for a journey by each of the modes of transport asked for.
+
+    Attributes:
+        origin - String - The normalised origin postcode
+        destination - String - The normalised destination postcode
+        waypoints - Tuple - The normalised waypoint postcodes
+        modes - Dictionary - A ModeResult (or a TransitResult for transit) for each mode, keyed by mode
+    """
+    __slots__ = ("origin", "destination", "waypoints", "modes")
+
+    def __init__(self, origin, destination, waypoints, modes):
+        self.origin = origin
+        self.destination = destination
+        self.waypoints = waypoints
+        self.modes = modes
+
+class GeocodeResult(object):
+    """ The postcodes found for a point.
+
+    Attributes:
+        status - String - The API status, or why the request failed
+        postcodes - List - The postcodes (which may be partial, eg NE6) for the point, empty if the request failed
+        retries - Integer - The number of times the request was retried
+    """
+    __slots__ = ("status", "postcodes", "retries")
+
+    def __init__(self, status, postcodes, retries):
+        self.status = status
+        self.postcodes = postcodes
+        self.retries = retries
+
+def quiet(message):
+    """ Ignores a status message, so the client never prints anything """
+    pass
+
+def get_transit_lines(result):
+    """ Gets the short names of the transit lines used by a decoded Directions API response, in order """
+    if result is None:
+        return list()
+    return [step.line_name for leg in result.legs for step in leg.steps if step.travel_mode != 'WALKING' and step.line_name is not None]
+
+def gather(futures, combine):
+    """ Creates a future for a value worked out from the results of several futures, without any thread waiting for them.
+
+    Arguments:
+        futures - List - The futures to wait for
+        combine - Function - Called with the list of their results, in the same order, once they have all finished
+
+    Returns:
+        A Future set to the return value of combine, or to the first exception raised by one of the futures or by combine
+    """
+    combined = Future()
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def finish():
+        try:
+            combined.set_result(combine([future.result() for future in futures]))
+        except Exception as e:
+            combined.set_exception(e)
+
+    def done(future):
+        with lock:
+            remaining[0] = remaining[0] - 1
+            last = remaining[0] == 0
+        if last:
+            finish()
+
+    if not futures:
+        finish()
+    for future in futures:
+        future.add_done_callback(done)
+
+    return combined
+
+class DirectionsClient(object):
+    """ Gets directions and postcodes for single journeys on demand, eg to answer queries in a web service, rather than for a whole input file.
+
+    Every method returns a concurrent.futures Future straight away. The requests are made by a shared pool of worker threads over one pool of keep-alive connections, and the requests for each mode and transit leg of a journey are made at the same time. Concurrent identical requests are coalesced: while one is in flight any other caller asking for the same thing is given its Future, without taking up another worker, so a burst of queries for the same postcodes makes only one request for each mode. Results are returned as typed records rather than column dictionaries and nothing is printed. Unlike the functions in Directions.py the client keeps its own settings, so it does not depend on or change the ones set there.
+    """
+
+    def __init__(self, api_key, base_url = None, transport = None, limiter = None, cache = None, workers = 16):
+        """ Creates the client and its worker threads.
+
+        Arguments:
+            api_key - String - The Google API key to make requests with
+            base_url - String - The scheme and host requests are sent to, by default the Google APIs
+            transport - Object - Makes the requests (see Directions.set_transport), by default an HttpTransport with a connection for each worker
+            limiter - RateLimit.RateLimiter - The rate limiter every request waits on, None for no limit
+            cache - ResponseCache.ResponseCache - Successful responses are taken from and saved to this cache, None for no cache
+            workers - Integer - The number of requests made at the same time
+        """
+        self.api_key = api_key
+        self.base_url = (base_url or DEFAULT_BASE_URL).rstrip("/")
+        self.transport = transport or HttpTransport(pool_size = workers)
+        self.limiter = limiter
+        self.cache = cache
+
+        self._executor = ThreadPoolExecutor(max_workers = workers)
+
+        #The Future of each request in flight keyed by its cache key. Only requests that overlap in time are shared, finished responses are left to the cache
+        self._in_flight = dict()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def _fetch(self, url, params, decode, key):
+        """ Makes a request, or takes it from the cache, returning the same tuple as Directions.api_request """
+        if self.cache is not None:
+            text = self.cache.get(key)
+            if text is not None:
+                return decode(text), 0, None
+
+        query = dict(params)
+        query["key"] = self.api_key
+        response = self.transport.get(url, query, decode, self.limiter)
+
+        if response.data is None:
+            return None, response.retries, response.error
+
+        if self.cache is not None and get_status(response.data) in CACHEABLE_STATUSES:
+            self.cache.put(key, response.text)
+
+        return response.data, response.retries, None
+
+    def _request(self, url, params, decode):
+        """ Makes a request in a worker thread, or gives back the Future of an identical request that is already in flight so that duplicates do not take up a worker.
+
+        Returns:
+            A Future for the tuple returned by Directions.api_request
+        """
+        url = self.base_url + url
+        key = get_cache_key(url, params)
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.shared = self.shared + 1
+                return future
+
+            self.calls = self.calls + 1
+            future = self._executor.submit(self._fetch, url, params, decode, key)
+            self._in_flight[key] = future
+
+        future.add_done_callback(functools.partial(self._finished, key))
+        return future
+
+    def _finished(self, key, future):
+        """ Forgets a request once it has finished, so that a later identical request is made again (or taken from the cache) """
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def _check_postcodes(self, postcodes):
+        """ Normalises postcodes, raising InvalidPostcode for any that do not match the postcode pattern """
+        normalised = list()
+        for postcode in postcodes:
+            postcode = normalize_postcode(postcode)
+            if not check_postcode(postcode):
+                raise InvalidPostcode("Invalid postcode: '{}'".format(postcode))
+            normalised.append(postcode)
+        return normalised
+
+    def _mode_request(self, mode, origin, destination, waypoints):
+        """ Gets a Future for the ModeResult of one of driving, bicycling or walking """
+        params = {"origin": origin, "destination": destination, "mode": mode}
+        if waypoints:
+            params["waypoints"] = get_waypoint_string(waypoints)
+
+        def combine(responses):
+            result, retries, error = responses[0]
+            values = get_mode_values(mode, result, retries, error, log = quiet)
+            colnames = MODE_COLUMNS[mode]
+            return ModeResult(mode, values[colnames[2]], values.get(colnames[0]), values.get(colnames[1]), retries)
+
+        return gather([self._request(DIRECTIONS_URL, params, decode_directions)], combine)
+
+    def _transit_request(self, origin, destination, waypoints, departure_time):
+        """ Gets a Future for the TransitResult of a journey, requesting every leg between waypoints at the same time """
+        pairs = create_waypoint_pairs(origin, destination, waypoints) if waypoints else [(origin, destination)]
+        requests = [self._request(DIRECTIONS_URL, {"origin": start, "destination": end, "mode": "transit", "departure_time": departure_time}, decode_directions) for start, end in pairs]
+
+        def combine(responses):
+            legs = [get_transit_values(result, retries, error, departure_time, log = quiet) for result, retries, error in responses]
+            values = legs[0][0] if len(legs) == 1 else combine_transit_legs(legs, departure_time)
+
+            lines = list()
+            for result, retries, error in responses:
+                lines.extend(get_transit_lines(result))
+
+            ok = values["Transit Request Status"] == "OK"
+            return TransitResult(values["Transit Request Status"], values.get("Transit Distance (m)") if ok else None, values.get("Transit Duration (sec)") if ok else None, values.get("Number of Transit Nodes") if ok else None,
+                                 values.get("Walking Distance to 1st stop (m)") if ok else None, values.get("Walking Distance from last stop (m)") if ok else None, values.get("Total Walking Distance (m)") if ok else None,
+                                 lines, values.get("Transit Departure Time"), values["Transit Request Retries"])
+
+        return gather(requests, combine)
+
+    def get_directions(self, origin, destination, waypoints = None, modes = ALL_MODES, departure_time = None):
+        """ Gets the directions for a journey by each of the supplied modes of transport, as get_direction_data does for a row of the input.
+
+        Arguments:
+            origin - String - Origin postcode
+            destination - String - Destination postcode
+            waypoints - Iterable - Intermediate waypoint postcodes, None for none
+            modes - Iterable - The modes of transport to request
+            departure_time - Integer - The number of seconds since the epoch transit journeys depart at, by default now
+
+        Returns:
+            A Future for a JourneyResult
+
+        Raises:
+            InvalidPostcode straight away if any of the postcodes is invalid
+        """
+        origin, destination = self._check_postcodes([origin, destination])
+        waypoints = tuple(self._check_postcodes(waypoints or ()))
+        modes = [mode for mode in ALL_MODES if mode in modes]
+
+        futures = list()
+        for mode in modes:
+            if mode == 'transit':
+                futures.append(self._transit_request(origin, destination, waypoints, departure_time or int(time.time())))
+            else:
+                futures.append(self._mode_request(mode, origin, destination, waypoints))
+
+        return gather(futures, lambda results: JourneyResult(origin, destination, waypoints, dict(zip(modes, results))))
+
+    def get_transit(self, origin, destination, waypoints = None, departure_time = None):
+        """ Gets the public transport directions for a journey, as get_transit_details does with every leg between waypoints departing at the same time.
+
+        Arguments:
+            origin - String - Origin postcode
+            destination - String - Destination postcode
+            waypoints - Iterable - Intermediate waypoint postcodes, None for none
+            departure_time - Integer - The number of seconds since the epoch the journey departs at, by default now
+
+        Returns:
+            A Future for a TransitResult
+
+        Raises:
+            InvalidPostcode straight away if any of the postcodes is invalid
+        """
+        origin, destination = self._check_postcodes([origin, destination])
+        waypoints = tuple(self._check_postcodes(waypoints or ()))
+        return self._transit_request(origin, destination, waypoints, departure_time or int(time.time()))
+
+    def reverse_geocode(self, latitude, longitude):
+        """ Gets the postcodes for a point, as reverse_geocode does.
+
+        Arguments:
+            latitude - Float - The latitude of the point
+            longitude - Float - The longitude of the point
+
+        Returns:
+            A Future for a GeocodeResult
+        """
+        params = {"latlng": "{},{}".format(latitude, longitude), "result_type": "postal_code"}
+
+        def combine(responses):
+            result, retries, error = responses[0]
+            if result is None:
+                return GeocodeResult(error, list(), retries)
+            return GeocodeResult(result.get("status"), get_geocode_postcodes(result, error, log = quiet), retries)
+
+        return gather([self._request(GEOCODE_URL, params, decode_json)], combine)
+
+    def coalesced(self):
+        """ Gets the number of requests that were made and the number that shared the response of an identical request already in flight, as a tuple """
+        with self._lock:
+            return self.calls, self.shared
+
+    def close(self):
+        """ Waits for the requests in flight to finish and stops the worker threads """
+        self._executor.shutdown(wait = True)
+        if self.cache is not None:
+            self.cache.close()
+
+def client_from_settings(config):
+    """ Creates a DirectionsClient using the [API], [HTTP], [RateLimit] and [Cache] sections of the settings file, as GetData.py does, with the number of workers set by workers in the optional [Client] section.
+
+    Arguments:
+        config - ConfigParser - The parsed settings file
+
+    Returns:
+        A DirectionsClient
+    """
+    base_url = None
+    if config.has_option('API', 'base_url'):
+        base_url = config.get('API', 'base_url')
+
+    workers = 16
+    if config.has_option('Client', 'workers'):
+        workers = config.getint('Client', 'workers')
+
+    #Unless [HTTP] sets pool_size, keep a connection open for each worker
+    return DirectionsClient(config.get('API', 'key'), base_url, transport_from_settings(config, workers), limiter_from_settings(config), cache_from_settings(config), workers)
@@ -1,9 +1,48 @@
-import requests
 import csv
 import time
 import pytz
 import datetime
 import re
+import sys
+import threading
+import functools
+import itertools
+import os
+
+from Transport import HttpTransport, get_status
+from RateLimit import RateLimiter
+from KeyPool import KeyPool, NoKeysAvailable
+from Responses import decode_json, decode_directions, decode_directions_polylines
+
+#The column names for the distance, duration and request status of each of the non-transit modes of transport
+MODE_COLUMNS = {
+    'driving': ("Driving Distance (m)", "Driving Duration (sec)", "Driving request status", "Driving request retries"),
+    'bicycling': ("Bicycling Distance (m)", "Bicycling Duration (sec)", "Bicycling request status", "Bicycling request retries"),
+    'walking': ("Walking Distance (m)", "Walking Duration (sec)", "Walking request status", "Walking request retries")
+}
+
+#The column names for the shape of the route of each mode of transport, only written when route geometry is turned on (see set_geometry)
+ROUTE_COLUMNS = {
+    'driving': ("Driving Route Ratio", "Driving Distance in Areas (m)", "Driving Route Bounds"),
+    'bicycling': ("Bicycling Route Ratio", "Bicycling Distance in Areas (m)", "Bicycling Route Bounds"),
+    'walking': ("Walking Route Ratio", "Walking Distance in Areas (m)", "Walking Route Bounds"),
+    'transit': ("Transit Route Ratio", "Transit Distance in Areas (m)", "Transit Route Bounds")
+}
+
+#Every mode of transport that can be requested, in the order their columns are written
+ALL_MODES = ('driving', 'bicycling', 'walking', 'transit')
+
+#Optional input column listing the modes to request for a row, eg "transit;walking"
+MODES_COLUMN = "Modes"
+
+#Request status given to a mode the settings ask for but a row's Modes column does not
+NOT_REQUESTED = "NOT_REQUESTED"
+
+#Request status given to a mode that was not requested because the journey is too long in a straight line for it (see Prefilter.py)
+SKIPPED_DISTANCE = "SKIPPED_DISTANCE"
+
+#The columns that depend on the departure time, these are repeated for each time slot in a wide departure time sweep
+TRANSIT_COLUMNS = ("Transit Request Status", "Transit Request Retries", "Transit Distance (m)", "Transit Duration (sec)", "Number of Transit Nodes", "Walking Distance to 1st stop (m)", "Walking Distance from last stop (m)", "Total Walking Distance (m)", "Transit Lines", "Transit Departure Time") + ROUTE_COLUMNS['transit']
 
 def get_waypoint_string(waypoints):
     """ Creates a string of postcodes seperated by pipes (|) from the supplied list of postcodes
@@ -25,8 +64,441 @@ def get_waypoint_string(waypoints):
 
     return wps
 
-def get_dist_duration(UniqueID, start, end, api_key, waypoints = None):
-    """ Gets distance and duration of a journey between start and end postcodes for driving, cycling and walking.
+#The endpoints of the Google APIs, relative to the base URL (see set_base_url)
+DEFAULT_BASE_URL = 'https://maps.googleapis.com'
+DIRECTIONS_URL = '/maps/api/directions/json'
+GEOCODE_URL = '/maps/api/geocode/json'
+DISTANCE_MATRIX_URL = '/maps/api/distancematrix/json'
+
+#The name each endpoint is recorded under in the metrics
+API_NAMES = {DIRECTIONS_URL: "directions", GEOCODE_URL: "geocode", DISTANCE_MATRIX_URL: "distancematrix"}
+
+#Response statuses that are a definite answer for the request and so can be cached
+CACHEABLE_STATUSES = ("OK", "ZERO_RESULTS", "NOT_FOUND")
+
+#The scheme and host all requests are sent to, eg a local MockServer.py for testing (see set_base_url)
+_base_url = DEFAULT_BASE_URL
+
+#The token bucket every request waits on, shared by all threads and modes (see set_rate_limiter)
+_rate_limiter = RateLimiter()
+
+#Whether the status of each request and row is printed to the console (see set_verbose)
+_verbose = True
+
+#The counters every request is recorded in, None means nothing is recorded (see set_metrics)
+_metrics = None
+
+#The persistent response cache, None means no caching (see set_cache)
+_cache = None
+
+#The archive every response is appended to, None means responses are not archived (see set_archive)
+_archive = None
+
+#Whether responses are taken from the archive instead of the network (see set_archive)
+_replay = False
+
+#The UniqueID of the row each thread is currently requesting, recorded with its archived responses (see set_row_id)
+_row = threading.local()
+
+#The transport used to make requests, created when first needed (see set_transport)
+_transport = None
+_transport_lock = threading.Lock()
+
+#The index of known postcodes, None means postcodes are only checked against the pattern (see set_postcode_index)
+_postcode_index = None
+
+#Works out the shape of each route from its polylines, None means polylines are not kept and no route columns are added (see set_geometry)
+_geometry = None
+
+#Semaphore limiting the number of requests that may be in flight at once across all threads, None means no limit (see set_max_in_flight)
+_request_slots = None
+
+def set_max_in_flight(max_in_flight):
+    """ Sets the maximum number of API requests that may be in flight at the same time across all threads.
+
+    Arguments:
+        max_in_flight - Integer - The maximum number of concurrent requests, None or zero removes the limit
+    """
+    global _request_slots
+
+    if max_in_flight:
+        _request_slots = threading.BoundedSemaphore(max_in_flight)
+    else:
+        _request_slots = None
+
+def set_base_url(base_url):
+    """ Sets the scheme and host that all API requests are sent to.
+
+    Arguments:
+        base_url - String - eg 'http://localhost:8000' to use a local MockServer.py, None restores the Google APIs
+    """
+    global _base_url
+    _base_url = (base_url or DEFAULT_BASE_URL).rstrip("/")
+
+def set_rate_limiter(limiter):
+    """ Sets the rate limiter that every API request made over the network waits on, replacing the default of 50 requests per second.
+
+    Arguments:
+        limiter - RateLimit.RateLimiter - The limiter to share between all requests, None for no limit (eg when using a local MockServer.py)
+    """
+    global _rate_limiter
+    _rate_limiter = limiter
+
+def set_verbose(verbose):
+    """ Sets whether the status of each request and row is printed to the console.
+
+    Arguments:
+        verbose - Boolean - False turns the per-request output off, eg for large runs where it would flood the console
+    """
+    global _verbose
+    _verbose = verbose
+
+def log(message):
+    """ Prints a message about a single request or row to the console, unless this output has been turned off with set_verbose """
+    if _verbose:
+        print message
+
+def set_archive(archive, replay = False):
+    """ Sets the archive the raw text of every API response is appended to, or that responses are replayed from.
+
+    Arguments:
+        archive - Archive.ResponseArchive - The archive to use, None stops archiving
+        replay - Boolean - If True no requests are made over the network, every response is taken from the archive instead and requests that are not in it fail
+    """
+    global _archive, _replay
+    _archive = archive
+    _replay = replay
+
+def set_row_id(unique_id):
+    """ Sets the UniqueID of the row the current thread is making requests for, which is recorded with each archived response. Threads started by run_parallel carry on with the same row.
+
+    Arguments:
+        unique_id - String - The UniqueID, None if requests are not being made for a single row
+    """
+    _row.unique_id = unique_id
+
+def get_row_id():
+    """ Gets the UniqueID of the row the current thread is making requests for, None if it has not been set """
+    return getattr(_row, "unique_id", None)
+
+def set_geometry(geometry):
+    """ Sets the stage that works out the shape of each route from its polylines, adding the ROUTE_COLUMNS for each mode to the output.
+
+    Arguments:
+        geometry - Geometry.RouteGeometry - The geometry stage to use, None stops polylines being kept from the responses
+    """
+    global _geometry
+    _geometry = geometry
+
+def get_route_values(mode, shape, distance):
+    """ Gets the route columns of a mode of transport from the shape of its route.
+
+    Arguments:
+        mode - String - The mode of transport
+        shape - Geometry.RouteShape - The shape of the route
+        distance - Float - The distance of the route given by the API in metres
+
+    Returns:
+        A dictionary with the ratio of the route distance to the straight line distance from its start to its end, the distance travelled inside the areas (if any are set) and the bounds of the route as "south,west,north,east". Values that cannot be worked out, eg the ratio of a route that ends where it starts, are left out
+    """
+    ratio_column, areas_column, bounds_column = ROUTE_COLUMNS[mode]
+    values = dict()
+
+    straight_line = shape.straight_line()
+    if straight_line:
+        values[ratio_column] = round(distance / straight_line, 4)
+    if shape.inside is not None:
+        values[areas_column] = round(shape.inside, 1)
+    if shape.bounds is not None:
+        values[bounds_column] = "{:.5f},{:.5f},{:.5f},{:.5f}".format(*shape.bounds)
+
+    return values
+
+def set_metrics(metrics):
+    """ Sets the metrics that every API request is recorded in.
+
+    Arguments:
+        metrics - Metrics.Metrics - The counters to update, None stops recording
+    """
+    global _metrics
+    _metrics = metrics
+
+def set_cache(cache):
+    """ Sets the persistent response cache used by all API requests.
+
+    Arguments:
+        cache - ResponseCache - The cache to read and store responses in, None turns caching off
+    """
+    global _cache
+    _cache = cache
+
+def get_cache_key(url, params):
+    """ Creates a normalised key for a request so that identical requests map to the same cache entry. The API key is left out and postcodes are upper cased with surplus whitespace removed. Departure times are reduced to the weekday and time of day in London so that the same request made in a later week still matches.
+
+    Arguments:
+        url - String - The API endpoint
+        params - Dictionary - The query parameters, not including the API key
+
+    Returns:
+        String key for the request
+    """
+    parts = [url]
+
+    for name in sorted(params.keys()):
+        value = params[name]
+        if name in ("origin", "destination", "waypoints"):
+            value = " ".join(str(value).upper().split())
+        elif name == "departure_time":
+            value = datetime.datetime.fromtimestamp(int(value), pytz.timezone('Europe/London')).strftime("%w %H:%M:%S")
+        parts.append("{}={}".format(name, value))
+
+    return "&".join(parts)
+
+def set_transport(transport):
+    """ Sets the transport used to make all API requests, replacing the default HttpTransport.
+
+    Arguments:
+        transport - Object - Any object with a get(url, params, decode) method returning a Transport.TransportResponse, eg a Transport.HttpTransport with custom timeouts
+    """
+    global _transport
+    _transport = transport
+
+def get_transport():
+    """ Gets the transport used to make API requests, creating the default HttpTransport the first time it is needed. """
+    global _transport
+
+    with _transport_lock:
+        if _transport is None:
+            _transport = HttpTransport()
+
+    return _transport
+
+def send_request(url, query, decode, limiter, api, mode):
+    """ Sends a request through the current transport, waiting for a free request slot if a limit on the number of in flight requests has been set, and records it in the metrics.
+
+    Arguments:
+        url - String - The full URL of the API endpoint
+        query - Dictionary - The query parameters for the request, including the API key
+        decode - Function - Turns the raw response text into the decoded response
+        limiter - RateLimit.RateLimiter - The rate limiter the request waits on, None for no limit
+        api - String - The name of the API the request is recorded under
+        mode - String - The mode of transport the request is recorded under, None if there is not one
+
+    Returns:
+        A Transport.TransportResponse
+    """
+    transport = get_transport()
+    metrics = _metrics
+
+    started = time.time()
+
+    slots = _request_slots
+    if slots is None:
+        slot_wait = 0.0
+        response = transport.get(url, query, decode, limiter)
+    else:
+        with slots:
+            slot_wait = time.time() - started
+            response = transport.get(url, query, decode, limiter)
+
+    latency = time.time() - started - slot_wait
+
+    if metrics is not None:
+        status = "NETWORK_ERROR" if response.data is None else get_status(response.data)
+        metrics.record_request(api, mode, status, latency, response.retries, response.backoff, slot_wait, response.throttle)
+
+    return response
+
+def api_request(url, params, api_key, decode = decode_json):
+    """ Makes a GET request to one of the Google APIs through the current transport. If a response cache has been set the response is taken from it where possible and successful responses are saved to it. Requests made over the network wait on the shared rate limiter, or the key's own limiter when using a KeyPool, and if a limit on the number of in flight requests has been set for a free request slot.
+
+    Arguments:
+        url - String - The API endpoint relative to the base URL, eg DIRECTIONS_URL
+        params - Dictionary - The query parameters for the request, not including the API key
+        api_key - String or KeyPool - The google_api key to be used for the request, or a pool of keys to choose from
+        decode - Function - Turns the raw response text into the returned response, by default the full decoded JSON
+
+    Returns:
+        A tuple of:
+            The decoded response (a dictionary, or the record returned by decode), or None if the request failed
+            Integer number of times the request was retried
+            String describing why the request failed, or None if it did not
+    """
+    cache = _cache
+    archive = _archive
+    api = API_NAMES.get(url, url)
+    mode = params.get("mode")
+
+    #The archive is keyed without the base URL so responses can be replayed whichever server they came from
+    if archive is not None:
+        archive_key = get_cache_key(url, params)
+        if _replay:
+            text = archive.get(archive_key)
+            if text is None:
+                return None, 0, "Not in the response archive"
+            return decode(text), 0, None
+
+    url = _base_url + url
+
+    if cache is not None:
+        key = get_cache_key(url, params)
+        text = cache.get(key)
+        if text is not None:
+            if _metrics is not None:
+                _metrics.record_cache_hit(api, mode)
+            data = decode(text)
+            if archive is not None and archive_key not in archive:
+                archive.put(archive_key, text, get_row_id(), api, mode, get_status(data))
+            return data, 0, None
+
+    query = dict(params)
+
+    if isinstance(api_key, KeyPool):
+        #Use the key with the most headroom, moving on to the next best key if the request failed because of the key
+        while True:
+            try:
+                pool_key = api_key.choose()
+            except NoKeysAvailable as e:
+                return None, 0, str(e)
+
+            query["key"] = pool_key.key
+            response = send_request(url, query, decode, pool_key.limiter, api, mode)
+
+            if not api_key.record(pool_key, None if response.data is None else get_status(response.data)):
+                break
+    else:
+        query["key"] = api_key
+        response = send_request(url, query, decode, _rate_limiter, api, mode)
+
+    if response.data is None:
+        return None, response.retries, response.error
+
+    if archive is not None:
+        archive.put(archive_key, response.text, get_row_id(), api, mode, get_status(response.data))
+
+    #Only keep responses that will give the same answer next time, not transient errors such as OVER_QUERY_LIMIT
+    if cache is not None and get_status(response.data) in CACHEABLE_STATUSES:
+        cache.put(key, response.text)
+
+    return response.data, response.retries, None
+
+def run_parallel(functions):
+    """ Runs each of the supplied functions in its own thread and waits for them all to finish.
+
+    Arguments:
+        functions - Iterable - Functions taking no arguments
+
+    Returns:
+        A list of the values returned by each function, in the same order as the supplied functions. If any function raised an exception the first one is re-raised here.
+    """
+    functions = list(functions)
+    results = [None] * len(functions)
+    errors = [None] * len(functions)
+    unique_id = get_row_id()
+
+    def run(i):
+        set_row_id(unique_id)
+        try:
+            results[i] = functions[i]()
+        except Exception:
+            errors[i] = sys.exc_info()
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(functions))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for error in errors:
+        if error:
+            raise error[0], error[1], error[2]
+
+    return results
+
+def get_mode_dist_duration(start, end, mode, api_key, waypoints = None):
+    """ Gets distance and duration of a journey between start and end postcodes for a single mode of transport.
+
+    Arguements:
+        start - String - Origin postcode
+        end - String - Destination postcode
+        mode - String - One of 'driving', 'bicycling' or 'walking'
+        api_key - String - The google_api key to be used for the request
+        waypoints - Iterable - Containing a list of intermediate waypoint postcodes
+
+    Returns:
+        A dictionary containing the distance, duration, request status and number of retries for the supplied mode, eg for driving:
+            "Driving Distance (m)",
+            "Driving Duration (sec)",
+            "Driving request status",
+            "Driving request retries"
+    """
+    #Make the appropriate request, depending on weather waypoints are needed, to the Google Directions API
+    params = {"origin": start, "destination": end, "mode": mode}
+    if waypoints:
+        params["waypoints"] = get_waypoint_string(waypoints)
+
+    #Only the fields needed are kept from the response (see Responses.decode_directions), including the polylines if the shape of the route is needed
+    geometry = _geometry
+    result, retries, error = api_request(DIRECTIONS_URL, params, api_key, decode = decode_directions if geometry is None else decode_directions_polylines)
+
+    return get_mode_values(mode, result, retries, error, geometry)
+
+def get_mode_values(mode, result, retries, error, geometry = None, log = log):
+    """ Gets the distance, duration, request status and number of retries for a single mode of transport from a Directions API response.
+
+    Arguments:
+        mode - String - One of 'driving', 'bicycling' or 'walking'
+        result - Responses.DirectionsResult - The decoded response, None if the request failed
+        retries - Integer - The number of times the request was retried
+        error - String - Why the request failed, None if it did not
+        geometry - Geometry.RouteGeometry - Works out the route columns from the polylines kept in the result, None to leave them out
+        log - Function - Called with the status of the request, by default printing it unless turned off with set_verbose
+
+    Returns:
+        A dictionary of the columns described in get_mode_dist_duration
+    """
+    colnames = MODE_COLUMNS[mode]
+
+    values = dict()
+    values[colnames[3]] = retries
+
+    #If the request is not successful print an error, record it as the status and do no further processing for this record
+    if result is None:
+        log(error)
+        values[colnames[2]] = error
+    else:
+        #Get the status string and print it to the console
+        status = result.status
+        log(colnames[2] + ": " + status)
+
+        #If the request went through ok then add the results to the values dictionary
+        if status == "OK":
+            #Initialise the counter variables for the total distance and duration
+            distance = 0.0
+            duration = 0.0
+
+            #Cycle through each of the legs in this route
+            for leg in result.legs:
+                #Adds distance and duration of leg to the totals
+                distance = distance + leg.distance
+                duration = duration + leg.duration
+
+            #Once we have cycled through all the legs of the route save the totals to the values dictionary
+            values[colnames[0]] = distance
+            values[colnames[1]] = duration
+
+            #Add the shape of the route worked out from its polylines
+            if geometry is not None:
+                values.update(get_route_values(mode, geometry.measure([result.polylines])[0], distance))
+
+        #Add the status to the output
+        values[colnames[2]] = status
+
+    return values
+
+def get_dist_duration(UniqueID, start, end, api_key, waypoints = None, parallel = False, known_values = None, modes = None):
+    """ Gets distance and duration of a journey between start and end postcodes for driving, cycling and walking, or just the supplied modes.
 
     Arguements:
         UniqueID - String - The unique ID number for this postcode start-end pair
@@ -34,6 +506,9 @@ def get_dist_duration(UniqueID, start, end, api_key, waypoints = None):
         end - String - Destination postcode
         api_key - String - The google_api key to be used for the request
         waypoints - Iterable - Containing a list of intermediate waypoint postcodes
+        parallel - Boolean - If True the request for each mode is made concurrently in its own thread
+        known_values - Dictionary - Values already found for some of the modes (eg from get_matrix_dist_duration), no request is made for a mode whose request status is in here
+        modes - Iterable - The modes to request, by default driving, bicycling and walking. Transit is ignored as it is handled by get_transit_details
 
     Returns:
         A dictionary containing the origin and destination postcodes and the distance and duration for each mode of transport
@@ -48,10 +523,13 @@ def get_dist_duration(UniqueID, start, end, api_key, waypoints = None):
             "Walking Duration (sec)"
     """
     #Array containing modes of transport for which information is requested - transit handled separately below as output is more complex
-    modes = ('driving', 'bicycling', 'walking')
+    if modes is None:
+        modes = ('driving', 'bicycling', 'walking')
+    modes = [mode for mode in modes if mode in MODE_COLUMNS]
 
-    #Set up a list containing the column header names for each of the distance and duration values to be added as keys to the values dictionary
-    colnames = (("Driving Distance (m)","Driving Duration (sec)", "Driving request status"),("Bicycling Distance (m)", "Bicycling Duration (sec)", "Bicycling request status"),("Walking Distance (m)", "Walking Duration (sec)", "Walking request status"))
+    #Skip any modes whose values are already known
+    if known_values:
+        modes = [mode for mode in modes if MODE_COLUMNS[mode][2] not in known_values]
 
     #The dictionary that will store distance and duration for the start and end postcodes supplied for each travel mode
     values = dict()
@@ -61,52 +539,182 @@ def get_dist_duration(UniqueID, start, end, api_key, waypoints = None):
     values["Origin Postcode"] = start
     values["Destination Postcode"] = end
 
-    #Cycle through the transport modes and get the directions for each
-    for i, mode in enumerate(modes):
+    if known_values:
+        values.update(known_values)
 
-        #Make the appropriate request, depending on weather waypoints are needed, to the Google Directions API
-        if waypoints:
-            r = requests.get('https://maps.googleapis.com/maps/api/directions/json?origin={}&destination={}&waypoints={}&mode={}&key={}'.format(start, end, get_waypoint_string(waypoints), mode, api_key))
-        else:
-            r = requests.get('https://maps.googleapis.com/maps/api/directions/json?origin={}&destination={}&mode={}&key={}'.format(start, end, mode, api_key))
+    #Get the directions for each of the transport modes, either one after the other or all at once
+    if parallel:
+        mode_values = run_parallel([functools.partial(get_mode_dist_duration, start, end, mode, api_key, waypoints) for mode in modes])
+    else:
+        mode_values = [get_mode_dist_duration(start, end, mode, api_key, waypoints) for mode in modes]
 
-        #If the request is not successful print an error and do no further processing for this record
-        if r.status_code != 200:
-            print "Request network error"
+    for mode_value in mode_values:
+        values.update(mode_value)
+
+    return values
+
+def pack_matrix_blocks(pairs, max_elements = 100, max_side = 25, min_density = 0.5):
+    """ Groups origin and destination pairs into blocks that can each be sent as a single Distance Matrix request. A request returns every origin to every destination, so pairs sharing an origin or destination are packed together to keep the number of unused elements down. The API charges for every element, so a block answering fewer than min_density of its elements is broken up and its pairs are sent one at a time instead.
+
+    Arguments:
+        pairs - Iterable - (origin, destination) postcode tuples
+        max_elements - Integer - The most elements (origins x destinations) allowed in one request
+        max_side - Integer - The most origins, or destinations, allowed in one request
+        min_density - Float - The smallest fraction of a block's elements that must be pairs asked for, 0 to keep every block
+
+    Returns:
+        A list of (origins, destinations, pairs) tuples, where origins and destinations are lists of postcodes and pairs is the list of pairs answered by that block
+    """
+    blocks = list()
+    origins = list()
+    destinations = list()
+    block_pairs = list()
+
+    #Sorting by destination puts pairs sharing a destination (eg everyone going to the same site) next to each other
+    for origin, destination in sorted(set(pairs), key=lambda pair: (pair[1], pair[0])):
+        n_origins = len(origins) + (origin not in origins)
+        n_destinations = len(destinations) + (destination not in destinations)
+
+        if block_pairs and (n_origins * n_destinations > max_elements or n_origins > max_side or n_destinations > max_side):
+            blocks.append((origins, destinations, block_pairs))
+            origins = list()
+            destinations = list()
+            block_pairs = list()
+
+        if origin not in origins:
+            origins.append(origin)
+        if destination not in destinations:
+            destinations.append(destination)
+        block_pairs.append((origin, destination))
+
+    if block_pairs:
+        blocks.append((origins, destinations, block_pairs))
+
+    #Sending the pairs of a sparse block on their own uses fewer elements than the whole block
+    packed = list()
+    for origins, destinations, block_pairs in blocks:
+        if len(block_pairs) < min_density * len(origins) * len(destinations):
+            packed.extend(([origin], [destination], [(origin, destination)]) for origin, destination in block_pairs)
         else:
-            #Turn the returned JSON string into a dictionary
-            result = r.json()
-            #Get the status string and print it to the console
-            status = result.get('status')
-            print colnames[i][2] + ": " + status
+            packed.append((origins, destinations, block_pairs))
+
+    return packed
+
+def get_matrix_dist_duration(pairs, mode, api_key, min_density = 0.5):
+    """ Gets the distance and duration of many journeys without waypoints for a single mode of transport, using as few Distance Matrix API requests as possible.
+
+    Arguments:
+        pairs - Iterable - (origin, destination) postcode tuples
+        mode - String - One of 'driving', 'bicycling' or 'walking'
+        api_key - String - The google_api key to be used for the requests
+        min_density - Float - Blocks answering fewer than this fraction of their elements are sent a pair at a time (see pack_matrix_blocks)
 
-            #If the request went through ok then add the results to the values dictionary
+    Returns:
+        A dictionary keyed by (origin, destination) tuple, each value is a dictionary of the same columns returned by get_mode_dist_duration
+    """
+    colnames = MODE_COLUMNS[mode]
+
+    results = dict()
+
+    for origins, destinations, block_pairs in pack_matrix_blocks(pairs, min_density = min_density):
+        params = {"origins": get_waypoint_string(origins), "destinations": get_waypoint_string(destinations), "mode": mode}
+
+        result, retries, error = api_request(DISTANCE_MATRIX_URL, params, api_key)
+
+        #If the whole request failed every pair in the block gets the same status
+        if result is None or result.get("status") != "OK":
+            status = error if result is None else result.get("status")
+            log("{} matrix request status: {}".format(mode, status))
+            for pair in block_pairs:
+                results[pair] = {colnames[2]: status, colnames[3]: retries}
+            continue
+
+        rows = result.get("rows")
+
+        for origin, destination in block_pairs:
+            element = rows[origins.index(origin)].get("elements")[destinations.index(destination)]
+            status = element.get("status")
+
+            values = {colnames[2]: status, colnames[3]: retries}
             if status == "OK":
-                #Get list of legs for this direction request
-                legs = result.get('routes')[0].get('legs')
+                values[colnames[0]] = float(element.get("distance").get("value"))
+                values[colnames[1]] = float(element.get("duration").get("value"))
+
+            results[(origin, destination)] = values
+
+    return results
+
+def get_matrix_pairs(jobs, matrix_modes, skip = None):
+    """ Finds the rows that can be answered by the Distance Matrix API, and which of the modes each needs.
 
-                #Initialise the counter variables for the total distance and duration
-                distance = 0.0
-                duration = 0.0
+    Arguments:
+        jobs - List - (input_data, known_values) tuples as passed to add_matrix_values
+        matrix_modes - Iterable - The driving, bicycling and walking modes set for the whole run
+        skip - Function - Called with each row, rows it returns True for are left out of the matrix
 
-                #Cycle through each of the legs in this route
-                for leg in legs:
-                    #Adds distance of leg to values dictionary using value of distance from distance dictionary which is in the leg dictionary
-                    distance = distance + leg.get('distance').get('value')
-                    #Adds duration of leg to values dictionary using value of duration from duration dictionary which is in the leg dictionary
-                    duration = duration + leg.get('duration').get('value')
+    Returns:
+        A list with an entry for each job, either a tuple of the normalised (origin, destination) pair and the modes to get from the matrix, or None if the row is left to get_directions
+    """
+    row_pairs = list()
+    for input_data, known_values in jobs:
+        origin = normalize_postcode(input_data["OriginPostcode"])
+        destination = normalize_postcode(input_data["DestinationPostcode"])
+        try:
+            row_modes = get_row_modes(input_data, matrix_modes)
+        except ValueError:
+            row_modes = None
+        if row_modes and known_values:
+            row_modes = tuple(mode for mode in row_modes if MODE_COLUMNS[mode][2] not in known_values)
+        if row_modes and (skip is None or not skip(input_data)) and not get_waypoint_list(input_data) and is_valid_postcode(origin) and is_valid_postcode(destination):
+            row_pairs.append(((origin, destination), row_modes))
+        else:
+            row_pairs.append(None)
 
-                #Once we have cycled through all the legs of the route save the totals to the values dictionary
-                values[colnames[i][0]] = distance
-                values[colnames[i][1]] = duration
+    return row_pairs
 
-            #Add the status to the output
-            values[colnames[i][2]] = status
+def add_matrix_values(jobs, api_key, chunk_size = 1000, parallel = False, skip = None, modes = ALL_MODES, min_density = 0.5):
+    """ Reads the input rows in chunks and gets the driving, bicycling and walking values for every row without waypoints using the Distance Matrix API. Rows with waypoints or invalid postcodes are left to get_directions.
 
-        #Sleep for half a second to prevent overloading the API
-        time.sleep(0.5)
+    Arguments:
+        jobs - Iterable - (input_data, known_values) tuples, where input_data is a dictionary read from the input csv and known_values is a dictionary of values already found for some of its modes (eg by Prefilter.DistanceFilter) or None. No matrix requests are made for the modes in known_values
+        api_key - String - The google_api key to be used for the requests
+        chunk_size - Integer - The number of rows read ahead and sent to the Distance Matrix API together
+        parallel - Boolean - If True the requests for the three modes are made concurrently
+        skip - Function - Called with each row, rows it returns True for need no requests (eg they are copied from an earlier output) so are left out of the matrix
+        modes - Iterable - The modes set for the whole run, each row only gets values for its own modes (see get_row_modes)
+        min_density - Float - Blocks answering fewer than this fraction of their elements are sent a pair at a time (see pack_matrix_blocks)
 
-    return values
+    Returns:
+        A generator of (input_data, known_values) tuples in input order, where known_values is the dictionary of matrix values (added to any that were already known) to pass to get_directions, or the known values passed in for rows the matrix was not used for
+    """
+    matrix_modes = [mode for mode in modes if mode in MODE_COLUMNS]
+    jobs = iter(jobs)
+
+    while True:
+        chunk = list(itertools.islice(jobs, chunk_size))
+        if not chunk:
+            return
+
+        row_pairs = get_matrix_pairs(chunk, matrix_modes, skip)
+        mode_pairs = [set(row[0] for row in row_pairs if row and mode in row[1]) for mode in matrix_modes]
+
+        #The matrix requests are shared between rows so are not archived under any one of them
+        set_row_id(None)
+
+        if parallel:
+            mode_results = run_parallel([functools.partial(get_matrix_dist_duration, pairs, mode, api_key, min_density) for mode, pairs in zip(matrix_modes, mode_pairs)])
+        else:
+            mode_results = [get_matrix_dist_duration(pairs, mode, api_key, min_density) for mode, pairs in zip(matrix_modes, mode_pairs)]
+
+        for (input_data, known_values), row in zip(chunk, row_pairs):
+            if row is None:
+                yield input_data, known_values
+            else:
+                known_values = dict(known_values or ())
+                for mode, results in zip(matrix_modes, mode_results):
+                    if mode in row[1]:
+                        known_values.update(results[row[0]])
+                yield input_data, known_values
 
 def get_departure_time(departure_time, weekday = 2):
     """ Gets the number of seconds since the epoch (midnight 01/01/1970) to the next weekday (wednesday as default as this is unlikly to be a public holiday) at the provided time.
@@ -153,6 +761,36 @@ def get_departure_time(departure_time, weekday = 2):
 
     return dt_secs
 
+def get_departure_times(start_time, end_time, step, weekday = 2):
+    """ Gets the departure time slots for a sweep from start_time to end_time (inclusive) on the next supplied weekday.
+
+    Arguments:
+        start_time - String - Time of day of the first slot in the format HH:mm:ss
+        end_time - String - Time of day of the last slot in the format HH:mm:ss
+        step - Integer - Number of minutes between each slot
+        weekday - Integer - The day of the week to use. Monday = 0, Sunday = 6
+
+    Returns:
+        A list of (slot name, departure time) tuples, where the slot name is the time of day as HH:MM and the departure time is the number of seconds since the epoch
+    """
+    def seconds_of_day(time_string):
+        parts = [int(part) for part in time_string.split(":")]
+        return parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+    start = seconds_of_day(start_time)
+    end = seconds_of_day(end_time)
+    if end < start or step <= 0:
+        raise ValueError("The sweep must end after it starts and the step must be at least one minute")
+
+    first_departure = get_departure_time(start_time, weekday)
+
+    slots = list()
+    for offset in range(0, end - start + 1, step * 60):
+        slot = start + offset
+        slots.append(("{:02d}:{:02d}".format(slot // 3600, (slot % 3600) // 60), first_departure + offset))
+
+    return slots
+
 def get_single_transit_journey(start, end, api_key, departure_time = None):
     """ Gets direction information (see dictionary keys) for public transport between the supplied start and end postcodes. This method assumes no intermediat waypoints and uses the 1st returned route.
 
@@ -172,52 +810,95 @@ def get_single_transit_journey(start, end, api_key, departure_time = None):
             "Walking Distance from last stop (m)",
             "Total Walking Distance (m)"
     """
+    return get_transit_leg(start, end, api_key, departure_time)[0]
 
-    #The dictionary that will store the transit information for the supplied origin and destination
-    values = dict()
+def get_transit_leg(start, end, api_key, departure_time = None):
+    """ Gets the same direction information as get_single_transit_journey along with the time the journey arrives, so that a following leg can be timed to depart from it, and the shape of its route so that the shapes of the legs between waypoints can be joined.
+
+    Arguements:
+        start - String - Origin postcode
+        end - String - Destination postcode
+        api_key - String - The google_api key to be used for the request
+        departure_time - Integer - The number of seconds since the epoch (midnight 01/01/1970) the default is the current time
+
+    Returns:
+        A tuple of the dictionary returned by get_single_transit_journey, the arrival time in seconds since the epoch (None if the request failed) and the Geometry.RouteShape of the route (None if the request failed or route geometry is turned off)
+    """
 
     #Make the request to the Google Directions API
+    params = {"origin": start, "destination": end, "mode": "transit"}
     if departure_time:
-        #If a depature time is provided use it
-        r = requests.get('https://maps.googleapis.com/maps/api/directions/json?origin={}&destination={}&mode=transit&depature_time={}&key={}'.format(start, end, departure_time, api_key))
-    else:
-        #If no depature time is provided use the current time (this is the default api behaviour if not time is provided)
-        r = requests.get('https://maps.googleapis.com/maps/api/directions/json?origin={}&destination={}&mode=transit&key={}'.format(start, end, api_key))
+        #If a departure time is provided use it
+        params["departure_time"] = departure_time
+    #If no depature time is provided use the current time (this is the default api behaviour if not time is provided)
+
+    #Only the fields needed are kept from the response (see Responses.decode_directions), including the polylines if the shape of the route is needed
+    geometry = _geometry
+    result, retries, error = api_request(DIRECTIONS_URL, params, api_key, decode = decode_directions if geometry is None else decode_directions_polylines)
+
+    return get_transit_values(result, retries, error, departure_time, geometry)
+
+def get_transit_values(result, retries, error, departure_time, geometry = None, log = log):
+    """ Gets the transit columns for a single journey from a Directions API response.
+
+    Arguments:
+        result - Responses.DirectionsResult - The decoded response, None if the request failed
+        retries - Integer - The number of times the request was retried
+        error - String - Why the request failed, None if it did not
+        departure_time - Integer - The departure time the request was made with, in seconds since the epoch
+        geometry - Geometry.RouteGeometry - Works out the route columns from the polylines kept in the result, None to leave them out
+        log - Function - Called with the status of the request and the transit lines used, by default printing them unless turned off with set_verbose
+
+    Returns:
+        The same tuple as get_transit_leg
+    """
+
+    #The dictionary that will store the transit information for the supplied origin and destination
+    values = dict()
+    arrival_time = None
+    shape = None
+
+    values["Transit Request Retries"] = retries
 
-    if r.status_code != 200:
-        print "Request Error"
+    if result is None:
+        log(error)
+        values["Transit Request Status"] = error
     else:
-        #For every request there is an associated status - turn the returned JSON string into a dictionary
-        result = r.json()
         #Get the status string and print it to the console
-        status = result.get('status')
-        print "Transit Status: " + status
+        status = result.status
+        log("Transit Status: " + status)
 
         #Add the Transit status to the values dictionary
         values["Transit Request Status"] = status
 
         if status == "OK":
             #Get the 1st leg of the 1st route
-            leg = result.get('routes')[0].get('legs')[0]
+            leg = result.legs[0]
             #Add the total distance and duration to the values dictionary
-            values["Transit Distance (m)"] = leg.get('distance').get('value')
-            values["Transit Duration (sec)"] = leg.get('duration').get('value')
+            values["Transit Distance (m)"] = leg.distance
+            values["Transit Duration (sec)"] = leg.duration
 
-            #Get the steps for this transit direction - returns list of step objects
-            steps = leg.get('steps')
+            #Get the arrival time, working it out from the duration if the API does not give one (eg for a journey that is all walking)
+            if leg.arrival_time:
+                arrival_time = leg.arrival_time
+            elif departure_time:
+                arrival_time = departure_time + values["Transit Duration (sec)"]
+
+            #Get the steps for this transit direction - a list of DirectionsStep records
+            steps = leg.steps
 
             #Add the number of nodes in the transit directions by getting length of steps array
             nsteps = len(steps)
             values["Number of Transit Nodes"] = nsteps
 
             #Get the walking distance for the 1st and last nodes. Uses -1 because zero indexed. If the 1st and last steps are not walking then add 0 to indicate negligble walking
-            if steps[0].get('travel_mode') == 'WALKING':
-                values["Walking Distance to 1st stop (m)"] = steps[0].get('distance').get('value')
+            if steps[0].travel_mode == 'WALKING':
+                values["Walking Distance to 1st stop (m)"] = steps[0].distance
             else:
                 values["Walking Distance to 1st stop (m)"] = 0.0
 
-            if steps[nsteps-1].get('travel_mode') == 'WALKING':
-                values["Walking Distance from last stop (m)"] = steps[nsteps-1].get('distance').get('value')
+            if steps[nsteps-1].travel_mode == 'WALKING':
+                values["Walking Distance from last stop (m)"] = steps[nsteps-1].distance
             else:
                 values["Walking Distance from last stop (m)"] = 0.0
 
@@ -225,19 +906,18 @@ def get_single_transit_journey(start, end, api_key, departure_time = None):
             walking_dist = 0.0
 
             #For each step that Google labels as "WALKING" add the distance to the prior total walking from above.
-            print "Transit Lines:"
+            log("Transit Lines:")
             lines = ""
             for step in steps:
-                if step.get('travel_mode') == 'WALKING':
-                    walking_dist = walking_dist + step.get('distance').get('value')
+                if step.travel_mode == 'WALKING':
+                    walking_dist = walking_dist + step.distance
                 else:
                     #Print out the name of the transit line to the console to help with verification.
-                    try:
-                        line_name = step.get("transit_details").get("line").get("short_name")
-                        lines = lines + " " + line_name
-                        print line_name
-                    except (AttributeError, TypeError):
-                        print "Error: no transit line name found"
+                    if step.line_name is not None:
+                        lines = lines + " " + step.line_name
+                        log(step.line_name)
+                    else:
+                        log("Error: no transit line name found")
 
             #Add the total walking distance
             values["Total Walking Distance (m)"] = walking_dist
@@ -248,10 +928,12 @@ def get_single_transit_journey(start, end, api_key, departure_time = None):
             #Add the departure time used in the request
             values["Transit Departure Time"] = datetime.datetime.fromtimestamp(departure_time)
 
-    #Sleep for half a second to prevent overloading the API
-    time.sleep(0.5)
+            #Add the shape of the route worked out from its polylines
+            if geometry is not None:
+                shape = geometry.measure([result.polylines])[0]
+                values.update(get_route_values('transit', shape, leg.distance))
 
-    return values
+    return values, arrival_time, shape
 
 def create_waypoint_pairs(start, end, waypoints):
     """ Creates a list of postcode pairs starting with the supplied start and end postcode.
@@ -276,7 +958,7 @@ def create_waypoint_pairs(start, end, waypoints):
 
     return pairs
 
-def get_transit_details(start, end, api_key, departure_time = None, waypoints = None):
+def get_transit_details(start, end, api_key, departure_time = None, waypoints = None, parallel = False, chain_departures = False):
     """ Gets direction information (see dictionary keys) for public transport between the supplied start and end postcodes and will include intermediate waypoints if supplied.
 
     Arguements:
@@ -285,6 +967,8 @@ def get_transit_details(start, end, api_key, departure_time = None, waypoints =
         api_key - String - The google_api key to be used for the request
         departure_time - Integer - The number of seconds since the epoch (midnight 01/01/1970) the default is the current time
         waypoints - Iterable - List of waypoint postcode strings
+        parallel - Boolean - If True the request for each leg between waypoints is made concurrently
+        chain_departures - Boolean - If True each leg departs at the time the previous leg arrives, rather than every leg using departure_time. The legs are then requested one after another as each depends on the one before.
 
     Returns:
         A dictionary containing the origin and destination postcodes and the distance and duration for each mode of transport
@@ -298,44 +982,79 @@ def get_transit_details(start, end, api_key, departure_time = None, waypoints =
     """
     if waypoints:
 
-        print "Running Transit Waypoints:"
+        log("Running Transit Waypoints:")
 
         #Get a list of waypoint pairs
         pairs = create_waypoint_pairs(start, end, waypoints)
 
-        #Set up the total dictionary and initialise the key value pairs
-        total = dict()
-        total["Transit Distance (m)"] = 0.0
-        total["Transit Duration (sec)"] = 0.0
-        total["Number of Transit Nodes"] = 0
-        total["Walking Distance to 1st stop (m)"] = 0.0
-        total["Walking Distance from last stop (m)"] = 0.0
-        total["Total Walking Distance (m)"] = 0.0
-        total["Transit Request Status"] = "OK"
-        total["Transit Lines"] = ""
-        total["Transit Departure Time"] = datetime.datetime.fromtimestamp(departure_time)
-
-        #Cycle through the waypoint pairs and add each value to the total
-        for i, pair in enumerate(pairs):
-
-            pair_details = get_single_transit_journey(pair[0], pair[1], api_key, departure_time)
-
-            if pair_details["Transit Request Status"] != "OK":
-                total["Transit Request Status"] = pair_details["Transit Request Status"]
-
-            total["Transit Distance (m)"] = total["Transit Distance (m)"] + pair_details["Transit Distance (m)"]
-            total["Transit Duration (sec)"] = total["Transit Duration (sec)"] + pair_details["Transit Duration (sec)"]
-            total["Number of Transit Nodes"] = total["Number of Transit Nodes"] + pair_details["Number of Transit Nodes"]
-            total["Walking Distance to 1st stop (m)"] =  total["Walking Distance to 1st stop (m)"] + pair_details["Walking Distance to 1st stop (m)"]
-            total["Walking Distance from last stop (m)"] = total["Walking Distance from last stop (m)"] + pair_details["Walking Distance from last stop (m)"]
-            total["Total Walking Distance (m)"] = total["Total Walking Distance (m)"] + pair_details["Total Walking Distance (m)"]
-            total["Transit Lines"] = total["Transit Lines"] + " Waypoint {}: ".format(i+1) + pair_details["Transit Lines"]
-
-        return total
+        #Get the details for each leg, all at once if they are independent or in order if each leg departs when the last arrives
+        if chain_departures:
+            legs = list()
+            leg_departure = departure_time
+            for pair in pairs:
+                leg = get_transit_leg(pair[0], pair[1], api_key, leg_departure)
+                legs.append(leg)
+                #If a leg fails carry on from the last known time
+                if leg[1]:
+                    leg_departure = leg[1]
+        elif parallel:
+            legs = run_parallel([functools.partial(get_transit_leg, pair[0], pair[1], api_key, departure_time) for pair in pairs])
+        else:
+            legs = [get_transit_leg(pair[0], pair[1], api_key, departure_time) for pair in pairs]
+
+        return combine_transit_legs(legs, departure_time, _geometry)
     else:
         return get_single_transit_journey(start, end, api_key, departure_time)
 
-def get_direction_data(UniqueID, start, end, api_key, depature_time = None, waypoints = None):
+def combine_transit_legs(legs, departure_time, geometry = None):
+    """ Adds up the transit columns of each leg of a journey between waypoints into the columns for the whole journey. If any leg failed the journey has the status of the last leg that failed, and its totals only include the legs that did not.
+
+    Arguments:
+        legs - List - The tuples returned by get_transit_leg for each leg, in the order they are travelled
+        departure_time - Integer - The departure time of the journey, in seconds since the epoch
+        geometry - Geometry.RouteGeometry - Joins the shapes of the legs into the route columns for the whole journey, None to leave them out
+
+    Returns:
+        A dictionary of the same columns as get_single_transit_journey
+    """
+    #Set up the total dictionary and initialise the key value pairs
+    total = dict()
+    total["Transit Distance (m)"] = 0.0
+    total["Transit Duration (sec)"] = 0.0
+    total["Number of Transit Nodes"] = 0
+    total["Walking Distance to 1st stop (m)"] = 0.0
+    total["Walking Distance from last stop (m)"] = 0.0
+    total["Total Walking Distance (m)"] = 0.0
+    total["Transit Request Status"] = "OK"
+    total["Transit Request Retries"] = 0
+    total["Transit Lines"] = ""
+    total["Transit Departure Time"] = datetime.datetime.fromtimestamp(departure_time)
+
+    #Cycle through the legs in order and add each value to the total
+    for i, (pair_details, arrival_time, shape) in enumerate(legs):
+
+        total["Transit Request Retries"] = total["Transit Request Retries"] + pair_details.get("Transit Request Retries", 0)
+
+        #If a leg failed record its status and leave it out of the totals, as it has no values to add
+        if pair_details.get("Transit Request Status") != "OK":
+            total["Transit Request Status"] = pair_details.get("Transit Request Status", "NA")
+            continue
+
+        total["Transit Distance (m)"] = total["Transit Distance (m)"] + pair_details["Transit Distance (m)"]
+        total["Transit Duration (sec)"] = total["Transit Duration (sec)"] + pair_details["Transit Duration (sec)"]
+        total["Number of Transit Nodes"] = total["Number of Transit Nodes"] + pair_details["Number of Transit Nodes"]
+        total["Walking Distance to 1st stop (m)"] =  total["Walking Distance to 1st stop (m)"] + pair_details["Walking Distance to 1st stop (m)"]
+        total["Walking Distance from last stop (m)"] = total["Walking Distance from last stop (m)"] + pair_details["Walking Distance from last stop (m)"]
+        total["Total Walking Distance (m)"] = total["Total Walking Distance (m)"] + pair_details["Total Walking Distance (m)"]
+        total["Transit Lines"] = total["Transit Lines"] + " Waypoint {}: ".format(i+1) + pair_details["Transit Lines"]
+
+    #The shape of the whole journey is the shapes of the legs joined together, so the ratio is to the straight line from the origin to the destination
+    if geometry is not None and total["Transit Request Status"] == "OK":
+        total.update(get_route_values('transit', geometry.combine([leg[2] for leg in legs]), total["Transit Distance (m)"]))
+
+    return total
+
+def get_direction_data(UniqueID, start, end, api_key, departure_time = None, waypoints = None, parallel = False, known_values = None, chain_departures = False, modes = ALL_MODES):
     """ Gets direction information (see dictionary keys) for various transport methods between the supplied start and end postcodes, with optional waypoints.
 
     Arguements:
@@ -345,6 +1064,10 @@ def get_direction_data(UniqueID, start, end, api_key, depature_time = None, wayp
         api_key - String - The google_api key to be used for the request
         departure_time - Integer - The number of seconds since the epoch (midnight 01/01/1970) the default is the current time
         waypoints - Iterable - Containing the intermediate waypoint postcodes
+        parallel - Boolean - If True the requests for all four modes of transport, and for each transit leg between waypoints, are made concurrently
+        known_values - Dictionary - Values already found for some of the non-transit modes, passed on to get_dist_duration
+        chain_departures - Boolean - If True each transit leg between waypoints departs when the previous leg arrives
+        modes - Iterable - The modes of transport to request, no requests are made and no columns are added for any others
 
     Returns:
         A dictionary containing the origin and destination postcodes and the distance and duration for each mode of transport
@@ -366,34 +1089,130 @@ def get_direction_data(UniqueID, start, end, api_key, depature_time = None, wayp
     """
 
     #Get the indervidual dictionaries for the different transport modes
-    vals = get_dist_duration(UniqueID, start, end, api_key, waypoints)
-    trans = get_transit_details(start, end, api_key, depature_time, waypoints)
+    if 'transit' not in modes:
+        return get_dist_duration(UniqueID, start, end, api_key, waypoints, parallel, known_values, modes)
 
-    #Combine them into one dictionary
-    data = vals.copy()
-    data.update(trans)
+    if parallel:
+        vals, trans = run_parallel([functools.partial(get_dist_duration, UniqueID, start, end, api_key, waypoints, True, known_values, modes),
+                                    functools.partial(get_transit_details, start, end, api_key, departure_time, waypoints, True, chain_departures)])
+    else:
+        vals = get_dist_duration(UniqueID, start, end, api_key, waypoints, known_values = known_values, modes = modes)
+        trans = get_transit_details(start, end, api_key, departure_time, waypoints, chain_departures = chain_departures)
+
+    #Combine them into one dictionary, the mode dictionary is only used here so can be added to rather than copied
+    vals.update(trans)
 
-    return data
+    return vals
 
 def read_postcode_csv(filename):
-    """ Reads a csv file and returns a list of dictionary objects with the column headers as keys.
+    """ Reads a csv file one row at a time, yielding a dictionary for each row with the column headers as keys. Only the current row is held in memory.
 
     Arguments:
         filename - String - The filename of the csv file that is to be opened
 
     Returns:
-        A list of dictionary objects, eack of which represents a row of the csv with the keys as the column names.
+        A generator of dictionary objects, eack of which represents a row of the csv with the keys as the column names.
     """
-    #Create the data list
-    data = list()
-
-    with open(filename) as csvfile:
+    with open(filename, 'rb') as csvfile:
         reader = csv.DictReader(csvfile)
 
         for row in reader:
-            data.append(row)
+            yield row
 
-    return data
+def read_csv_header(filename):
+    """ Gets the column names from the first row of a csv file, an empty list if the file is empty """
+    with open(filename, 'rb') as csvfile:
+        return next(csv.reader(csvfile), [])
+
+def count_csv_rows(filename):
+    """ Counts the data rows in a csv file by counting its line breaks, without parsing it. Assumes no cell contains a line break.
+
+    Arguments:
+        filename - String - The filename of the csv file
+
+    Returns:
+        Integer - The number of lines after the header row
+    """
+    lines = 0
+    last = "\n"
+
+    with open(filename, 'rb') as csvfile:
+        while True:
+            chunk = csvfile.read(1024 * 1024)
+            if not chunk:
+                break
+            lines = lines + chunk.count("\n")
+            last = chunk[-1]
+
+    #Count a final line that has no line break at the end of it
+    if last != "\n":
+        lines = lines + 1
+
+    return max(lines - 1, 0)
+
+def read_written_ids(filename, rows_per_id = 1):
+    """ Prepares a partly written output csv file for more rows to be appended and gets the UniqueIDs already in it. If the previous run was stopped part way through writing a row that incomplete row is removed, and if it was stopped part way through writing the rows of a UniqueID (eg the time slots of a long sweep) those rows are removed too so the UniqueID is processed again. Assumes no cell contains a line break.
+
+    Arguments:
+        filename - String - The filename of the output csv file
+        rows_per_id - Integer - The number of rows written for each UniqueID, one after another
+
+    Returns:
+        A tuple of the header row as a list (None if the file is missing or empty) and a set of the UniqueIDs already written
+    """
+    if not os.path.exists(filename) or os.path.getsize(filename) == 0:
+        return None, set()
+
+    #Cut the file back to the end of the last complete line
+    with open(filename, 'rb+') as csvfile:
+        csvfile.seek(0, os.SEEK_END)
+        size = csvfile.tell()
+        end = size
+        while end > 0:
+            step = min(end, 64 * 1024)
+            csvfile.seek(end - step)
+            chunk = csvfile.read(step)
+            newline = chunk.rfind("\n")
+            if newline != -1:
+                end = end - step + newline + 1
+                break
+            end = end - step
+        if end != size:
+            csvfile.truncate(end)
+
+    header = None
+    written = set()
+
+    #The UniqueID of the last rows read, where its first row starts and how many rows it has
+    last_id = None
+    last_offset = 0
+    last_rows = 0
+
+    with open(filename, 'rb+') as csvfile:
+        while True:
+            offset = csvfile.tell()
+            line = csvfile.readline()
+            if not line:
+                break
+            row = next(csv.reader([line]), None)
+            if header is None:
+                header = row
+                id_column = header.index("UniqueID")
+            elif row:
+                unique_id = row[id_column]
+                if unique_id != last_id:
+                    last_id = unique_id
+                    last_offset = offset
+                    last_rows = 0
+                last_rows = last_rows + 1
+                written.add(unique_id)
+
+        #Only the last UniqueID can have been stopped part way through its rows
+        if last_id is not None and last_rows < rows_per_id:
+            written.discard(last_id)
+            csvfile.truncate(last_offset)
+
+    return header, written
 
 def check_postcode(postcode):
     """ Checks if the supplied string matches the pattern for a UK post code. Note that this method does not actually check if a postcode actually exists. This method also expects a space in the middle of the postcode.
@@ -411,6 +1230,49 @@ def check_postcode(postcode):
     else:
         return False
 
+def normalize_postcode(postcode):
+    """ Puts a postcode into the standard form of upper case letters with a single space before the last three characters, eg "ne17ru " becomes "NE1 7RU". Strings too short to be a full postcode are returned upper cased and stripped.
+
+    Arguments:
+        postcode - String - The postcode to be normalised
+
+    Returns:
+        The normalised postcode string
+    """
+    compact = "".join(postcode.split()).upper()
+
+    if len(compact) < 5:
+        return compact
+
+    return compact[:-3] + " " + compact[-3:]
+
+def set_postcode_index(index):
+    """ Sets the postcode index used to check that postcodes actually exist before any requests are made for them.
+
+    Arguments:
+        index - PostcodeIndex - The index of known postcodes, None to only check the postcode pattern
+    """
+    global _postcode_index
+    _postcode_index = index
+
+def is_valid_postcode(postcode):
+    """ Checks that a normalised postcode matches the UK postcode pattern and, if a postcode index has been set, that it is a live postcode in the index.
+
+    Arguments:
+        postcode - String - A normalised postcode (see normalize_postcode)
+
+    Returns:
+        Boolean indicating if the postcode can be sent to the API
+    """
+    if not check_postcode(postcode):
+        return False
+
+    index = _postcode_index
+    if index is not None and not index.contains(postcode):
+        return False
+
+    return True
+
 def get_waypoint_list(input_data, NA_char = "99"):
     """ Gets a list of valid postcode waypoints from the supplied input dictionary, ignoring any cell that uses the NA character.
 
@@ -419,7 +1281,7 @@ def get_waypoint_list(input_data, NA_char = "99"):
         NA_char - String - The character used to signal missing data in the input csv file
 
     Returns:
-        A list of postcode strings taken from the input data
+        A list of normalised postcode strings taken from the input data
     """
 
     #Get the dictionary keys that contain the word Waypoint
@@ -435,7 +1297,7 @@ def get_waypoint_list(input_data, NA_char = "99"):
         for waypoint in waypoint_keys:
             wp = input_data.get(waypoint).strip()
             if wp != NA_char:
-                waypoints.append(wp)
+                waypoints.append(normalize_postcode(wp))
 
         #If there is 1 or more valid waypoint then return the list else return none
         if waypoints:
@@ -445,19 +1307,156 @@ def get_waypoint_list(input_data, NA_char = "99"):
     else:
         return None
 
-def get_directions(input_data, api_key, departure_time):
-    """ Checks all supplied postcodes and prevents a call to the api of any are invalid. Note that this method assumes a space in the middle of the postcode inorder to be valid.
+def parse_modes(text):
+    """ Parses a list of modes of transport, eg "transit; walking".
+
+    Arguments:
+        text - String - Mode names seperated by commas, semicolons, pipes or spaces
+
+    Returns:
+        A tuple of the modes in the order of ALL_MODES
+
+    Raises:
+        ValueError if any of the names is not a mode of transport
+    """
+    names = set(re.split(r"[\s,;|]+", text.strip().lower())) - set([""])
+
+    unknown = names - set(ALL_MODES)
+    if unknown:
+        raise ValueError("Unknown mode of transport: '{}'".format("', '".join(sorted(unknown))))
+
+    return tuple(mode for mode in ALL_MODES if mode in names)
+
+def get_row_modes(input_data, modes = ALL_MODES):
+    """ Gets the modes of transport to request for an input row: those listed in its Modes column that are also in modes, or all of modes if the row has no Modes column or it is empty or NA.
+
+    Arguments:
+        input_data - Dictionary - Data read from the input csv
+        modes - Iterable - The modes set for the whole run
+
+    Returns:
+        A tuple of modes
+
+    Raises:
+        ValueError if the Modes column names something that is not a mode of transport
+    """
+    text = (input_data.get(MODES_COLUMN) or "").strip()
+    if text == "" or text.upper() == "NA":
+        return tuple(modes)
+
+    row_modes = parse_modes(text)
+    return tuple(mode for mode in modes if mode in row_modes)
+
+def get_status_column(mode):
+    """ Gets the name of the request status column of a mode of transport """
+    if mode == 'transit':
+        return "Transit Request Status"
+    return MODE_COLUMNS[mode][2]
+
+def get_mode_columns(fieldnames, modes):
+    """ Removes the columns of any modes of transport that are not being requested from a list of column names.
+
+    Arguments:
+        fieldnames - List - Column names including those for every mode
+        modes - Iterable - The modes being requested
+
+    Returns:
+        A list of column names
+    """
+    excluded = set()
+    for mode in MODE_COLUMNS:
+        if mode not in modes:
+            excluded.update(MODE_COLUMNS[mode])
+            excluded.update(ROUTE_COLUMNS[mode])
+    if 'transit' not in modes:
+        excluded.update(TRANSIT_COLUMNS)
+
+    return [name for name in fieldnames if name not in excluded]
+
+def check_directions_input(input_data):
+    """ Normalises and checks all the postcodes in an input row. If a postcode index has been set (see set_postcode_index) postcodes that are not in it are also treated as invalid.
+
+    Arguments:
+        input_data - Dictionary - read from the input data csv file
+
+    Returns:
+        A tuple of the normalised origin, destination and list of waypoints (None if there are none), and the result dictionary for the row if any postcode is invalid (None if they are all valid)
+    """
+    #Get the normalised origin and destinations postcodes and the list of waypoints, if any
+    origin = normalize_postcode(input_data["OriginPostcode"])
+    destination = normalize_postcode(input_data["DestinationPostcode"])
+    waypoints = get_waypoint_list(input_data)
+
+    #Check the post codes and if any are invalid insert the reason into the postcode status field
+    check_origin = is_valid_postcode(origin)
+    check_destination = is_valid_postcode(destination)
+
+    check_waypoints = True
+    if waypoints:
+        for waypoint in waypoints:
+            if not is_valid_postcode(waypoint):
+                check_waypoints = False
+
+    if check_origin and check_destination and check_waypoints:
+        result = None
+    elif check_origin and check_waypoints and not check_destination:
+        result = {"UniqueID":input_data["UniqueID"], "Origin Postcode":origin, "Destination Postcode":destination, "Postcode Status":"Invalid Destination Postcode: '{}'".format(destination)}
+        log("Error: Invalid Destination Postcode: '{}'".format(destination))
+    elif not check_origin and check_destination and check_waypoints:
+        result = {"UniqueID":input_data["UniqueID"], "Origin Postcode":origin, "Destination Postcode":destination, "Postcode Status":"Invalid Origin Postcode: '{}'".format(origin)}
+        log("Error: Invalid Origin Postcode: '{}'".format(origin))
+    elif check_origin and check_destination and not check_waypoints:
+        result = {"UniqueID":input_data["UniqueID"], "Origin Postcode":origin, "Destination Postcode":destination, "Postcode Status":"One or more waypoints invalid"}
+        log("Error: One or more invalid waypoint postcodes")
+    else:
+        result = {"UniqueID":input_data["UniqueID"], "Origin Postcode":origin, "Destination Postcode":destination, "Postcode Status":"Destination and Origin Invalid"}
+        log("Error: All postcodes are invalid")
+
+    return origin, destination, waypoints, result
+
+def check_row_modes(input_data, modes, invalid):
+    """ Gets the modes to request for an input row, creating the result for an invalid row if its Modes column cannot be read.
+
+    Arguments:
+        input_data - Dictionary - read from the input data csv file
+        modes - Iterable - The modes set for the whole run
+        invalid - Dictionary - The result for the row if check_directions_input found it invalid, otherwise None
+
+    Returns:
+        A tuple of the row's modes and the invalid result (None if the row is valid)
+    """
+    try:
+        return get_row_modes(input_data, modes), invalid
+    except ValueError as e:
+        log("Error: {}".format(e))
+        if invalid is None:
+            invalid = {"UniqueID":input_data["UniqueID"], "Origin Postcode":normalize_postcode(input_data["OriginPostcode"]), "Destination Postcode":normalize_postcode(input_data["DestinationPostcode"]), "Postcode Status":str(e)}
+        return (), invalid
+
+def add_row_columns(result, input_data, waypoints, row_modes):
+    """ Adds the Waypoints column, and the Modes column if the input has one, to a result dictionary """
+    result["Waypoints"] = get_waypoint_string(waypoints or [])
+    if MODES_COLUMN in input_data:
+        result[MODES_COLUMN] = "|".join(row_modes)
+
+def get_directions(input_data, api_key, departure_time, parallel = False, known_values = None, chain_departures = False, modes = ALL_MODES):
+    """ Normalises and checks all supplied postcodes and prevents a call to the api of any are invalid. If a postcode index has been set (see set_postcode_index) postcodes that are not in it are also treated as invalid.
 
     Arguments:
         input_data - Dictionary - read from the input data csv file
         api_key - String - The Google API to make the request with
         departure_time - Integer - The number of seconds since the epoch (midnight 01/01/1970) the default is the current time
+        parallel - Boolean - If True the requests for all four modes of transport, and for each transit leg between waypoints, are made concurrently
+        known_values - Dictionary - Values already found for some of the non-transit modes (see add_matrix_values), no requests are made for these modes
+        chain_departures - Boolean - If True each transit leg between waypoints departs when the previous leg arrives
+        modes - Iterable - The modes of transport to request, narrowed down for this row by its Modes column if it has one (see get_row_modes). Modes left out by the Modes column are given the status NOT_REQUESTED
 
     Returns:
         A dictionary containing the origin and destination postcodes and the distance and duration for each mode of transport
         Dictionary keys:
             "Origin Postcode",
             "Destination Postcode",
+            "Waypoints" (the waypoint postcodes seperated by pipes)
             "Driving Distance (m)",
             "Driving Duration (sec)",
             "Bicycling Distance (m)",
@@ -471,39 +1470,104 @@ def get_directions(input_data, api_key, departure_time):
             "Walking Distance from last stop (m)",
             "Total Walking Distance (m)"
     """
-    #Get the origin and destinations postcodes and the list of waypoints, if any
-    origin = input_data["OriginPostcode"].strip()
-    destination = input_data["DestinationPostcode"].strip()
-    waypoints = get_waypoint_list(input_data)
+    set_row_id(input_data["UniqueID"])
+    origin, destination, waypoints, result = check_directions_input(input_data)
+    row_modes, result = check_row_modes(input_data, modes, result)
 
-    #Check the post codes and if both are fine submit to the api if not insert "Not Valid" into the postcode status field
-    check_origin = check_postcode(origin)
-    check_destination = check_postcode(destination)
+    #Only submit to the api if all the postcodes are fine
+    if result is None:
+        result = get_direction_data(input_data["UniqueID"], origin, destination, api_key, departure_time, waypoints, parallel, known_values, chain_departures, row_modes)
+        result["Postcode Status"] = "OK"
 
-    check_waypoints = True
-    if waypoints:
-        for waypoint in waypoints:
-            if not check_postcode(waypoint):
-                check_waypoints = False
+        for mode in modes:
+            if mode not in row_modes:
+                result[get_status_column(mode)] = NOT_REQUESTED
 
-    if check_origin and check_destination and check_waypoints:
-        result = get_direction_data(input_data["UniqueID"], origin, destination, api_key, departure_time, waypoints)
-        result["Postcode Status"] = "OK"
-    elif check_origin and check_waypoints and not check_destination:
-        result = {"UniqueID":input_data["UniqueID"], "Origin Postcode":origin, "Destination Postcode":destination, "Postcode Status":"Invalid Destination Postcode: '{}'".format(destination)}
-        print "Error: Invalid Destination Postcode: '{}'".format(destination)
-    elif not check_origin and check_destination and check_waypoints:
-        result = {"UniqueID":input_data["UniqueID"], "Origin Postcode":origin, "Destination Postcode":destination, "Postcode Status":"Invalid Origin Postcode: '{}'".format(origin)}
-        print "Error: Invalid Origin Postcode: '{}'".format(origin)
-    elif check_origin and check_destination and not check_waypoints:
-        result = {"UniqueID":input_data["UniqueID"], "Origin Postcode":origin, "Destination Postcode":destination, "Postcode Status":"One or more waypoints invalid"}
-        print "Error: One or more invalid waypoint postcodes"
-    else:
-        result = {"UniqueID":input_data["UniqueID"], "Origin Postcode":origin, "Destination Postcode":destination, "Postcode Status":"Destination and Origin Invalid"}
-        print "Error: All postcodes are invalid"
+    add_row_columns(result, input_data, waypoints, row_modes)
 
     return result
 
+def get_sweep_directions(input_data, api_key, departure_times, parallel = False, known_values = None, chain_departures = False, modes = ALL_MODES):
+    """ Gets the directions for an input row at each of a number of departure times. The driving, bicycling and walking requests do not depend on the departure time so are only made once, and only the transit requests are made for every time slot.
+
+    Arguments:
+        input_data - Dictionary - read from the input data csv file
+        api_key - String - The Google API to make the request with
+        departure_times - List - (slot name, departure time) tuples from get_departure_times
+        parallel - Boolean - If True the requests for every mode and time slot are made concurrently
+        known_values - Dictionary - Values already found for some of the non-transit modes (see add_matrix_values), no requests are made for these modes
+        chain_departures - Boolean - If True each transit leg between waypoints departs when the previous leg arrives
+        modes - Iterable - The modes of transport to request, narrowed down for this row by its Modes column as for get_directions
+
+    Returns:
+        A list with a dictionary for each time slot, in the same order as departure_times. Each has the same keys as the dictionary returned by get_directions, plus the "Departure Slot" name.
+    """
+    set_row_id(input_data["UniqueID"])
+    origin, destination, waypoints, invalid = check_directions_input(input_data)
+    row_modes, invalid = check_row_modes(input_data, modes, invalid)
+
+    if invalid is not None:
+        rows = [dict(invalid) for slot in departure_times]
+    else:
+        uid = input_data["UniqueID"]
+        functions = [functools.partial(get_dist_duration, uid, origin, destination, api_key, waypoints, parallel, known_values, row_modes)]
+        if 'transit' in row_modes:
+            functions.extend(functools.partial(get_transit_details, origin, destination, api_key, departure_time, waypoints, parallel, chain_departures) for slot_name, departure_time in departure_times)
+
+        if parallel:
+            results = run_parallel(functions)
+        else:
+            results = [function() for function in functions]
+
+        rows = list()
+        for transit in results[1:] or [dict() for slot in departure_times]:
+            row = dict(results[0])
+            row.update(transit)
+            row["Postcode Status"] = "OK"
+            for mode in modes:
+                if mode not in row_modes:
+                    row[get_status_column(mode)] = NOT_REQUESTED
+            rows.append(row)
+
+    for row, (slot_name, departure_time) in zip(rows, departure_times):
+        row["Departure Slot"] = slot_name
+        add_row_columns(row, input_data, waypoints, row_modes)
+
+    return rows
+
+def get_sweep_columns(fieldnames, departure_times):
+    """ Gets the column names for wide departure time sweep output, where the transit columns are repeated for each time slot with the slot name in front, eg "07:15 Transit Duration (sec)".
+
+    Arguments:
+        fieldnames - List - The column names for a single departure time
+        departure_times - List - (slot name, departure time) tuples from get_departure_times
+
+    Returns:
+        A list of column names
+    """
+    columns = [name for name in fieldnames if name not in TRANSIT_COLUMNS]
+    for slot_name, departure_time in departure_times:
+        columns.extend("{} {}".format(slot_name, name) for name in fieldnames if name in TRANSIT_COLUMNS)
+    return columns
+
+def widen_sweep_rows(rows):
+    """ Combines the rows returned by get_sweep_directions into a single row with the transit columns for each time slot (see get_sweep_columns).
+
+    Arguments:
+        rows - List - Dictionaries returned by get_sweep_directions for one input row
+
+    Returns:
+        A dictionary
+    """
+    wide = dict((name, value) for name, value in rows[0].items() if name not in TRANSIT_COLUMNS and name != "Departure Slot")
+
+    for row in rows:
+        for name in TRANSIT_COLUMNS:
+            if name in row:
+                wide["{} {}".format(row["Departure Slot"], name)] = row[name]
+
+    return wide
+
 def reverse_geocode(latlong, api_key):
     """ Accepts a (latitude, longitude) tuple and reverse geocodes it into postal codes. This may include partial postcodes (eg NE6) as well as full postal codes.
 
@@ -515,21 +1579,34 @@ def reverse_geocode(latlong, api_key):
         A list of Post Code Strings that relate to the supplied latitude and longitude
     """
 
-    postcodes = list()
-
     latitude = latlong[0]
     longitude = latlong[1]
 
     #Make the request to the Google GeoCoding API
-    r = requests.get("https://maps.googleapis.com/maps/api/geocode/json?latlng={},{}&result_type=postal_code&key={}".format(latitude,longitude,api_key))
+    result, retries, error = api_request(GEOCODE_URL, {"latlng": "{},{}".format(latitude, longitude), "result_type": "postal_code"}, api_key)
+
+    return get_geocode_postcodes(result, error)
+
+def get_geocode_postcodes(result, error, log = log):
+    """ Gets the postcodes from a Geocoding API response.
+
+    Arguments:
+        result - Dictionary - The decoded response, None if the request failed
+        error - String - Why the request failed, None if it did not
+        log - Function - Called with the error if the request failed, by default printing it unless turned off with set_verbose
+
+    Returns:
+        The list of postcodes returned by reverse_geocode
+    """
+    postcodes = list()
 
     #If the request is not successful print an error and do no further processing for this record
-    if r.status_code != 200:
-        print "Request network error"
+    if result is None:
+        log(error)
         postcodes.append("Request Error")
     else:
-        #For every request there is an associated status - turn the returned JSON string into a dictionary and pull out the list of results
-        results = r.json().get("results")
+        #For every request there is an associated status - pull out the list of results from the decoded JSON
+        results = result.get("results")
 
         #Cycle through the list of result json objects
         for result in results:
@@ -545,3 +1622,27 @@ def reverse_geocode(latlong, api_key):
                         postcodes.append(component.get("short_name"))
 
     return postcodes
+
+def get_setting(config, section, option, default):
+    """ Gets an optional value from the settings file, converting it to the same type as the supplied default.
+
+    Arguments:
+        config - ConfigParser - The parsed settings file
+        section - String - The section of the settings file, eg 'Run'
+        option - String - The name of the setting within the section
+        default - The value to use if the setting is not present, its type (Integer, Float, Boolean or String) sets how the value is read
+
+    Returns:
+        The value from the settings file, or the default if it is not present
+    """
+    if not config.has_option(section, option):
+        return default
+
+    if isinstance(default, bool):
+        return config.getboolean(section, option)
+    elif isinstance(default, int):
+        return config.getint(section, option)
+    elif isinstance(default, float):
+        return config.getfloat(section, option)
+    else:
+        return config.get(section, option)
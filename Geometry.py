@@ -0,0 +1,310 @@
+import json
+
+import numpy as np
+
+#Mean radius of the Earth in metres, used for the great circle distance between points
+EARTH_RADIUS = 6371008.8
+
+#Encoded polylines hold coordinates in units of 1e-5 degrees
+POLYLINE_PRECISION = 1e5
+
+#Most polygon edges tested against route points at once, keeping the arrays used by the test small
+MAX_EDGE_TESTS = 1000000
+
+def haversine(latitudes1, longitudes1, latitudes2, longitudes2):
+    """ Gets the great circle distance between pairs of points, all at once.
+
+    Arguments:
+        latitudes1 - NumPy array - Latitudes of the first point of each pair in degrees
+        longitudes1 - NumPy array - Longitudes of the first point of each pair in degrees
+        latitudes2 - NumPy array - Latitudes of the second point of each pair in degrees
+        longitudes2 - NumPy array - Longitudes of the second point of each pair in degrees
+
+    Returns:
+        A NumPy array of distances in metres
+    """
+    latitudes1, longitudes1, latitudes2, longitudes2 = [np.radians(np.asarray(values, dtype=np.float64)) for values in (latitudes1, longitudes1, latitudes2, longitudes2)]
+
+    a = np.sin((latitudes2 - latitudes1) / 2.0) ** 2 + np.cos(latitudes1) * np.cos(latitudes2) * np.sin((longitudes2 - longitudes1) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def _cumsum_groups(values, starts, counts):
+    """ Gets the running total of values, starting again from zero at the start of each group """
+    totals = np.cumsum(values)
+    offsets = np.zeros(len(counts), dtype=totals.dtype)
+    nonempty = counts > 0
+    offsets[nonempty] = totals[starts[nonempty]] - values[starts[nonempty]]
+    return totals - np.repeat(offsets, counts)
+
+def decode_polylines(encoded):
+    """ Decodes many Google encoded polylines at once. Rather than looping over the characters of each polyline, every polyline is joined into one array and each step of decoding (splitting the 5 bit chunks into values, undoing the sign encoding and adding up the offsets between points) is done for all of them together.
+
+    Arguments:
+        encoded - Iterable - Encoded polyline strings, eg the "points" of a Directions API polyline
+
+    Returns:
+        A tuple of NumPy arrays of the latitudes and longitudes of every point in degrees, one polyline after another, and of the number of points in each polyline
+
+    Raises:
+        ValueError if a polyline is not validly encoded
+    """
+    encoded = list(encoded)
+    lengths = np.array([len(polyline) for polyline in encoded], dtype=np.int64)
+
+    data = np.frombuffer("".join(encoded).encode("ascii"), dtype=np.uint8).astype(np.int64) - 63
+    if len(data) == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(len(encoded), dtype=np.int64)
+    if (data < 0).any() or (data >= 64).any():
+        raise ValueError("Polyline contains a character that is not part of the encoding")
+
+    #Each value is a run of 5 bit chunks, least significant first, where every chunk but the last has the 0x20 bit set
+    is_last = data < 0x20
+    string_ends = np.cumsum(lengths)
+    if not is_last[string_ends[lengths > 0] - 1].all():
+        raise ValueError("Polyline ends part way through a value")
+
+    value_starts = np.flatnonzero(np.concatenate(([True], is_last[:-1])))
+    positions = np.arange(len(data)) - np.repeat(value_starts, np.diff(np.append(value_starts, len(data))))
+    values = np.add.reduceat((data & 0x1f) << (5 * positions), value_starts)
+    values = np.where(values & 1, ~(values >> 1), values >> 1)
+
+    #Each polyline is pairs of values, the offset in latitude then longitude from the previous point (or from zero for its first point)
+    finished = np.concatenate(([0], np.cumsum(is_last)))
+    value_counts = finished[string_ends] - finished[string_ends - lengths]
+    if (value_counts % 2).any():
+        raise ValueError("Polyline has a latitude without a longitude")
+
+    counts = value_counts // 2
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+    latitudes = _cumsum_groups(values[0::2], starts, counts) / POLYLINE_PRECISION
+    longitudes = _cumsum_groups(values[1::2], starts, counts) / POLYLINE_PRECISION
+
+    return latitudes, longitudes, counts
+
+def read_areas(filename):
+    """ Reads the areas that the distance a route travels inside is measured for from a GeoJSON file.
+
+    Arguments:
+        filename - String - A GeoJSON file containing Polygon or MultiPolygon geometries, on their own or as features of a FeatureCollection
+
+    Returns:
+        A list with a list of rings for each area, each ring a tuple of NumPy arrays of the latitudes and longitudes of its corners
+    """
+    with open(filename) as f:
+        data = json.load(f)
+
+    if data.get("type") == "FeatureCollection":
+        geometries = [feature.get("geometry") for feature in data.get("features", ())]
+    elif data.get("type") == "Feature":
+        geometries = [data.get("geometry")]
+    else:
+        geometries = [data]
+
+    areas = list()
+    for geometry in geometries:
+        if not geometry:
+            continue
+        if geometry.get("type") == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry.get("type") == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            raise ValueError("{} contains a {} rather than a Polygon or MultiPolygon".format(filename, geometry.get("type")))
+
+        #GeoJSON positions are longitude then latitude
+        rings = list()
+        for polygon in polygons:
+            for ring in polygon:
+                corners = np.array(ring, dtype=np.float64)
+                rings.append((corners[:, 1], corners[:, 0]))
+        areas.append(rings)
+
+    return areas
+
+def ring_crossings(ring, latitudes, longitudes):
+    """ Checks which points are inside a ring by counting how many of its edges a line running east from each point crosses, an odd number meaning the point is inside.
+
+    Arguments:
+        ring - Tuple - NumPy arrays of the latitudes and longitudes of the ring's corners
+        latitudes - NumPy array - The latitudes of the points
+        longitudes - NumPy array - The longitudes of the points
+
+    Returns:
+        A NumPy boolean array that is True for each point inside the ring
+    """
+    y1, x1 = ring
+    y2 = np.roll(y1, -1)
+    x2 = np.roll(x1, -1)
+
+    inside = np.zeros(len(latitudes), dtype=bool)
+    chunk = max(1, MAX_EDGE_TESTS // max(len(y1), 1))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for start in range(0, len(latitudes), chunk):
+            py = latitudes[start:start + chunk, np.newaxis]
+            px = longitudes[start:start + chunk, np.newaxis]
+            crosses = ((y1 > py) != (y2 > py)) & (px < (x2 - x1) * (py - y1) / (y2 - y1) + x1)
+            inside[start:start + chunk] = crosses.sum(axis=1) % 2 == 1
+
+    return inside
+
+class RouteShape(object):
+    """ The shape of a route worked out from its polylines.
+
+    Attributes:
+        start - Tuple - The latitude and longitude the route starts at, None if the route has no points
+        end - Tuple - The latitude and longitude the route ends at, None if the route has no points
+        length - Float - The length of the route along its polylines in metres
+        inside - Float - The length of the route inside any of the areas in metres, None if no areas are set
+        bounds - Tuple - The south, west, north and east edges of the box containing the route, None if the route has no points
+    """
+    __slots__ = ("start", "end", "length", "inside", "bounds")
+
+    def __init__(self, start, end, length, inside, bounds):
+        self.start = start
+        self.end = end
+        self.length = length
+        self.inside = inside
+        self.bounds = bounds
+
+    def straight_line(self):
+        """ Gets the distance in a straight line from the start of the route to its end in metres, None if the route has no points """
+        if self.start is None:
+            return None
+        return float(haversine(self.start[0], self.start[1], self.end[0], self.end[1]))
+
+def combine_shapes(shapes):
+    """ Joins the shapes of routes that follow on from each other, eg the legs of a transit journey between waypoints, into the shape of the whole journey.
+
+    Arguments:
+        shapes - Iterable - RouteShape objects in the order they are travelled, None for a route with no shape (eg a failed request)
+
+    Returns:
+        A RouteShape
+    """
+    shapes = [shape for shape in shapes if shape is not None and shape.start is not None]
+    if not shapes:
+        return RouteShape(None, None, 0.0, None, None)
+
+    inside = None
+    if shapes[0].inside is not None:
+        inside = sum(shape.inside for shape in shapes)
+
+    bounds = (min(shape.bounds[0] for shape in shapes), min(shape.bounds[1] for shape in shapes), max(shape.bounds[2] for shape in shapes), max(shape.bounds[3] for shape in shapes))
+
+    return RouteShape(shapes[0].start, shapes[-1].end, sum(shape.length for shape in shapes), inside, bounds)
+
+class RouteGeometry(object):
+    """ Works out the shape of routes from their encoded polylines: where they start and end, their length, how far they travel inside a set of areas and the box containing them.
+
+    Every polyline of every route passed to measure is decoded and measured together using NumPy (see decode_polylines), so a batch of routes, eg every response for a file replayed from the archive, costs little more than one. A part of a route between two points counts as inside an area if the point half way along it is, which is close enough with the detailed step polylines.
+    """
+
+    def __init__(self, areas = None):
+        """ Creates the geometry stage.
+
+        Arguments:
+            areas - List - The areas to measure the distance inside, from read_areas, None to not measure it
+        """
+        self.areas = areas
+
+        #The box around each ring, so points nowhere near it are not tested against every edge
+        self._ring_bounds = None
+        if areas is not None:
+            self._ring_bounds = [[(ring[0].min(), ring[1].min(), ring[0].max(), ring[1].max()) for ring in rings] for rings in areas]
+
+    def contains(self, latitudes, longitudes):
+        """ Checks which points are inside any of the areas. Holes in an area, and parts of an area inside other parts, are handled by counting every edge of the area together.
+
+        Arguments:
+            latitudes - NumPy array - The latitudes of the points
+            longitudes - NumPy array - The longitudes of the points
+
+        Returns:
+            A NumPy boolean array that is True for each point inside an area
+        """
+        inside = np.zeros(len(latitudes), dtype=bool)
+
+        for rings, ring_bounds in zip(self.areas or (), self._ring_bounds or ()):
+            area_inside = np.zeros(len(latitudes), dtype=bool)
+            for ring, (south, west, north, east) in zip(rings, ring_bounds):
+                near = np.flatnonzero((latitudes >= south) & (latitudes <= north) & (longitudes >= west) & (longitudes <= east))
+                if len(near):
+                    area_inside[near] ^= ring_crossings(ring, latitudes[near], longitudes[near])
+            inside |= area_inside
+
+        return inside
+
+    def combine(self, shapes):
+        """ Joins the shapes of routes that follow on from each other (see combine_shapes) """
+        return combine_shapes(shapes)
+
+    def measure(self, routes):
+        """ Works out the shape of a batch of routes.
+
+        Arguments:
+            routes - Iterable - A list of encoded polyline strings for each route, eg DirectionsResult.polylines, in the order they are travelled
+
+        Returns:
+            A list with a RouteShape for each route
+        """
+        routes = list(routes)
+        route_count = len(routes)
+
+        polylines = list()
+        polyline_routes = list()
+        for i, route in enumerate(routes):
+            polylines.extend(route)
+            polyline_routes.extend([i] * len(route))
+
+        latitudes, longitudes, counts = decode_polylines(polylines)
+
+        #The route each point belongs to, the last point of one step polyline is the first of the next so joining them does not add any distance
+        point_routes = np.repeat(np.array(polyline_routes, dtype=np.int64), counts)
+        point_counts = np.bincount(point_routes, minlength=route_count)
+
+        joined = point_routes[1:] == point_routes[:-1]
+        lengths = haversine(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:]) * joined
+        route_lengths = np.bincount(point_routes[:-1], lengths, minlength=route_count)
+
+        route_inside = None
+        if self.areas is not None:
+            inside = self.contains((latitudes[:-1] + latitudes[1:]) / 2.0, (longitudes[:-1] + longitudes[1:]) / 2.0)
+            route_inside = np.bincount(point_routes[:-1], lengths * inside, minlength=route_count)
+
+        #The first and last point and the bounds of each route that has any points
+        nonempty = np.flatnonzero(point_counts)
+        firsts = np.concatenate(([0], np.cumsum(point_counts)[:-1]))[nonempty]
+        lasts = firsts + point_counts[nonempty] - 1
+        bounds = [np.minimum.reduceat(latitudes, firsts), np.minimum.reduceat(longitudes, firsts), np.maximum.reduceat(latitudes, firsts), np.maximum.reduceat(longitudes, firsts)] if len(nonempty) else None
+
+        shapes = [RouteShape(None, None, 0.0, None if route_inside is None else 0.0, None) for i in range(route_count)]
+        for j, i in enumerate(nonempty):
+            shape = shapes[i]
+            shape.start = (float(latitudes[firsts[j]]), float(longitudes[firsts[j]]))
+            shape.end = (float(latitudes[lasts[j]]), float(longitudes[lasts[j]]))
+            shape.length = float(route_lengths[i])
+            if route_inside is not None:
+                shape.inside = float(route_inside[i])
+            shape.bounds = tuple(float(edge[j]) for edge in bounds)
+
+        return shapes
+
+def geometry_from_settings(config):
+    """ Creates the route geometry stage described by the optional [Geometry] section of the settings file.
+
+    Arguments:
+        config - ConfigParser - The parsed settings file
+
+    Returns:
+        A RouteGeometry measuring inside the areas in the GeoJSON file named by the areas setting (if there is one), or None if there is no [Geometry] section
+    """
+    if not config.has_section('Geometry'):
+        return None
+
+    areas = None
+    if config.has_option('Geometry', 'areas'):
+        areas = read_areas(config.get('Geometry', 'areas'))
+
+    return RouteGeometry(areas)
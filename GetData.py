@@ -1,42 +1,358 @@
 import ConfigParser
+import os
+import functools
+import sys
 
 from Directions import *
+from Batch import ordered_map
+from ResponseCache import cache_from_settings
+from Archive import archive_from_settings
+from Planning import JourneyPlan, PreviousOutput, RequestPlan
+from Transport import transport_from_settings
+from RateLimit import limiter_from_settings
+from KeyPool import keypool_from_settings
+from Output import open_output
+from Metrics import Metrics, reporter_from_settings
+from Shards import get_shard, get_part_filename, write_checkpoint, get_limit_shares
 
 #Get the settings from the config file
 config = ConfigParser.SafeConfigParser()
 config.read("Settings.cfg")
 
-#Get the API key from the settings file
-api_key = config.get('API', 'key')
+#When the input is split into shards (see Shards.py) only the rows in one shard are processed, chosen on the command line or by index in the [Shards] section
+shard_count = get_setting(config, 'Shards', 'count', 1)
+shard_index = None
+if shard_count > 1:
+    shard_index = int(sys.argv[1]) if len(sys.argv) > 1 else get_setting(config, 'Shards', 'index', -1)
+    if not 0 <= shard_index < shard_count:
+        sys.exit("Set index in the [Shards] section to the shard to process, from 0 to {}, or run every shard with Shards.py".format(shard_count - 1))
+
+def get_shard_filename(filename):
+    """ Gets this shard's own copy of an output, metrics or key usage file, or the file itself if the input is not sharded """
+    if filename is None or shard_index is None:
+        return filename
+    return get_part_filename(filename, shard_index, shard_count)
+
+#A shard gets an even share of the rate limits with the other shards running at the same time, and of the daily quota with the other shards still to finish
+rate_share, quota_share = 1, 1
+if shard_index is not None:
+    rate_share, quota_share = get_limit_shares(config, config.get('Files', 'output'), shard_count)
+
+#Get the API key from the settings file, or the pool of keys to share the requests between if several are set
+api_key = keypool_from_settings(config, rate_share, get_shard_filename(get_setting(config, 'API', 'usage_file', None)), quota_share)
+if api_key is None:
+    api_key = config.get('API', 'key')
+
+#Send requests somewhere other than the Google APIs if a base URL is set, eg a local MockServer.py for testing
+base_url = get_setting(config, 'API', 'base_url', DEFAULT_BASE_URL)
+set_base_url(base_url)
 
 #Get the input and output files from the settings file
 input_filename = config.get('Files', 'input')
-output_filename = config.get('Files', 'output')
+output_filename = get_shard_filename(config.get('Files', 'output'))
+
+#If resuming, rows already in the output file are kept and only the missing rows are requested and appended. A shard always resumes its part file, which is its checkpoint
+resume = get_setting(config, 'Files', 'resume', False) or shard_index is not None
+
+#Copy the rows of an earlier output csv that are OK and whose journey has not changed, and only request the rest
+previous_filename = get_setting(config, 'Files', 'previous', None)
+
+#Number of rows written between each flush of the output file to disk
+fsync_interval = get_setting(config, 'Files', 'fsync_interval', 100)
+
+#Format of the output file (csv, parquet or arrow) and the number of rows in each batch written to a columnar file
+output_format = get_setting(config, 'Files', 'format', 'csv')
+row_group_size = get_setting(config, 'Files', 'row_group_size', 10000)
+if shard_index is not None and output_format != 'csv':
+    sys.exit("Cannot run shards: the part files can only be written and merged as csv")
+if resume and output_format != 'csv':
+    sys.exit("Cannot resume: resuming is only supported for csv output")
 
 #Set the depature time for transit directions using the time and weekday from teh settings file
 departure_time = get_departure_time(config.get('Time', 'time'), config.getint('Time', 'day'))
 
-#Get a list of dictionaries containing the start and destination postcodes from the input file
-inputs = read_postcode_csv(input_filename)
+#If a sweep is set, transit directions are found for every step minutes from sweep_start to sweep_end instead, written as one row per time slot (long) or one row per journey (wide)
+departure_times = None
+if config.has_option('Time', 'sweep_start'):
+    departure_times = get_departure_times(config.get('Time', 'sweep_start'), config.get('Time', 'sweep_end'), get_setting(config, 'Time', 'sweep_step', 15), config.getint('Time', 'day'))
+    sweep_format = get_setting(config, 'Time', 'sweep_format', 'long')
+
+#The modes of transport to request, only these have columns in the output. A Modes column in the input can narrow them down further for each row
+try:
+    modes = parse_modes(get_setting(config, 'Run', 'modes', ",".join(ALL_MODES)))
+except ValueError as e:
+    sys.exit("Cannot read modes in the [Run] section: {}".format(e))
+if not modes:
+    sys.exit("Set at least one mode of transport in modes in the [Run] section")
+if departure_times is not None and 'transit' not in modes:
+    sys.exit("A departure time sweep needs transit in modes in the [Run] section")
+
+#Get the concurrency settings, by default rows are processed one at a time
+workers = get_setting(config, 'Run', 'workers', 1)
+max_in_flight = get_setting(config, 'Run', 'max_in_flight', 0)
+buffer_size = get_setting(config, 'Run', 'buffer_size', 100)
+
+#Make the requests for each row (the four modes and each transit leg between waypoints) at the same time, by default only when processing several rows at once
+parallel = get_setting(config, 'Run', 'parallel_requests', workers > 1)
+
+#Time each transit leg between waypoints to depart when the previous leg arrives
+chain_departures = get_setting(config, 'Run', 'chain_departures', False)
+
+#Rows asking for the same journey are only requested once unless this is turned off
+deduplicate = get_setting(config, 'Run', 'deduplicate', True)
+
+#Rows without waypoints can have their driving, bicycling and walking values found in batches using the Distance Matrix API
+matrix = get_setting(config, 'Run', 'matrix', False)
+matrix_chunk = get_setting(config, 'Run', 'matrix_chunk', 1000)
+#The Distance Matrix API charges for every element of a block, so blocks where fewer than this fraction of the elements are journeys asked for are sent a journey at a time
+matrix_min_density = get_setting(config, 'Run', 'matrix_min_density', 0.5)
+
+#Only work out the requests the run would make and how long they would take, without making any of them
+plan_only = get_setting(config, 'Run', 'plan_only', False)
+
+#Print the status of every request and row unless this is turned off, a progress line is printed instead when it is off. A plan summarises the invalid rows instead
+verbose = get_setting(config, 'Metrics', 'verbose', True) and not plan_only
+set_verbose(verbose)
+
+#Record every request in the metrics
+metrics = Metrics()
+set_metrics(metrics)
+
+#Limit the number of requests that can be made at the same time across all the worker threads
+set_max_in_flight(max_in_flight)
+
+#Share one adaptive rate limit between every request, with the rate and daily limit from the settings file split between the shards
+rate_limiter = limiter_from_settings(config, rate_share, quota_share)
+set_rate_limiter(rate_limiter)
+
+#Make requests over a pooled connection with the timeouts and retries from the settings file
+set_transport(transport_from_settings(config))
+
+#Use the persistent response cache if one is set up in the settings file
+cache = cache_from_settings(config)
+set_cache(cache)
+
+#Append every response to the archive if one is set up in the settings file (one for each shard). When replaying no requests are made, every response is taken from the archive so new columns can be worked out from earlier responses
+archive = archive_from_settings(config, get_shard_filename(get_setting(config, 'Archive', 'path', None)))
+replay = get_setting(config, 'Archive', 'replay', False)
+if replay and archive is None:
+    sys.exit("Cannot replay: there is no [Archive] section in the settings file")
+if replay and plan_only:
+    sys.exit("Nothing to plan: when replaying every response is taken from the archive and no requests are made")
+set_archive(archive, replay)
+
+#Check postcodes exist using the local postcode index, if one is set up in the settings file
+postcode_index = None
+if config.has_option('Postcodes', 'index'):
+    from PostcodeIndex import index_from_settings
+    postcode_index = index_from_settings(config)
+    set_postcode_index(postcode_index)
+
+    #Report every bad postcode in the file before any quota is spent
+    if get_setting(config, 'Postcodes', 'validate_input', True):
+        report = postcode_index.validate_file(input_filename)
+        print "Postcode check: {} of {} rows valid".format(report["Valid Rows"], report["Rows"])
+        for uid, postcode in report["Invalid"]:
+            print "Invalid postcode in row {}: '{}'".format(uid, postcode)
+
+#Skip the driving, bicycling or walking requests for journeys further in a straight line than the [Prefilter] distance for the mode, working the distances out from the postcode index
+distance_filter = None
+if config.has_section('Prefilter'):
+    from Prefilter import filter_from_settings
+    try:
+        distance_filter = filter_from_settings(config, postcode_index)
+    except ValueError as e:
+        sys.exit("Cannot use the [Prefilter] section: {}".format(e))
+    prefilter_chunk = get_setting(config, 'Prefilter', 'chunk_size', 10000)
+
+#Work out the shape of every route from its polylines, if a [Geometry] section is set up in the settings file
+geometry = None
+if config.has_section('Geometry'):
+    from Geometry import geometry_from_settings
+    geometry = geometry_from_settings(config)
+    set_geometry(geometry)
+
+#Set the header list
+fieldnames = ["UniqueID", "Origin Postcode", "Destination Postcode", "Waypoints", "Driving Distance (m)","Driving Duration (sec)", "Driving request status", "Driving request retries", "Bicycling Distance (m)", "Bicycling Duration (sec)", "Bicycling request status", "Bicycling request retries", "Walking Distance (m)", "Walking Duration (sec)", "Walking request status", "Walking request retries", "Transit Request Status", "Transit Request Retries", "Transit Distance (m)", "Transit Duration (sec)", "Number of Transit Nodes", "Walking Distance to 1st stop (m)", "Walking Distance from last stop (m)", "Total Walking Distance (m)","Postcode Status","Transit Lines","Transit Departure Time"]
+
+#Add the route shape columns for each mode after the rest
+if geometry is not None:
+    for mode in ALL_MODES:
+        fieldnames.extend(ROUTE_COLUMNS[mode])
+
+#Only write the columns of the modes being requested, and the modes of each row if the input sets them
+fieldnames = get_mode_columns(fieldnames, modes)
+if MODES_COLUMN in read_csv_header(input_filename):
+    fieldnames.insert(fieldnames.index("Waypoints") + 1, MODES_COLUMN)
+
+#In a sweep the output has the time slot of each row (long) or the transit columns for each time slot (wide)
+if departure_times is not None:
+    if sweep_format == 'wide':
+        fieldnames = get_sweep_columns(fieldnames, departure_times)
+    else:
+        fieldnames.insert(fieldnames.index(MODES_COLUMN if MODES_COLUMN in fieldnames else "Waypoints") + 1, "Departure Slot")
+
+#Find the rows of the earlier output that can be copied forward
+previous = None
+if previous_filename:
+    if os.path.abspath(previous_filename) == os.path.abspath(output_filename):
+        sys.exit("Cannot copy rows from {}: it is also the output file".format(previous_filename))
+    try:
+        previous = PreviousOutput(previous_filename, fieldnames, [slot_name for slot_name, slot_time in departure_times] if departure_times is not None else None, modes)
+    except ValueError as e:
+        sys.exit("Cannot copy rows from the previous output: {}".format(e))
+
+#Find the rows that have already been written by a previous run
+header = None
+written = set()
+if resume:
+    #A long sweep writes a row for each time slot, a UniqueID is only done once all of them are written
+    header, written = read_written_ids(output_filename, len(departure_times) if departure_times is not None and sweep_format == 'long' else 1)
+    if header is not None and header != fieldnames:
+        sys.exit("Cannot resume: the columns in {} do not match the current output columns".format(output_filename))
+    print "Resuming: {} rows already written to {}".format(len(written), output_filename)
+
+def read_shard():
+    """ Streams the input rows in this process's shard, every row if the input is not sharded """
+    for item in read_postcode_csv(input_filename):
+        if shard_index is None or get_shard(item["UniqueID"], shard_count) == shard_index:
+            yield item
+
+def read_inputs():
+    """ Streams the input rows that still need to be processed """
+    for item in read_shard():
+        if item["UniqueID"] not in written:
+            yield item
+
+def can_copy(item):
+    """ Checks if an input row can be copied from the earlier output rather than requested """
+    return previous is not None and previous.can_copy(item)
+
+def read_jobs():
+    """ Streams (input row, known values) pairs, marking the modes skipped by the straight line distance filter and getting the other non-transit values for whole chunks of rows from the Distance Matrix API if they are turned on """
+    jobs = ((item, None) for item in read_inputs())
+    if distance_filter is not None:
+        jobs = distance_filter.add_skipped_values(jobs, prefilter_chunk, modes)
+    if matrix:
+        jobs = add_matrix_values(jobs, api_key, matrix_chunk, parallel, can_copy, modes, matrix_min_density)
+    return jobs
+
+def plan_requests():
+    """ Counts the requests each input row still to be processed would need, reading them through the same stages as read_jobs but with the Distance Matrix requests counted rather than made """
+    request_plan = RequestPlan(modes, [slot_time for slot_name, slot_time in departure_times] if departure_times is not None else [departure_time], deduplicate, chain_departures, cache, base_url)
+
+    jobs = ((item, None) for item in read_inputs())
+    if distance_filter is not None:
+        jobs = distance_filter.add_skipped_values(jobs, prefilter_chunk, modes)
+    if matrix:
+        jobs = request_plan.add_matrix_values(jobs, matrix_chunk, can_copy, modes, matrix_min_density)
+
+    for item, known_values in jobs:
+        request_plan.add_row(item, known_values, can_copy(item))
+
+    return request_plan
+
+if plan_only:
+    request_plan = plan_requests()
+    for line in request_plan.summary([pool_key.limiter for pool_key in api_key.keys] if isinstance(api_key, KeyPool) else [rate_limiter] if rate_limiter is not None else []):
+        print line
+    if distance_filter is not None:
+        print distance_filter.summary()
+    if archive is not None:
+        archive.close()
+    if cache is not None:
+        cache.close()
+    sys.exit()
+
+#Get the total number of items for use in the console output, counting lines is much cheaper than parsing the file but a shard has to check which rows are its own
+if shard_index is None:
+    total = count_csv_rows(input_filename)
+else:
+    total = sum(1 for item in read_shard())
+    print "Shard {} of {}: {} input rows, writing to {}".format(shard_index, shard_count, total, output_filename)
+
+#Group the rows by journey so each unique journey is only requested once
+if deduplicate:
+    plan = JourneyPlan(item for item in read_inputs() if not can_copy(item))
+    print "{} rows contain {} unique journeys (dedup ratio {:.2f})".format(plan.rows, plan.journeys, plan.dedup_ratio())
+
+def get_sweep_rows(item, known_values):
+    """ Gets the output rows for every time slot of the sweep for a single input row, combined into one row for wide output """
+    rows = get_sweep_directions(item, api_key, departure_times, parallel, known_values, chain_departures, modes)
+    if sweep_format == 'wide':
+        return widen_sweep_rows(rows)
+    return rows
+
+def process_row(numbered_job):
+    """ Gets the directions dictionary (or a list of them for a long sweep) for a single numbered input row """
+    i, (item, known_values) = numbered_job
+    log("Processing id: {} ({} of {})".format(item["UniqueID"], i+1+len(written), total))
+
+    if previous is not None:
+        rows = previous.copy(item)
+        if rows is not None:
+            return rows
+
+    if departure_times is not None:
+        fetch_row = functools.partial(get_sweep_rows, known_values=known_values)
+    else:
+        fetch_row = functools.partial(get_directions, api_key=api_key, departure_time=departure_time, parallel=parallel, known_values=known_values, chain_departures=chain_departures, modes=modes)
+    if deduplicate:
+        return plan.fetch(item, fetch_row)
+    return fetch_row(item)
+
+#Report the metrics and progress periodically while the rows are processed
+metrics.set_total_rows(total - len(written))
+reporter = reporter_from_settings(config, metrics, verbose, get_shard_filename(get_setting(config, 'Metrics', 'path', None)))
+
+#Open the output file for as long as it is needed, appending to it when resuming. The header containing the column names is written unless it is already there
+output = open_output(output_filename, fieldnames, output_format, resume, header is None, row_group_size)
+
+try:
+    #Get a directions dictionary for each set of postcodes and save them to the output file
+    if workers > 1:
+        #Process several rows at once, the results come back in input order so can be written straight out
+        results = ordered_map(process_row, enumerate(read_jobs()), workers, buffer_size)
+    else:
+        results = (process_row(numbered_job) for numbered_job in enumerate(read_jobs()))
+
+    for i, result in enumerate(results):
+        #Write the dictionary, or each of the dictionaries for a long sweep, to the output file
+        if isinstance(result, list):
+            for row in result:
+                output.write(row)
+        else:
+            output.write(result)
+        metrics.record_rows()
 
-#Get the total number of items for use in the console output
-total = len(inputs)
+        #Make sure completed rows survive a crash
+        if fsync_interval and (i + 1) % fsync_interval == 0:
+            output.sync()
+            if shard_index is not None:
+                write_checkpoint(output_filename, len(written) + i + 1, False)
 
-#Open the output csv file for as long as it is needed
-with open(output_filename, 'wb') as csvfile:
+    #Record that the shard is finished so it can be merged
+    if shard_index is not None:
+        output.sync()
+        write_checkpoint(output_filename, total, True)
+finally:
+    output.close()
+    reporter.stop()
 
-    #Set the header list
-    fieldnames = ["UniqueID", "Origin Postcode", "Destination Postcode", "Driving Distance (m)","Driving Duration (sec)", "Driving request status", "Bicycling Distance (m)", "Bicycling Duration (sec)", "Bicycling request status", "Walking Distance (m)", "Walking Duration (sec)", "Walking request status", "Transit Request Status", "Transit Distance (m)", "Transit Duration (sec)", "Number of Transit Nodes", "Walking Distance to 1st stop (m)", "Walking Distance from last stop (m)", "Total Walking Distance (m)","Postcode Status","Transit Lines","Transit Departure Time"]
+    if previous is not None:
+        previous.close()
+        print previous.summary()
 
-    #Create the writer object
-    writer = csv.DictWriter(csvfile, fieldnames=fieldnames, restval='NA')
+    if distance_filter is not None:
+        print distance_filter.summary()
 
-    #Write the header containing the column names to the csv file
-    writer.writeheader()
+    if archive is not None:
+        archive.close()
 
-    #Get a directions dictionary for each set of postcodes and save them to the output csv
-    for i, item in enumerate(inputs):
-        print "Processing id: {} ({} of {})".format(item["UniqueID"], i+1, total)
+    #Save the times of the last cache hits, so the least recently used responses are evicted first
+    if cache is not None:
+        cache.close()
 
-        #Write the dictionary to the csv file
-        writer.writerow(get_directions(item, api_key, departure_time))
+    #Save how much of each key's daily quota has been used
+    if isinstance(api_key, KeyPool):
+        api_key.close()
@@ -1,15 +1,176 @@
-import csv, ConfigParser
+import csv, ConfigParser, itertools, time
 
-from Directions import reverse_geocode, check_postcode
+from Directions import reverse_geocode, check_postcode, set_cache, set_transport, set_rate_limiter, set_base_url, set_verbose, set_metrics, set_archive, set_row_id, log, count_csv_rows, get_setting, DEFAULT_BASE_URL
+from ResponseCache import cache_from_settings
+from Archive import archive_from_settings
+from Transport import transport_from_settings
+from RateLimit import limiter_from_settings
+from KeyPool import KeyPool, keypool_from_settings
+from Batch import ordered_map, SingleFlight
+from Metrics import Metrics, reporter_from_settings
 
 #Get the settings from the config file
 config = ConfigParser.SafeConfigParser()
 config.read("Settings.cfg")
 
-api_key = config.get('API', 'key')
+#Get the API key from the settings file, or the pool of keys to share the requests between if several are set
+api_key = keypool_from_settings(config)
+if api_key is None:
+    api_key = config.get('API', 'key')
+
+#Send requests somewhere other than the Google APIs if a base URL is set, eg a local MockServer.py for testing
+set_base_url(get_setting(config, 'API', 'base_url', DEFAULT_BASE_URL))
+
 inputfile = config.get('Files', 'latlong')
 outputfile = config.get('Files', 'postcodes')
 
+#Share one adaptive rate limit between every request, with the rate and daily limit from the settings file
+set_rate_limiter(limiter_from_settings(config))
+
+#Make requests over a pooled connection with the timeouts and retries from the settings file
+set_transport(transport_from_settings(config))
+
+#Use the persistent response cache if one is set up in the settings file
+cache = cache_from_settings(config)
+set_cache(cache)
+
+#Append every response to the archive if one is set up in the settings file, or take every response from it when replaying
+archive = archive_from_settings(config)
+set_archive(archive, get_setting(config, 'Archive', 'replay', False))
+
+#Print the status of every record unless this is turned off, a progress line is printed instead when it is off
+verbose = get_setting(config, 'Metrics', 'verbose', True)
+set_verbose(verbose)
+
+#Record every request in the metrics
+metrics = Metrics()
+set_metrics(metrics)
+
+#Get the reverse geocoding settings, by default every point is sent to the Google Geocoding API
+mode = get_setting(config, 'Geocoding', 'mode', 'api')
+nearest = get_setting(config, 'Geocoding', 'nearest', 1)
+max_distance = get_setting(config, 'Geocoding', 'max_distance', 500.0)
+api_fallback = get_setting(config, 'Geocoding', 'api_fallback', False)
+cell_size = get_setting(config, 'Geocoding', 'cell_size', 1000.0)
+chunk_size = get_setting(config, 'Geocoding', 'chunk_size', 100000)
+
+#Pipeline mode settings: the number of decimal places coordinates are rounded to before being looked up, and how many points are looked up at once
+snap_precision = get_setting(config, 'Geocoding', 'snap_precision', 4)
+workers = get_setting(config, 'Geocoding', 'workers', 8)
+buffer_size = get_setting(config, 'Geocoding', 'buffer_size', 1000)
+#Pipeline mode: the most looked up points remembered for later records, the least recently used are forgotten first so memory stays bounded
+memo_size = get_setting(config, 'Geocoding', 'memo_size', 100000)
+
+def api_postcodes(latlong):
+    """ Gets the full postcodes for a (latitude, longitude) tuple from the Geocoding API, printing why if there are none """
+    results = reverse_geocode(latlong, api_key)
+
+    if not results:
+        #If the results are empty post to the console
+        log("No postcodes found")
+        return []
+
+    #Cycle through the postcode results and reject any that are not full postcodes
+    valid = [result for result in results if check_postcode(result)]
+    if not valid:
+        log("Only partial postcodes found")
+
+    return valid
+
+def api_rows(reader):
+    """ Yields an output row for every input row with at least one full postcode, using one API request per row """
+    for row in reader:
+        latlong = (row["Latitude"],row["Longitude"])
+
+        log("Processing record: {}".format(row["Collision Reference "]))
+        set_row_id(row["Collision Reference "])
+        postcodes = api_postcodes(latlong)
+        metrics.record_rows()
+
+        #If at least one of the postcodes is valid save the results to the file, with the id and lat/long for reference
+        if postcodes:
+            yield [row["Collision Reference "], latlong[0], latlong[1]] + postcodes
+
+def snap_coordinates(latlong):
+    """ Rounds a (latitude, longitude) tuple of strings to snap_precision decimal places so that points a few metres apart share a lookup. Coordinates that are not numbers are left as they are. """
+    try:
+        return ("{:.{}f}".format(float(latlong[0]), snap_precision), "{:.{}f}".format(float(latlong[1]), snap_precision))
+    except ValueError:
+        return latlong
+
+def pipeline_rows(reader):
+    """ Yields an output row for every input row with at least one full postcode, looking up each snapped coordinate only once and making several requests at once. Rows are yielded in input order. """
+    lookups = SingleFlight(max_results = memo_size)
+
+    def lookup(row):
+        set_row_id(row["Collision Reference "])
+        latlong = snap_coordinates((row["Latitude"], row["Longitude"]))
+        postcodes = lookups.get(latlong, lambda: api_postcodes(latlong))
+        if postcodes:
+            return [row["Collision Reference "], row["Latitude"], row["Longitude"]] + postcodes
+        return None
+
+    start = time.time()
+    rows = 0
+
+    for output_row in ordered_map(lookup, reader, workers, buffer_size):
+        rows = rows + 1
+        metrics.record_rows()
+        if output_row:
+            yield output_row
+
+    #Report how much work was saved
+    elapsed = max(time.time() - start, 1e-6)
+    print "Processed {} records in {:.1f}s ({:.1f} records/sec)".format(rows, elapsed, rows / elapsed)
+    print "Snapped coordinates looked up: {} ({} records answered by an earlier lookup)".format(lookups.calls, lookups.shared)
+    if cache is not None:
+        print "Response cache: {} hits, {} misses".format(cache.hits, cache.misses)
+        print "API requests: {} ({:.1f} requests/sec)".format(cache.misses, cache.misses / elapsed)
+    else:
+        print "API requests: {} ({:.1f} requests/sec)".format(lookups.calls, lookups.calls / elapsed)
+
+def parse_coordinate(value):
+    """ Turns a latitude or longitude string into a float, NaN if it is not a number """
+    try:
+        return float(value)
+    except ValueError:
+        return float("nan")
+
+def offline_rows(reader):
+    """ Yields an output row for every input row with a postcode centroid within max_distance, answering whole chunks of rows at once from the local postcode index """
+    from PostcodeIndex import index_from_settings
+    from ReverseGeocoder import GridGeocoder
+
+    geocoder = GridGeocoder.from_index(index_from_settings(config), cell_size)
+
+    while True:
+        chunk = list(itertools.islice(reader, chunk_size))
+        if not chunk:
+            return
+
+        latitudes = [parse_coordinate(row["Latitude"]) for row in chunk]
+        longitudes = [parse_coordinate(row["Longitude"]) for row in chunk]
+        postcodes, distances = geocoder.query(latitudes, longitudes, nearest, max_distance)
+
+        log("Processed {} records".format(len(chunk)))
+        metrics.record_rows(len(chunk))
+
+        for i, row in enumerate(chunk):
+            found = [postcode for postcode in postcodes[i] if postcode]
+
+            #Points with no postcode nearby can be sent to the API instead
+            if not found and api_fallback:
+                log("Processing record: {} (no postcode within {}m)".format(row["Collision Reference "], max_distance))
+                set_row_id(row["Collision Reference "])
+                found = api_postcodes((row["Latitude"], row["Longitude"]))
+
+            if found:
+                yield [row["Collision Reference "], row["Latitude"], row["Longitude"]] + found
+
+#Report the metrics and progress periodically while the records are processed
+metrics.set_total_rows(count_csv_rows(inputfile))
+reporter = reporter_from_settings(config, metrics, verbose)
+
 with open(inputfile, 'rb') as csvfile:
     with open(outputfile, 'wb') as outfile:
 
@@ -19,28 +180,25 @@ with open(inputfile, 'rb') as csvfile:
         #Write the header row for the output file
         writer.writerow(["Reference", "Latitude", "Longitude", "Postcodes"])
 
-        for row in reader:
-            latlong = (row["Latitude"],row["Longitude"])
-
-            print "Processing record: {}".format(row["Collision Reference "])
-            results = reverse_geocode(latlong, api_key)
-
-            if results:
-                #Add the id and lat/long for reference
-                valid_pc = [row["Collision Reference "], latlong[0], latlong[1]]
-
-                #Cycle through the postcode results and reject any that are not full postcodes
-                valid_found = False
-                for result in results:
-                    if check_postcode(result):
-                        valid_pc.append(result)
-                        valid_found = True
-
-                #If at least one of the postcodes is valid save the results to the file
-                if valid_found:
-                    writer.writerow(valid_pc)
-                else:
-                    print "Only partial postcodes found"
-            else:
-                #If the results are empty post to the console
-                print "No postcodes found"
+        if mode == 'offline':
+            rows = offline_rows(reader)
+        elif mode == 'pipeline':
+            rows = pipeline_rows(reader)
+        else:
+            rows = api_rows(reader)
+
+        for row in rows:
+            writer.writerow(row)
+
+reporter.stop()
+
+if archive is not None:
+    archive.close()
+
+#Save the times of the last cache hits, so the least recently used responses are evicted first
+if cache is not None:
+    cache.close()
+
+#Save how much of each key's daily quota has been used
+if isinstance(api_key, KeyPool):
+    api_key.close()
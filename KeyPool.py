@@ -0,0 +1,193 @@
+import threading
+import json
+import os
+
+from RateLimit import RateLimiter, get_quota_day, split_limits
+
+#API statuses meaning a key cannot be used again: for the rest of the run, or until its daily quota is reset
+DENIED_STATUSES = ("REQUEST_DENIED",)
+EXHAUSTED_STATUSES = ("OVER_DAILY_LIMIT",)
+
+class ApiKey(object):
+    """ One Google API key in a KeyPool, with its own rate limit and daily quota.
+
+    Attributes:
+        name - String - The name the key is reported and saved under, so the key itself is never printed
+        key - String - The Google API key
+        limiter - RateLimit.RateLimiter - Limits the rate and daily number of requests made with this key
+        denied - Boolean - True once the API has refused the key, it is not used again in this run
+        exhausted_day - Date - The quota day on which the API reported the daily limit was used up, None if it has not
+    """
+    __slots__ = ("name", "key", "limiter", "denied", "exhausted_day")
+
+    def __init__(self, name, key, limiter):
+        self.name = name
+        self.key = key
+        self.limiter = limiter
+        self.denied = False
+        self.exhausted_day = None
+
+class NoKeysAvailable(Exception):
+    """ Raised when every key in the pool has been denied or has used up its daily quota """
+    pass
+
+class KeyPool(object):
+    """ A set of Google API keys that requests are shared between. It can be passed anywhere an API key string is accepted.
+
+    Each request goes to the key with the most headroom: first the keys that can make a request straight away under their rate limit, then the one with the most of its daily quota left. Keys the API refuses (REQUEST_DENIED) are dropped for the rest of the run and keys that run out of quota are rested until it is reset. The number of requests made with each key today is saved to a JSON file so that a restarted run does not go over the daily quota.
+    """
+
+    def __init__(self, keys, usage_file = None, save_interval = 100):
+        """ Creates the pool, loading today's usage of each key from the usage file if it exists.
+
+        Arguments:
+            keys - List - ApiKey objects
+            usage_file - String - JSON file the number of requests made with each key today is kept in, None to not keep a record
+            save_interval - Integer - The usage file is rewritten after this many requests
+        """
+        self.keys = list(keys)
+        self.usage_file = usage_file
+        self.save_interval = save_interval
+
+        self._unsaved = 0
+        self._lock = threading.Lock()
+
+        if usage_file and os.path.exists(usage_file):
+            with open(usage_file) as f:
+                usage = json.load(f)
+
+            today = str(get_quota_day())
+            for api_key in self.keys:
+                record = usage.get(api_key.name)
+                if record and record.get("day") == today:
+                    api_key.limiter.used_today = record.get("used", 0)
+                    if record.get("exhausted"):
+                        api_key.exhausted_day = api_key.limiter.day
+
+    def _is_available(self, api_key):
+        if api_key.denied or api_key.exhausted_day == get_quota_day():
+            return False
+        remaining = api_key.limiter.headroom()[1]
+        return remaining is None or remaining > 0
+
+    def choose(self):
+        """ Gets the key the next request should use.
+
+        Returns:
+            The ApiKey with the most headroom
+
+        Raises:
+            NoKeysAvailable if every key has been denied or has used up its quota
+        """
+        best = None
+        best_headroom = None
+
+        for api_key in self.keys:
+            if not self._is_available(api_key):
+                continue
+
+            tokens, remaining = api_key.limiter.headroom()
+            headroom = (tokens >= 1.0, float("inf") if remaining is None else remaining, tokens)
+
+            if best is None or headroom > best_headroom:
+                best = api_key
+                best_headroom = headroom
+
+        if best is None:
+            raise NoKeysAvailable("No API keys available: every key has been denied or has used its daily quota")
+
+        return best
+
+    def record(self, api_key, status):
+        """ Records the outcome of a request made with a key, taking the key out of rotation if the API will not accept it.
+
+        Arguments:
+            api_key - ApiKey - The key the request was made with
+            status - String - The API status of the response, None if no response was received
+
+        Returns:
+            True if the request failed because of the key and should be made again with another key
+        """
+        remaining = api_key.limiter.headroom()[1]
+        denied = status in DENIED_STATUSES
+        exhausted = status in EXHAUSTED_STATUSES or remaining == 0
+        removed = False
+
+        with self._lock:
+            if denied and not api_key.denied:
+                api_key.denied = True
+                removed = True
+                print "API key '{}' was denied and will not be used for the rest of this run".format(api_key.name)
+            elif exhausted and api_key.exhausted_day != get_quota_day():
+                api_key.exhausted_day = get_quota_day()
+                removed = True
+                print "API key '{}' has used its daily quota".format(api_key.name)
+
+            self._unsaved = self._unsaved + 1
+            save = removed or self._unsaved >= self.save_interval
+
+        if save:
+            self.save()
+
+        #Requests that were already in flight when a key was taken out of rotation fail in the same way, so these are made again too
+        return denied or status in EXHAUSTED_STATUSES or (status is None and remaining == 0)
+
+    def save(self):
+        """ Writes today's usage of each key to the usage file, replacing it in one step """
+        if not self.usage_file:
+            return
+
+        with self._lock:
+            self._unsaved = 0
+            usage = dict()
+            for api_key in self.keys:
+                usage[api_key.name] = {"day": str(api_key.limiter.day), "used": api_key.limiter.used_today, "exhausted": api_key.exhausted_day == api_key.limiter.day, "denied": api_key.denied}
+
+            temp_filename = self.usage_file + ".tmp"
+            with open(temp_filename, "w") as f:
+                json.dump(usage, f, indent=2, sort_keys=True)
+            os.rename(temp_filename, self.usage_file)
+
+    def close(self):
+        """ Saves the usage of each key, call this when the run is finished """
+        self.save()
+
+def keypool_from_settings(config, share = 1, usage_file = None, quota_share = None):
+    """ Creates the key pool described by the settings file. The pool is used when the [API] section has a 'keys' option listing key names, each of which has a [Key:<name>] section with its key and optionally its own qps and daily_limit (the [RateLimit] settings are used for anything not set).
+
+    Arguments:
+        config - ConfigParser - The parsed settings file
+        share - Integer - The number of processes running at the same time each key's rate is split between, eg when running shards with Shards.py
+        usage_file - String - File the usage of each key is kept in instead of the usage_file setting, eg a separate file for each shard
+        quota_share - Integer - The number of processes each key's daily limit is split between, share if None
+
+    Returns:
+        A KeyPool, or None if the settings file only has a single [API] key
+    """
+    if not config.has_option('API', 'keys'):
+        return None
+
+    keys = list()
+
+    for name in config.get('API', 'keys').split(","):
+        name = name.strip()
+        section = 'Key:' + name
+
+        options = dict()
+        for option in ("qps", "min_qps", "increase", "decrease", "burst"):
+            if config.has_option(section, option):
+                options[option] = config.getfloat(section, option)
+            elif config.has_option('RateLimit', option):
+                options[option] = config.getfloat('RateLimit', option)
+
+        if config.has_option(section, 'daily_limit'):
+            options["daily_limit"] = config.getint(section, 'daily_limit')
+        elif config.has_option('RateLimit', 'daily_limit'):
+            options["daily_limit"] = config.getint('RateLimit', 'daily_limit')
+
+        keys.append(ApiKey(name, config.get(section, 'key'), RateLimiter(**split_limits(options, share, quota_share))))
+
+    if usage_file is None and config.has_option('API', 'usage_file'):
+        usage_file = config.get('API', 'usage_file')
+
+    return KeyPool(keys, usage_file)
@@ -0,0 +1,284 @@
+import threading
+import json
+import time
+import os
+
+#Upper bounds in seconds of the request latency histogram buckets
+LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+#Prefix of every metric name in the Prometheus output
+PREFIX = "ncldirections_"
+
+class Metrics(object):
+    """ Thread-safe counters describing a run: API requests by api, mode and status, request latency, retries, cache hits, the time spent waiting for the rate limiter, backing off between retries, waiting for a request slot and waiting on the network, and the number of rows processed.
+
+    A snapshot can be exported as JSON or in the Prometheus text format, eg to be picked up by the node exporter textfile collector.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.total_rows = None
+        self.rows = 0
+
+        #Keyed by (api, mode, status)
+        self.requests = dict()
+
+        #Keyed by (api, mode)
+        self.retries = dict()
+        self.cache_hits = dict()
+        self.latency_buckets = dict()
+        self.latency_sum = dict()
+        self.latency_count = dict()
+
+        #Total seconds spent in each part of making a request
+        self.throttle_seconds = 0.0
+        self.backoff_seconds = 0.0
+        self.slot_wait_seconds = 0.0
+        self.network_seconds = 0.0
+
+        self._lock = threading.Lock()
+
+    def record_request(self, api, mode, status, latency, retries = 0, backoff = 0.0, slot_wait = 0.0, throttle = 0.0):
+        """ Records a request made over the network.
+
+        Arguments:
+            api - String - The API requested, eg 'directions'
+            mode - String - The mode of transport requested, None if the API does not have one
+            status - String - The API status of the response, or 'NETWORK_ERROR' if no response was received
+            latency - Float - Seconds from starting the first attempt to receiving the final response, including any retries and waits for the rate limiter
+            retries - Integer - The number of times the request was retried
+            backoff - Float - Seconds of the latency spent waiting between retries
+            slot_wait - Float - Seconds spent waiting for a free request slot before the request was sent
+            throttle - Float - Seconds of the latency spent waiting for the rate limiter
+        """
+        key = (api, mode or "")
+
+        with self._lock:
+            request_key = (api, mode or "", status)
+            self.requests[request_key] = self.requests.get(request_key, 0) + 1
+            self.retries[key] = self.retries.get(key, 0) + retries
+
+            buckets = self.latency_buckets.get(key)
+            if buckets is None:
+                buckets = [0] * len(LATENCY_BUCKETS)
+                self.latency_buckets[key] = buckets
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    buckets[i] = buckets[i] + 1
+            self.latency_sum[key] = self.latency_sum.get(key, 0.0) + latency
+            self.latency_count[key] = self.latency_count.get(key, 0) + 1
+
+            self.throttle_seconds = self.throttle_seconds + throttle
+            self.backoff_seconds = self.backoff_seconds + backoff
+            self.slot_wait_seconds = self.slot_wait_seconds + slot_wait
+            self.network_seconds = self.network_seconds + latency - backoff - throttle
+
+    def record_cache_hit(self, api, mode):
+        """ Records a request answered from the response cache rather than the network """
+        key = (api, mode or "")
+        with self._lock:
+            self.cache_hits[key] = self.cache_hits.get(key, 0) + 1
+
+    def record_rows(self, count = 1):
+        """ Records that count more input rows have been processed """
+        with self._lock:
+            self.rows = self.rows + count
+
+    def set_total_rows(self, total_rows):
+        """ Sets the number of input rows to be processed in this run, used to estimate the time remaining """
+        self.total_rows = total_rows
+
+    def snapshot(self):
+        """ Gets the current values of all the metrics.
+
+        Returns:
+            A dictionary that can be encoded as JSON
+        """
+        with self._lock:
+            elapsed = max(time.time() - self.started, 1e-6)
+            rate = self.rows / elapsed
+
+            eta = None
+            if self.total_rows is not None and rate > 0:
+                eta = max(self.total_rows - self.rows, 0) / rate
+
+            requests = [{"api": api, "mode": mode, "status": status, "count": count} for (api, mode, status), count in sorted(self.requests.items())]
+
+            modes = list()
+            for key in sorted(set(self.latency_count) | set(self.cache_hits)):
+                buckets = self.latency_buckets.get(key, [0] * len(LATENCY_BUCKETS))
+                modes.append({
+                    "api": key[0],
+                    "mode": key[1],
+                    "requests": self.latency_count.get(key, 0),
+                    "cache_hits": self.cache_hits.get(key, 0),
+                    "retries": self.retries.get(key, 0),
+                    "latency_sum_seconds": self.latency_sum.get(key, 0.0),
+                    "latency_buckets": [[bound, count] for bound, count in zip(LATENCY_BUCKETS, buckets)]
+                })
+
+            return {
+                "timestamp": time.time(),
+                "elapsed_seconds": elapsed,
+                "rows": self.rows,
+                "total_rows": self.total_rows,
+                "rows_per_second": rate,
+                "eta_seconds": eta,
+                "requests": requests,
+                "modes": modes,
+                "throttle_seconds": self.throttle_seconds,
+                "backoff_seconds": self.backoff_seconds,
+                "slot_wait_seconds": self.slot_wait_seconds,
+                "network_seconds": self.network_seconds
+            }
+
+    def to_json(self):
+        """ Gets a snapshot of the metrics as a JSON string """
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """ Gets a snapshot of the metrics in the Prometheus text exposition format """
+        snapshot = self.snapshot()
+        lines = list()
+
+        def metric(name, metric_type, description, samples):
+            lines.append("# HELP {}{} {}".format(PREFIX, name, description))
+            lines.append("# TYPE {}{} {}".format(PREFIX, name, metric_type))
+            for suffix, labels, value in samples:
+                label_text = ",".join('{}="{}"'.format(label, str(label_value).replace('"', '\\"')) for label, label_value in labels)
+                if label_text:
+                    label_text = "{" + label_text + "}"
+                if not isinstance(value, (int, long)):
+                    value = repr(float(value))
+                lines.append("{}{}{}{} {}".format(PREFIX, name, suffix, label_text, value))
+
+        metric("requests_total", "counter", "API requests made over the network by api, mode and response status", [("", (("api", r["api"]), ("mode", r["mode"]), ("status", r["status"])), r["count"]) for r in snapshot["requests"]])
+        metric("cache_hits_total", "counter", "API requests answered from the response cache", [("", (("api", m["api"]), ("mode", m["mode"])), m["cache_hits"]) for m in snapshot["modes"]])
+        metric("retries_total", "counter", "API request retries", [("", (("api", m["api"]), ("mode", m["mode"])), m["retries"]) for m in snapshot["modes"]])
+
+        samples = list()
+        for m in snapshot["modes"]:
+            labels = (("api", m["api"]), ("mode", m["mode"]))
+            for bound, count in m["latency_buckets"]:
+                samples.append(("_bucket", labels + (("le", bound),), count))
+            samples.append(("_bucket", labels + (("le", "+Inf"),), m["requests"]))
+            samples.append(("_sum", labels, m["latency_sum_seconds"]))
+            samples.append(("_count", labels, m["requests"]))
+        metric("request_latency_seconds", "histogram", "Time taken to get a response, including retries", samples)
+
+        metric("throttle_seconds_total", "counter", "Time spent waiting for the rate limiter", [("", (), snapshot["throttle_seconds"])])
+        metric("backoff_seconds_total", "counter", "Time spent waiting between retries", [("", (), snapshot["backoff_seconds"])])
+        metric("slot_wait_seconds_total", "counter", "Time spent waiting for a free request slot", [("", (), snapshot["slot_wait_seconds"])])
+        metric("network_seconds_total", "counter", "Time spent waiting on the network", [("", (), snapshot["network_seconds"])])
+        metric("rows_processed_total", "counter", "Input rows processed", [("", (), snapshot["rows"])])
+        metric("rows_per_second", "gauge", "Average input rows processed per second", [("", (), snapshot["rows_per_second"])])
+
+        if snapshot["total_rows"] is not None:
+            metric("rows", "gauge", "Input rows to be processed in this run", [("", (), snapshot["total_rows"])])
+        if snapshot["eta_seconds"] is not None:
+            metric("eta_seconds", "gauge", "Estimated seconds until every row has been processed", [("", (), snapshot["eta_seconds"])])
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename, file_format = "prometheus"):
+        """ Writes a snapshot of the metrics to a file, replacing it in one step so readers never see a partly written file.
+
+        Arguments:
+            filename - String - The file to write
+            file_format - String - Either 'prometheus' or 'json'
+        """
+        text = self.to_json() if file_format == "json" else self.to_prometheus()
+
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "w") as f:
+            f.write(text)
+        os.rename(temp_filename, filename)
+
+    def progress(self):
+        """ Gets a one line summary of the progress of the run for the console """
+        snapshot = self.snapshot()
+
+        total = sum(r["count"] for r in snapshot["requests"])
+        errors = sum(r["count"] for r in snapshot["requests"] if r["status"] != "OK")
+
+        if snapshot["total_rows"] is not None:
+            text = "Processed {} of {} rows".format(snapshot["rows"], snapshot["total_rows"])
+        else:
+            text = "Processed {} rows".format(snapshot["rows"])
+
+        text = text + " ({:.1f} rows/sec), {} requests ({} not OK)".format(snapshot["rows_per_second"], total, errors)
+
+        if snapshot["eta_seconds"] is not None:
+            text = text + ", about {:.0f}s remaining".format(snapshot["eta_seconds"])
+
+        return text
+
+class MetricsReporter(object):
+    """ Rewrites the metrics file and prints a progress line every interval seconds from a background thread """
+
+    def __init__(self, metrics, filename = None, file_format = "prometheus", interval = 10.0, progress = True):
+        """ Starts reporting.
+
+        Arguments:
+            metrics - Metrics - The metrics to report
+            filename - String - The file the metrics are written to, None to not write a file
+            file_format - String - Either 'prometheus' or 'json'
+            interval - Float - Seconds between each report
+            progress - Boolean - If True a progress line is printed with each report
+        """
+        self.metrics = metrics
+        self.filename = filename
+        self.file_format = file_format
+        self.interval = interval
+        self.progress = progress
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def report(self):
+        """ Writes the metrics file and prints the progress line now """
+        if self.filename:
+            self.metrics.write(self.filename, self.file_format)
+        if self.progress:
+            print self.metrics.progress()
+
+    def stop(self):
+        """ Stops the background thread and makes a final report """
+        self._stop.set()
+        self._thread.join()
+        self.report()
+
+def reporter_from_settings(config, metrics, verbose, filename = None):
+    """ Starts the metrics reporter described by the optional [Metrics] section of the settings file.
+
+    Arguments:
+        config - ConfigParser - The parsed settings file
+        metrics - Metrics - The metrics to report
+        verbose - Boolean - Whether the per-request console output is on, the progress line is printed by default only when it is off
+        filename - String - File the metrics are written to instead of the path setting, eg a separate file for each shard
+
+    Returns:
+        A running MetricsReporter
+    """
+    if filename is None and config.has_option('Metrics', 'path'):
+        filename = config.get('Metrics', 'path')
+
+    file_format = "prometheus"
+    if config.has_option('Metrics', 'format'):
+        file_format = config.get('Metrics', 'format')
+
+    interval = 10.0
+    if config.has_option('Metrics', 'interval'):
+        interval = config.getfloat('Metrics', 'interval')
+
+    progress = not verbose
+    if config.has_option('Metrics', 'progress'):
+        progress = config.getboolean('Metrics', 'progress')
+
+    return MetricsReporter(metrics, filename, file_format, interval, progress)
@@ -0,0 +1,236 @@
+import BaseHTTPServer
+import SocketServer
+import ConfigParser
+import urlparse
+import hashlib
+import random
+import time
+import json
+
+#Average speed in metres per second for each mode of transport, used to give the synthetic routes realistic durations
+MODE_SPEEDS = {"driving": 9.0, "bicycling": 4.5, "walking": 1.4, "transit": 6.0}
+
+def get_seed(*parts):
+    """ Creates a random seed from the request parameters so the same request always gets the same synthetic route """
+    return int(hashlib.md5("|".join(parts)).hexdigest()[:8], 16)
+
+def encode_polyline(points):
+    """ Encodes a list of (latitude, longitude) tuples using the Google encoded polyline algorithm.
+
+    Arguments:
+        points - List - (latitude, longitude) tuples
+
+    Returns:
+        String encoded polyline
+    """
+    encoded = list()
+    previous = (0, 0)
+
+    for point in points:
+        current = (int(round(point[0] * 1e5)), int(round(point[1] * 1e5)))
+
+        for value, last in zip(current, previous):
+            value = value - last
+            value = ~(value << 1) if value < 0 else value << 1
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1f)) + 63))
+                value = value >> 5
+            encoded.append(chr(value + 63))
+
+        previous = current
+
+    return "".join(encoded)
+
+def make_step(rng, mode, distance, location):
+    """ Creates a synthetic step of the supplied length starting at location, returning the step and where it ends """
+    end = (location[0] + rng.uniform(-0.01, 0.01), location[1] + rng.uniform(-0.01, 0.01))
+    points = [location] + [(location[0] + (end[0] - location[0]) * i / 5.0, location[1] + (end[1] - location[1]) * i / 5.0) for i in range(1, 6)]
+
+    duration = int(distance / MODE_SPEEDS[mode])
+
+    step = {
+        "travel_mode": mode.upper(),
+        "distance": {"text": "{:.1f} km".format(distance / 1000.0), "value": distance},
+        "duration": {"text": "{} mins".format(duration // 60 + 1), "value": duration},
+        "start_location": {"lat": location[0], "lng": location[1]},
+        "end_location": {"lat": end[0], "lng": end[1]},
+        "polyline": {"points": encode_polyline(points)},
+        "html_instructions": "Head <b>north</b> on Synthetic Street towards <b>Example Road</b>"
+    }
+
+    return step, end
+
+def make_leg(rng, mode, start, end, departure_time):
+    """ Creates a synthetic leg between two postcodes, with transit legs made up of walking and transit steps """
+    location = (54.97 + rng.uniform(-0.1, 0.1), -1.61 + rng.uniform(-0.1, 0.1))
+    steps = list()
+
+    if mode == "transit":
+        for i in range(rng.randint(1, 3)):
+            step, location = make_step(rng, "walking", rng.randint(50, 800), location)
+            steps.append(step)
+
+            step, location = make_step(rng, "transit", rng.randint(1000, 8000), location)
+            step["transit_details"] = {"line": {"short_name": "{}{}".format(rng.choice("XQ"), rng.randint(1, 99)), "name": "Synthetic Line", "vehicle": {"type": "BUS"}}, "num_stops": rng.randint(2, 20)}
+            steps.append(step)
+
+        step, location = make_step(rng, "walking", rng.randint(50, 800), location)
+        steps.append(step)
+    else:
+        for i in range(rng.randint(3, 12)):
+            step, location = make_step(rng, mode, rng.randint(50, 3000), location)
+            steps.append(step)
+
+    distance = sum(step["distance"]["value"] for step in steps)
+    duration = sum(step["duration"]["value"] for step in steps)
+
+    leg = {
+        "start_address": start,
+        "end_address": end,
+        "distance": {"text": "{:.1f} km".format(distance / 1000.0), "value": distance},
+        "duration": {"text": "{} mins".format(duration // 60), "value": duration},
+        "steps": steps
+    }
+
+    if mode == "transit":
+        leg["departure_time"] = {"text": "", "time_zone": "Europe/London", "value": departure_time}
+        leg["arrival_time"] = {"text": "", "time_zone": "Europe/London", "value": departure_time + duration}
+
+    return leg
+
+def directions_response(query):
+    """ Creates a synthetic Directions API response with one leg between each of the origin, waypoints and destination """
+    mode = query.get("mode", "driving")
+    places = [query.get("origin", "")] + [place for place in query.get("waypoints", "").split("|") if place] + [query.get("destination", "")]
+    departure_time = int(query.get("departure_time", time.time()))
+
+    legs = list()
+    for start, end in zip(places[:-1], places[1:]):
+        rng = random.Random(get_seed(start, end, mode))
+        leg = make_leg(rng, mode, start, end, departure_time)
+        legs.append(leg)
+        departure_time = leg.get("arrival_time", {}).get("value", departure_time)
+
+    return {"geocoded_waypoints": [{"geocoder_status": "OK", "place_id": "synthetic", "types": ["postal_code"]} for place in places], "routes": [{"summary": "Synthetic route", "legs": legs, "overview_polyline": {"points": ""}, "warnings": []}], "status": "OK"}
+
+def matrix_response(query):
+    """ Creates a synthetic Distance Matrix API response for every origin and destination pair """
+    mode = query.get("mode", "driving")
+    rows = list()
+
+    for origin in query.get("origins", "").split("|"):
+        elements = list()
+        for destination in query.get("destinations", "").split("|"):
+            rng = random.Random(get_seed(origin, destination, mode))
+            distance = rng.randint(500, 30000)
+            elements.append({"status": "OK", "distance": {"text": "", "value": distance}, "duration": {"text": "", "value": int(distance / MODE_SPEEDS[mode])}})
+        rows.append({"elements": elements})
+
+    return {"origin_addresses": query.get("origins", "").split("|"), "destination_addresses": query.get("destinations", "").split("|"), "rows": rows, "status": "OK"}
+
+def geocode_response(query):
+    """ Creates a synthetic reverse Geocoding API response with a full postcode and the postcode district it is in """
+    rng = random.Random(get_seed(query.get("latlng", "")))
+    district = "NE{}".format(rng.randint(1, 99))
+    postcode = "{} {}{}{}".format(district, rng.randint(0, 9), rng.choice("ABDEFGHJLNPQRSTUWXYZ"), rng.choice("ABDEFGHJLNPQRSTUWXYZ"))
+
+    results = list()
+    for name in (postcode, district):
+        results.append({"address_components": [{"long_name": name, "short_name": name, "types": ["postal_code"]}, {"long_name": "Newcastle upon Tyne", "short_name": "Newcastle upon Tyne", "types": ["postal_town"]}], "formatted_address": "Newcastle upon Tyne {}, UK".format(name), "types": ["postal_code"]})
+
+    return {"results": results, "status": "OK"}
+
+#The endpoints served and the function creating the response for each
+ENDPOINTS = {
+    "/maps/api/directions/json": directions_response,
+    "/maps/api/distancematrix/json": matrix_response,
+    "/maps/api/geocode/json": geocode_response
+}
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ Answers requests to the Google API endpoints with synthetic responses, after the latency and with the errors set on the server """
+
+    #Keep connections open between requests like the real APIs do
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        server = self.server
+
+        time.sleep(max(0.0, random.gauss(server.latency, server.latency_jitter)))
+
+        create_response = ENDPOINTS.get(url.path)
+        if create_response is None:
+            self.send_body(404, "Not Found")
+            return
+
+        chance = random.random()
+        if chance < server.error_rate:
+            self.send_body(500, "Internal Server Error")
+        elif chance < server.error_rate + server.over_query_limit_rate:
+            self.send_body(200, json.dumps({"error_message": "You have exceeded your rate-limit for this API.", "routes": [], "results": [], "status": "OVER_QUERY_LIMIT"}))
+        else:
+            self.send_body(200, json.dumps(create_response(dict(urlparse.parse_qsl(url.query)))))
+
+    def send_body(self, code, body):
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        #Printing every request would slow the server down and swamp the console
+        pass
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ A local stand-in for the Google Directions, Distance Matrix and Geocoding APIs, for measuring throughput without using any quota. Each request is handled in its own thread. """
+
+    daemon_threads = True
+    request_queue_size = 128
+    allow_reuse_address = True
+
+    def __init__(self, port = 8000, latency = 0.05, latency_jitter = 0.01, error_rate = 0.0, over_query_limit_rate = 0.0):
+        """ Creates the server, call serve_forever to start answering requests.
+
+        Arguments:
+            port - Integer - The local port to listen on
+            latency - Float - The average number of seconds taken to answer a request
+            latency_jitter - Float - The standard deviation of the time taken to answer a request in seconds
+            error_rate - Float - The fraction of requests answered with an HTTP 500 error
+            over_query_limit_rate - Float - The fraction of requests answered with the OVER_QUERY_LIMIT status
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ("localhost", port), MockHandler)
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.over_query_limit_rate = over_query_limit_rate
+
+def server_from_settings(config):
+    """ Creates the mock server described by the optional [MockServer] section of the settings file.
+
+    Arguments:
+        config - ConfigParser - The parsed settings file
+
+    Returns:
+        A MockServer, using the defaults for any setting that is not present
+    """
+    options = dict()
+
+    for name in ("latency", "latency_jitter", "error_rate", "over_query_limit_rate"):
+        if config.has_option('MockServer', name):
+            options[name] = config.getfloat('MockServer', name)
+
+    if config.has_option('MockServer', 'port'):
+        options["port"] = config.getint('MockServer', 'port')
+
+    return MockServer(**options)
+
+if __name__ == "__main__":
+    #Serve synthetic responses until interrupted, point the scripts at it by setting base_url in the [API] section
+    config = ConfigParser.SafeConfigParser()
+    config.read("Settings.cfg")
+
+    server = server_from_settings(config)
+    print "Mock Google APIs listening on http://localhost:{}".format(server.server_address[1])
+    server.serve_forever()
@@ -0,0 +1,171 @@
+import csv
+import os
+import datetime
+
+class CsvOutput(object):
+    """ Writes result dictionaries to a csv file, with 'NA' for any missing values. """
+
+    def __init__(self, filename, fieldnames, append = False, write_header = True):
+        """ Opens the csv file.
+
+        Arguments:
+            filename - String - The output file
+            fieldnames - List - The column names, in the order they are written
+            append - Boolean - If True rows are added to the end of an existing file rather than replacing it
+            write_header - Boolean - If True the header row is written when the file is opened
+        """
+        self.file = open(filename, 'ab' if append else 'wb')
+        self.writer = csv.DictWriter(self.file, fieldnames=fieldnames, restval='NA')
+
+        if write_header:
+            self.writer.writeheader()
+
+    def write(self, result):
+        """ Writes a single result dictionary as a row. """
+        self.writer.writerow(result)
+
+    def sync(self):
+        """ Makes sure every row written so far is saved to disk. """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+def get_column_type(name):
+    """ Gets the Arrow type for an output column from its name. Distances, durations and ratios are floats, counts are integers, the departure time is a timestamp and everything else is a string.
+
+    Arguments:
+        name - String - The column name
+
+    Returns:
+        A pyarrow DataType
+    """
+    import pyarrow as pa
+
+    if name.endswith("(m)") or name.endswith("(sec)") or name.endswith("Ratio"):
+        return pa.float64()
+    elif name.endswith("retries") or name.endswith("Retries") or name.startswith("Number of"):
+        return pa.int64()
+    elif name.endswith("Departure Time"):
+        return pa.timestamp("s")
+    else:
+        return pa.string()
+
+class ArrowOutput(object):
+    """ Writes result dictionaries to a typed columnar file, either Parquet or Arrow IPC, in batches of rows. Missing values are written as nulls rather than 'NA'. Requires pyarrow.
+
+    Rows waiting to be written are held as one list of values per column rather than as dictionaries.
+    """
+
+    def __init__(self, filename, fieldnames, file_format = "parquet", batch_size = 10000):
+        """ Opens the output file.
+
+        Arguments:
+            filename - String - The output file
+            fieldnames - List - The column names, in the order they are written
+            file_format - String - Either 'parquet' or 'arrow'
+            batch_size - Integer - The number of rows in each Parquet row group or Arrow record batch
+        """
+        import pyarrow as pa
+
+        self.fieldnames = list(fieldnames)
+        self.batch_size = batch_size
+        self.types = [get_column_type(name) for name in self.fieldnames]
+        self.schema = pa.schema([pa.field(name, column_type) for name, column_type in zip(self.fieldnames, self.types)])
+        self.columns = [list() for name in self.fieldnames]
+        self.rows = 0
+
+        if file_format == "parquet":
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(filename, self.schema)
+        elif file_format == "arrow":
+            self.sink = pa.OSFile(filename, 'wb')
+            self.writer = pa.RecordBatchFileWriter(self.sink, self.schema)
+        else:
+            raise ValueError("Unknown output format: {}".format(file_format))
+
+        self.file_format = file_format
+
+    def write(self, result):
+        """ Adds a single result dictionary to the current batch, writing the batch out once it is full. """
+        for column, name in zip(self.columns, self.fieldnames):
+            column.append(result.get(name))
+
+        self.rows = self.rows + 1
+        if self.rows >= self.batch_size:
+            self._write_batch()
+
+    def _write_batch(self):
+        """ Converts the waiting rows into typed arrays and writes them as one row group or record batch. """
+        import pyarrow as pa
+
+        if self.rows == 0:
+            return
+
+        arrays = [pa.array([convert_value(value, column_type) for value in column], type=column_type) for column, column_type in zip(self.columns, self.types)]
+        batch = pa.RecordBatch.from_arrays(arrays, self.fieldnames)
+
+        if self.file_format == "parquet":
+            self.writer.write_table(pa.Table.from_batches([batch], self.schema))
+        else:
+            self.writer.write_batch(batch)
+
+        self.columns = [list() for name in self.fieldnames]
+        self.rows = 0
+
+    def sync(self):
+        """ Does nothing, a columnar file can only be read once it has been closed so rows are kept until their batch is full rather than written early in small batches. """
+        pass
+
+    def close(self):
+        self._write_batch()
+        self.writer.close()
+        if self.file_format == "arrow":
+            self.sink.close()
+
+def convert_value(value, column_type):
+    """ Converts a single result value to suit its Arrow column type, with None for missing or unparseable values. """
+    import pyarrow as pa
+
+    if value is None or value == "NA":
+        return None
+
+    try:
+        if column_type == pa.float64():
+            return float(value)
+        elif column_type == pa.int64():
+            return int(value)
+        elif column_type == pa.timestamp("s"):
+            #Rows copied from an earlier csv output have the time as text
+            if isinstance(value, basestring):
+                return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+            return value if isinstance(value, datetime.datetime) else None
+        elif isinstance(value, str):
+            return value.decode("utf-8")
+        else:
+            return unicode(value)
+    except (TypeError, ValueError):
+        return None
+
+def open_output(filename, fieldnames, file_format = "csv", append = False, write_header = True, batch_size = 10000):
+    """ Opens the output file in the requested format.
+
+    Arguments:
+        filename - String - The output file
+        fieldnames - List - The column names, in the order they are written
+        file_format - String - One of 'csv' (the default), 'parquet' or 'arrow'
+        append - Boolean - If True rows are added to an existing csv file, columnar files cannot be appended to
+        write_header - Boolean - If True the csv header row is written
+        batch_size - Integer - The number of rows in each batch written to a columnar file
+
+    Returns:
+        A CsvOutput or ArrowOutput, both of which have write, sync and close methods
+    """
+    if file_format == "csv":
+        return CsvOutput(filename, fieldnames, append, write_header)
+
+    if append:
+        raise ValueError("Resuming is only supported for csv output")
+
+    return ArrowOutput(filename, fieldnames, file_format, batch_size)
@@ -0,0 +1,454 @@
+import threading
+import csv
+import datetime
+import itertools
+
+from Directions import get_waypoint_list, normalize_postcode, parse_modes, get_row_modes, ALL_MODES, MODES_COLUMN, NOT_REQUESTED, SKIPPED_DISTANCE
+from Directions import MODE_COLUMNS, DEFAULT_BASE_URL, DIRECTIONS_URL, DISTANCE_MATRIX_URL, API_NAMES, check_directions_input, check_row_modes, create_waypoint_pairs, get_waypoint_string, get_cache_key, get_matrix_pairs, pack_matrix_blocks
+
+def get_journey_key(input_data):
+    """ Gets a key identifying the journey requested by a row of the input csv. Rows with the same key need exactly the same API requests.
+
+    Arguments:
+        input_data - Dictionary - Data read from the input csv
+
+    Returns:
+        A tuple of the normalised origin and destination postcodes, a tuple of the waypoint postcodes and the modes named in the row's Modes column (in the order of ALL_MODES, empty if it has none or it is NA). A Modes column that cannot be read is kept as its text, so the row is still rejected by get_directions
+    """
+    waypoints = get_waypoint_list(input_data) or ()
+    text = (input_data.get(MODES_COLUMN) or "").strip()
+    if text.upper() == "NA":
+        modes = ()
+    else:
+        try:
+            modes = parse_modes(text)
+        except ValueError:
+            modes = text
+    return (normalize_postcode(input_data["OriginPostcode"]), normalize_postcode(input_data["DestinationPostcode"]), tuple(waypoints), modes)
+
+class JourneyPlan(object):
+    """ Groups the rows of an input file by journey so that each unique journey is only requested from the API once, with the result shared by every row that asks for it.
+
+    Results are only kept in memory until the last row that needs them has been given them.
+    """
+
+    def __init__(self, inputs):
+        """ Counts the number of rows asking for each journey.
+
+        Arguments:
+            inputs - Iterable - Dictionaries read from the input csv
+        """
+        self.rows = 0
+        self._remaining = dict()
+        self._results = dict()
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+        for item in inputs:
+            key = get_journey_key(item)
+            self._remaining[key] = self._remaining.get(key, 0) + 1
+            self.rows = self.rows + 1
+
+        self.journeys = len(self._remaining)
+
+    def dedup_ratio(self):
+        """ Gets the number of rows per unique journey, eg 4.0 means only a quarter of the rows need to be requested. """
+        if self.journeys == 0:
+            return 1.0
+        return float(self.rows) / self.journeys
+
+    def fetch(self, input_data, function):
+        """ Gets the result for a row, calling the supplied function only if no other row with the same journey has already done so. If another thread is already fetching the same journey this waits for it to finish rather than making a second request.
+
+        Arguments:
+            input_data - Dictionary - Data read from the input csv
+            function - Function - Called with input_data to get the result dictionary (or list of dictionaries), eg a partial of Directions.get_directions
+
+        Returns:
+            The result dictionary, or list of dictionaries, with the "UniqueID" set to the one in input_data
+        """
+        key = get_journey_key(input_data)
+
+        while True:
+            with self._lock:
+                if key in self._results:
+                    return self._take(key, input_data)
+
+                event = self._pending.get(key)
+                if event is None:
+                    #Nobody has asked for this journey yet so this thread makes the request
+                    event = threading.Event()
+                    self._pending[key] = event
+                    break
+
+            #Wait for the thread making the request, if it failed go round again and try to make it ourselves
+            event.wait()
+
+        try:
+            result = function(input_data)
+        except Exception:
+            with self._lock:
+                del self._pending[key]
+            event.set()
+            raise
+
+        with self._lock:
+            self._results[key] = result
+            del self._pending[key]
+            shared = self._take(key, input_data)
+        event.set()
+
+        return shared
+
+    def _take(self, key, input_data):
+        """ Gets a copy of a finished result for a row and forgets the result once no more rows need it. Must be called with the lock held. """
+        result = self._results[key]
+
+        remaining = self._remaining.get(key, 1) - 1
+        if remaining > 0:
+            self._remaining[key] = remaining
+        else:
+            self._remaining.pop(key, None)
+            del self._results[key]
+
+        if isinstance(result, list):
+            return [dict(row, UniqueID=input_data["UniqueID"]) for row in result]
+
+        result = result.copy()
+        result["UniqueID"] = input_data["UniqueID"]
+        return result
+
+def count_row_requests(waypoints, slots = 1, modes = ALL_MODES):
+    """ Gets the number of Directions API requests needed for a row: one for each non-transit mode and one for each transit leg between waypoints in each time slot """
+    requests = len([mode for mode in modes if mode != 'transit'])
+    if 'transit' in modes:
+        requests = requests + (len(waypoints) + 1) * slots
+    return requests
+
+class PreviousOutput(object):
+    """ The rows of an earlier output csv that can be copied into a new run instead of being requested again.
+
+    A row is copied forward unchanged if every request status in it is OK (or NOT_REQUESTED or SKIPPED_DISTANCE) and the current input asks for the same origin, destination, waypoints and modes under the same UniqueID. Rows that failed (any request status that is not OK, including NA), rows whose journey has changed and rows that were not in the earlier output are requested as normal. Only the position of each copyable row in the file is kept in memory, the row itself is read back when it is needed.
+    """
+
+    def __init__(self, filename, fieldnames, slots = None, modes = ALL_MODES):
+        """ Reads the earlier output, finding the rows that can be copied forward.
+
+        Arguments:
+            filename - String - The earlier output csv file
+            fieldnames - List - The columns of the new output, which must be the same as the earlier output's
+            slots - List - The departure slot names in a sweep. When the output has a row per time slot (a long sweep) a UniqueID is only copied if every slot is there and OK
+            modes - Iterable - The modes of transport set for the whole run
+        """
+        self.filename = filename
+        self.slots = slots
+        self.modes = tuple(modes)
+        self.counts = {"Copied": 0, "Failed": 0, "Changed": 0, "New": 0}
+        #The Directions requests the copied rows would need one row at a time, an upper bound as the run would share requests between repeated journeys, use the Distance Matrix or find responses in the cache
+        self.requests_avoided = 0
+
+        #Keyed by UniqueID, a tuple of the journey key and the offsets of the rows in the file, or None for rows that failed
+        self._rows = dict()
+        self._lock = threading.Lock()
+
+        self.file = open(filename, 'rb')
+        self.header = next(csv.reader([self.file.readline()]), None)
+        if self.header != fieldnames:
+            self.file.close()
+            raise ValueError("The columns in {} do not match the current output columns".format(filename))
+
+        status_columns = [i for i, name in enumerate(self.header) if name.lower().endswith("request status")]
+        id_column = self.header.index("UniqueID")
+        origin_column = self.header.index("Origin Postcode")
+        destination_column = self.header.index("Destination Postcode")
+        waypoints_column = self.header.index("Waypoints")
+        slot_column = self.header.index("Departure Slot") if "Departure Slot" in self.header else None
+        modes_column = self.header.index(MODES_COLUMN) if MODES_COLUMN in self.header else None
+
+        found_slots = dict()
+
+        #Assumes no cell contains a line break, as for resuming
+        while True:
+            offset = self.file.tell()
+            line = self.file.readline()
+            if not line:
+                break
+            row = next(csv.reader([line]), None)
+            if not row or len(row) != len(self.header):
+                continue
+
+            unique_id = row[id_column]
+            ok = all(row[i] in ("OK", NOT_REQUESTED, SKIPPED_DISTANCE) for i in status_columns)
+            waypoints = tuple(row[waypoints_column].split("|")) if row[waypoints_column] else ()
+            key = (row[origin_column], row[destination_column], waypoints, row[modes_column] if modes_column is not None else None)
+
+            previous = self._rows.get(unique_id, (key, []))
+            if not ok or previous is None or previous[0] != key:
+                self._rows[unique_id] = None
+                continue
+
+            #Outside a long sweep there is only one row for each UniqueID, any more are duplicates
+            if slot_column is None and previous[1]:
+                continue
+
+            previous[1].append(offset)
+            self._rows[unique_id] = previous
+            if slot_column is not None:
+                found_slots.setdefault(unique_id, set()).add(row[slot_column])
+
+        #A long sweep row can only be copied if it has an OK row for every time slot
+        if slot_column is not None:
+            for unique_id, row_slots in found_slots.items():
+                if self._rows[unique_id] is not None and (row_slots != set(slots or []) or len(self._rows[unique_id][1]) != len(slots)):
+                    self._rows[unique_id] = None
+
+    def _get_key(self, input_data):
+        """ Gets the key an input row's earlier output rows must have to be copied, matching the one made from the output columns """
+        row_modes = None
+        if MODES_COLUMN in self.header:
+            row_modes = "|".join(get_row_modes(input_data, self.modes))
+        return get_journey_key(input_data)[:3] + (row_modes,)
+
+    def can_copy(self, input_data):
+        """ Checks if the earlier output has OK rows for the same journey as an input row """
+        previous = self._rows.get(input_data["UniqueID"])
+        if previous is None:
+            return False
+
+        try:
+            return previous[0] == self._get_key(input_data)
+        except ValueError:
+            return False
+
+    def copy(self, input_data):
+        """ Gets the earlier output rows for an input row, counting why rows that cannot be copied need to be requested again.
+
+        Arguments:
+            input_data - Dictionary - Data read from the input csv
+
+        Returns:
+            A list of the earlier row dictionaries (one for each time slot in a long sweep), or None if the row needs to be requested
+        """
+        unique_id = input_data["UniqueID"]
+
+        if not self.can_copy(input_data):
+            if unique_id not in self._rows:
+                reason = "New"
+            elif self._rows[unique_id] is None:
+                reason = "Failed"
+            else:
+                reason = "Changed"
+            with self._lock:
+                self.counts[reason] = self.counts[reason] + 1
+            return None
+
+        rows = list()
+        with self._lock:
+            for offset in self._rows[unique_id][1]:
+                self.file.seek(offset)
+                rows.append(dict(zip(self.header, next(csv.reader([self.file.readline()])))))
+
+            self.counts["Copied"] = self.counts["Copied"] + 1
+            key = self._rows[unique_id][0]
+            row_modes = self.modes if key[3] is None else [mode for mode in key[3].split("|") if mode]
+            self.requests_avoided = self.requests_avoided + count_row_requests(key[2], len(self.slots or [None]), row_modes)
+
+        return rows
+
+    def summary(self):
+        """ Gets a one line summary of the rows copied and requested for the console """
+        return "Copied {} unchanged rows from {}, which would need at most {} requests if each row were requested on its own. Requested {} rows that failed before, {} that changed and {} new rows".format(self.counts["Copied"], self.filename, self.requests_avoided, self.counts["Failed"], self.counts["Changed"], self.counts["New"])
+
+    def close(self):
+        self.file.close()
+
+class RequestPlan(object):
+    """ Works out the API requests a run would make without making any of them, so the quota and time a new input file needs are known before it is started.
+
+    Each row is put through the same checks as get_directions (check_directions_input and check_row_modes) and its requests are worked out in the same way: one Directions request for each of its non-transit modes, one for each transit leg between its waypoints (see create_waypoint_pairs) in each departure time slot, and Distance Matrix blocks (see pack_matrix_blocks) in place of the non-transit requests the matrix answers. Rows copied from an earlier output, repeated journeys and invalid rows need no requests. If a response cache is used, requests already in it, and requests repeated within the run (which will be in it by the time they are made), are counted as cache hits instead.
+    """
+
+    def __init__(self, modes = ALL_MODES, departure_times = None, deduplicate = True, chain_departures = False, cache = None, base_url = DEFAULT_BASE_URL):
+        """ Creates an empty plan.
+
+        Arguments:
+            modes - Iterable - The modes set for the whole run
+            departure_times - List - The departure time of the transit requests in seconds since the epoch, one for each time slot in a sweep. None for a single request at the current time
+            deduplicate - Boolean - If True rows asking for the same journey as an earlier row need no requests, as when GetData.py groups rows with a JourneyPlan
+            chain_departures - Boolean - If True each transit leg between waypoints departs when the previous leg arrives, so only the first leg can be looked up in the cache
+            cache - ResponseCache.ResponseCache - The cache the run would take responses from, None if it does not use one
+            base_url - String - The address requests are sent to, which is part of the cache key
+        """
+        self.modes = tuple(modes)
+        self.departure_times = list(departure_times or [None])
+        self.deduplicate = deduplicate
+        self.chain_departures = chain_departures
+        self.cache = cache
+        self.base_url = base_url
+
+        self.rows = 0
+        self.counts = {"Requested": 0, "Copied": 0, "Duplicate": 0, "Invalid": 0}
+        self.invalid = dict()
+        self.requests = dict()
+        self.elements = 0
+        self.cache_hits = 0
+
+        self._journeys = set()
+        self._keys = set()
+
+    def _add_request(self, url, params, cacheable = True):
+        """ Counts a request, unless it will be answered by the cache.
+
+        Arguments:
+            url - String - The API endpoint relative to the base URL, eg DIRECTIONS_URL
+            params - Dictionary - The query parameters for the request, not including the API key
+            cacheable - Boolean - False if the request's parameters are not known until the run, so it cannot be looked up in the cache
+
+        Returns:
+            True if the request would be made over the network, False if it would come from the cache
+        """
+        if self.cache is not None and cacheable:
+            key = get_cache_key(self.base_url + url, params)
+            if key in self._keys or key in self.cache:
+                self.cache_hits = self.cache_hits + 1
+                return False
+            self._keys.add(key)
+
+        api = (API_NAMES[url], params["mode"])
+        self.requests[api] = self.requests.get(api, 0) + 1
+        return True
+
+    def add_matrix_values(self, jobs, chunk_size = 1000, skip = None, modes = ALL_MODES, min_density = 0.5):
+        """ Counts the Distance Matrix requests that Directions.add_matrix_values would make for the input rows, read in the same chunks.
+
+        Arguments:
+            jobs - Iterable - (input_data, known_values) tuples as passed to add_matrix_values
+            chunk_size - Integer - The number of rows read ahead and sent to the Distance Matrix API together
+            skip - Function - Called with each row, rows it returns True for are left out of the matrix
+            modes - Iterable - The modes set for the whole run
+            min_density - Float - Blocks answering fewer than this fraction of their elements are sent a pair at a time (see pack_matrix_blocks)
+
+        Returns:
+            A generator of (input_data, known_values) tuples in input order, where the request status of each mode the matrix would answer is in known_values so no Directions request is counted for it
+        """
+        matrix_modes = [mode for mode in modes if mode in MODE_COLUMNS]
+        jobs = iter(jobs)
+
+        while True:
+            chunk = list(itertools.islice(jobs, chunk_size))
+            if not chunk:
+                return
+
+            row_pairs = get_matrix_pairs(chunk, matrix_modes, skip)
+
+            for mode in matrix_modes:
+                for origins, destinations, block_pairs in pack_matrix_blocks(set(row[0] for row in row_pairs if row and mode in row[1]), min_density = min_density):
+                    params = {"origins": get_waypoint_string(origins), "destinations": get_waypoint_string(destinations), "mode": mode}
+                    if self._add_request(DISTANCE_MATRIX_URL, params):
+                        self.elements = self.elements + len(origins) * len(destinations)
+
+            for (input_data, known_values), row in zip(chunk, row_pairs):
+                if row is not None:
+                    known_values = dict(known_values or ())
+                    for mode in row[1]:
+                        known_values[MODE_COLUMNS[mode][2]] = "OK"
+                yield input_data, known_values
+
+    def add_row(self, input_data, known_values = None, copied = False):
+        """ Counts the Directions requests needed for an input row.
+
+        Arguments:
+            input_data - Dictionary - Data read from the input csv
+            known_values - Dictionary - Values that will already be known for some of the non-transit modes (eg from Prefilter.DistanceFilter or add_matrix_values), no requests are counted for these modes
+            copied - Boolean - True if the row will be copied from an earlier output, so needs no requests
+        """
+        self.rows = self.rows + 1
+
+        if copied:
+            self.counts["Copied"] = self.counts["Copied"] + 1
+            return
+
+        if self.deduplicate:
+            key = get_journey_key(input_data)
+            if key in self._journeys:
+                self.counts["Duplicate"] = self.counts["Duplicate"] + 1
+                return
+            self._journeys.add(key)
+
+        origin, destination, waypoints, invalid = check_directions_input(input_data)
+        row_modes, invalid = check_row_modes(input_data, self.modes, invalid)
+
+        if invalid is not None:
+            self.counts["Invalid"] = self.counts["Invalid"] + 1
+            reason = invalid["Postcode Status"]
+            self.invalid[reason] = self.invalid.get(reason, 0) + 1
+            return
+
+        self.counts["Requested"] = self.counts["Requested"] + 1
+
+        for mode in row_modes:
+            if mode == 'transit' or (known_values and MODE_COLUMNS[mode][2] in known_values):
+                continue
+            params = {"origin": origin, "destination": destination, "mode": mode}
+            if waypoints:
+                params["waypoints"] = get_waypoint_string(waypoints)
+            self._add_request(DIRECTIONS_URL, params)
+
+        if 'transit' in row_modes:
+            pairs = create_waypoint_pairs(origin, destination, waypoints) if waypoints else [(origin, destination)]
+            for departure_time in self.departure_times:
+                for i, (start, end) in enumerate(pairs):
+                    params = {"origin": start, "destination": end, "mode": "transit"}
+                    if departure_time:
+                        params["departure_time"] = departure_time
+                    #A chained leg departs whenever the leg before it arrives, which is only known once that leg has been requested
+                    self._add_request(DIRECTIONS_URL, params, i == 0 or not self.chain_departures)
+
+    def total(self):
+        """ Gets the total number of requests that would be made over the network """
+        return sum(self.requests.values())
+
+    def summary(self, limiters = None):
+        """ Gets the lines describing the plan for the console, with the time the requests would take under the rate limit and how much of the daily quota they need.
+
+        Arguments:
+            limiters - List - The RateLimit.RateLimiter the requests would wait on (one for each key when using a KeyPool), empty or None if there is no rate limit
+
+        Returns:
+            A list of strings
+        """
+        lines = ["Plan: {} rows, {} to request, {} repeated journeys, {} copied from the previous output and {} invalid".format(self.rows, self.counts["Requested"], self.counts["Duplicate"], self.counts["Copied"], self.counts["Invalid"])]
+
+        for reason in sorted(self.invalid):
+            lines.append("  {}: {} rows".format(reason, self.invalid[reason]))
+
+        for api, mode in sorted(self.requests):
+            lines.append("  {} {}: {} requests".format(api, mode, self.requests[(api, mode)]))
+
+        if self.elements:
+            lines.append("  distancematrix elements: {}".format(self.elements))
+
+        if self.cache is not None:
+            lines.append("  {} requests answered by the response cache".format(self.cache_hits))
+
+        total = self.total()
+        lines.append("Total: {} requests".format(total))
+
+        limiters = list(limiters or [])
+        if not limiters:
+            lines.append("No rate limit is set, so the run time depends on how quickly the API responds")
+            return lines
+
+        qps = sum(limiter.max_qps for limiter in limiters)
+        lines.append("Estimated run time at {:g} requests per second: {}".format(qps, datetime.timedelta(seconds=int(round(total / qps)))))
+
+        if all(limiter.daily_limit for limiter in limiters):
+            daily_limit = sum(limiter.daily_limit for limiter in limiters)
+            remaining = sum(limiter.headroom()[1] for limiter in limiters)
+            #Whatever is left today is used first, then a full daily limit each day after
+            days = 1 + (max(total - remaining, 0) + daily_limit - 1) // daily_limit
+            lines.append("Quota needed: {} of the daily limit of {} ({} left today), taking {} day{}".format(total, daily_limit, remaining, days, "" if days == 1 else "s"))
+        else:
+            lines.append("Quota needed: {} requests".format(total))
+
+        return lines
@@ -0,0 +1,208 @@
+import csv
+import os
+import ConfigParser
+
+import numpy as np
+
+from Directions import normalize_postcode, get_waypoint_list, check_postcode, read_postcode_csv
+
+#Layout of each entry in the index file: the normalised postcode (at most 8 characters, eg "SW1A 1AA") and its centroid
+INDEX_DTYPE = np.dtype([("postcode", "S8"), ("latitude", "f4"), ("longitude", "f4")])
+
+#The ONS Postcode Directory uses this latitude for postcodes with no grid reference
+ONS_NO_LATITUDE = 99.999999
+
+def build_postcode_index(directory_filename, index_filename, include_terminated = False):
+    """ Builds a sorted postcode index file from an ONS Postcode Directory style csv file. The csv needs a "pcds" (or "pcd") column and may have "lat", "long" and "doterm" (date of termination) columns.
+
+    Arguments:
+        directory_filename - String - The postcode directory csv file
+        index_filename - String - The index file to be written
+        include_terminated - Boolean - If True postcodes that have been retired are kept in the index
+
+    Returns:
+        Integer - The number of postcodes in the index
+    """
+    postcodes = list()
+    latitudes = list()
+    longitudes = list()
+
+    with open(directory_filename, 'rb') as csvfile:
+        reader = csv.DictReader(csvfile)
+
+        for row in reader:
+            if not include_terminated and row.get("doterm", "").strip():
+                continue
+
+            postcode = normalize_postcode(row.get("pcds") or row.get("pcd", ""))
+            if not check_postcode(postcode):
+                continue
+
+            try:
+                latitude = float(row.get("lat", ""))
+                longitude = float(row.get("long", ""))
+            except ValueError:
+                latitude = longitude = float("nan")
+
+            if latitude == ONS_NO_LATITUDE:
+                latitude = longitude = float("nan")
+
+            postcodes.append(postcode)
+            latitudes.append(latitude)
+            longitudes.append(longitude)
+
+    index = np.empty(len(postcodes), dtype=INDEX_DTYPE)
+    index["postcode"] = postcodes
+    index["latitude"] = latitudes
+    index["longitude"] = longitudes
+
+    #Sort by postcode and drop any duplicates so the index can be binary searched
+    index.sort(order="postcode")
+    if len(index):
+        keep = np.ones(len(index), dtype=bool)
+        keep[1:] = index["postcode"][1:] != index["postcode"][:-1]
+        index = index[keep]
+
+    #Write through a file object so that numpy does not add a .npy extension to the name
+    with open(index_filename, 'wb') as indexfile:
+        np.save(indexfile, index)
+
+    return len(index)
+
+class PostcodeIndex(object):
+    """ A sorted index of known postcodes and their centroids, memory mapped from a file built by build_postcode_index so that it opens almost instantly and is shared between processes by the operating system. """
+
+    def __init__(self, index_filename):
+        """ Opens the index file.
+
+        Arguments:
+            index_filename - String - The index file written by build_postcode_index
+        """
+        self.entries = np.load(index_filename, mmap_mode="r")
+        self.postcodes = self.entries["postcode"]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def find(self, postcodes):
+        """ Finds the position of each of the supplied normalised postcodes in the index.
+
+        Arguments:
+            postcodes - Iterable - Normalised postcode strings
+
+        Returns:
+            A tuple of a NumPy array of positions in the index and a NumPy boolean array that is True for each postcode that is in the index. Positions of postcodes not in the index are meaningless.
+        """
+        postcodes = list(postcodes)
+
+        #Anything longer than the index entries would be cut short by the conversion below, and cannot be a postcode anyway
+        fits = np.array([len(postcode) <= 8 for postcode in postcodes], dtype=bool)
+        postcodes = np.asarray(postcodes, dtype="S8")
+
+        if len(self.postcodes) == 0:
+            return np.zeros(len(postcodes), dtype=int), np.zeros(len(postcodes), dtype=bool)
+
+        positions = np.searchsorted(self.postcodes, postcodes)
+        clipped = np.minimum(positions, len(self.postcodes) - 1)
+        found = (self.postcodes[clipped] == postcodes) & fits
+
+        return clipped, found
+
+    def contains(self, postcode):
+        """ Checks if a single normalised postcode is in the index.
+
+        Arguments:
+            postcode - String - A normalised postcode (see Directions.normalize_postcode)
+
+        Returns:
+            Boolean indicating if the postcode is in the index
+        """
+        return bool(self.find([postcode])[1][0])
+
+    def lookup(self, postcodes):
+        """ Checks many normalised postcodes against the index at once.
+
+        Arguments:
+            postcodes - Iterable - Normalised postcode strings
+
+        Returns:
+            A NumPy boolean array that is True for each postcode that is in the index
+        """
+        return self.find(postcodes)[1]
+
+    def coordinates(self, postcodes):
+        """ Gets the centroid of each of the supplied normalised postcodes.
+
+        Arguments:
+            postcodes - Iterable - Normalised postcode strings
+
+        Returns:
+            A tuple of NumPy arrays of latitudes and longitudes, NaN for any postcode that is not in the index or has no centroid
+        """
+        positions, found = self.find(postcodes)
+
+        latitudes = np.where(found, self.entries["latitude"][positions], np.nan)
+        longitudes = np.where(found, self.entries["longitude"][positions], np.nan)
+
+        return latitudes, longitudes
+
+    def validate_file(self, filename):
+        """ Checks every postcode in an input csv file in one pass, so bad rows can be found before any requests are made.
+
+        Arguments:
+            filename - String - An input csv file in the format read by GetData.py
+
+        Returns:
+            A dictionary with the keys:
+                "Rows" - the number of rows in the file
+                "Valid Rows" - the number of rows where every postcode is valid
+                "Invalid" - a list of (UniqueID, postcode) tuples for each postcode that does not match the pattern or is not in the index
+        """
+        ids = list()
+        postcodes = list()
+        rows = 0
+
+        #Collect every postcode in the file, remembering which row it came from
+        for input_data in read_postcode_csv(filename):
+            rows = rows + 1
+            row_postcodes = [normalize_postcode(input_data["OriginPostcode"]), normalize_postcode(input_data["DestinationPostcode"])]
+            row_postcodes.extend(get_waypoint_list(input_data) or [])
+            for postcode in row_postcodes:
+                ids.append(input_data["UniqueID"])
+                postcodes.append(postcode)
+
+        #Check the pattern and then look every postcode up in the index at once
+        valid = self.lookup(postcodes) & np.array([check_postcode(postcode) for postcode in postcodes], dtype=bool)
+
+        invalid = [(ids[i], postcodes[i]) for i in np.flatnonzero(~valid)]
+
+        return {"Rows": rows, "Valid Rows": rows - len(set(uid for uid, postcode in invalid)), "Invalid": invalid}
+
+def index_from_settings(config):
+    """ Opens the postcode index named in the optional [Postcodes] section of the settings file.
+
+    Arguments:
+        config - ConfigParser - The parsed settings file
+
+    Returns:
+        A PostcodeIndex, or None if no index is set
+    """
+    if not config.has_option('Postcodes', 'index'):
+        return None
+
+    return PostcodeIndex(config.get('Postcodes', 'index'))
+
+if __name__ == "__main__":
+    #Build the index from the postcode directory named in the settings file
+    config = ConfigParser.SafeConfigParser()
+    config.read("Settings.cfg")
+
+    directory_filename = config.get('Postcodes', 'directory')
+    index_filename = config.get('Postcodes', 'index')
+
+    include_terminated = False
+    if config.has_option('Postcodes', 'include_terminated'):
+        include_terminated = config.getboolean('Postcodes', 'include_terminated')
+
+    count = build_postcode_index(directory_filename, index_filename, include_terminated)
+    print "Wrote {} postcodes to {} ({} bytes)".format(count, index_filename, os.path.getsize(index_filename))
@@ -0,0 +1,121 @@
+import itertools
+import threading
+
+import numpy as np
+
+from Directions import MODE_COLUMNS, ALL_MODES, SKIPPED_DISTANCE, normalize_postcode, get_waypoint_list, get_row_modes
+from Geometry import haversine
+
+class DistanceFilter(object):
+    """ Skips the driving, bicycling or walking requests for journeys that are too long in a straight line for the mode to be of any use, eg walking a 60km commute.
+
+    The straight line distance of each journey (through its waypoints, if it has any) is worked out from the postcode centroids in a PostcodeIndex. The rows are read in chunks and every postcode in a chunk is looked up and every distance worked out at once using NumPy. Journeys with a postcode that is not in the index are never skipped, so they are requested (or rejected as invalid) as normal.
+    """
+
+    def __init__(self, index, thresholds):
+        """ Creates the filter.
+
+        Arguments:
+            index - PostcodeIndex.PostcodeIndex - The postcode centroids
+            thresholds - Dictionary - The longest straight line distance in metres to request each mode for, keyed by mode. Modes without a threshold are always requested
+        """
+        self.index = index
+        self.thresholds = dict(thresholds)
+
+        #The number of rows each mode was skipped for
+        self.skipped = dict((mode, 0) for mode in self.thresholds)
+        self._lock = threading.Lock()
+
+    def get_distances(self, rows):
+        """ Gets the straight line distance of a batch of journeys from the postcode centroids.
+
+        Arguments:
+            rows - List - Dictionaries read from the input csv
+
+        Returns:
+            A NumPy array with the distance of each journey in metres, from the origin through each waypoint to the destination, NaN if any of its postcodes is not in the index
+        """
+        if not rows:
+            return np.zeros(0)
+
+        postcodes = list()
+        counts = list()
+        for input_data in rows:
+            journey = [normalize_postcode(input_data["OriginPostcode"])] + (get_waypoint_list(input_data) or []) + [normalize_postcode(input_data["DestinationPostcode"])]
+            postcodes.extend(journey)
+            counts.append(len(journey))
+
+        latitudes, longitudes = self.index.coordinates(postcodes)
+        latitudes = latitudes.astype(np.float64)
+        longitudes = longitudes.astype(np.float64)
+
+        #Every journey has at least two postcodes, so each is a run of legs between consecutive postcodes. The legs from the end of one journey to the start of the next are not part of either
+        legs = haversine(latitudes[:-1], longitudes[:-1], latitudes[1:], longitudes[1:])
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        legs[starts[1:] - 1] = 0.0
+        return np.add.reduceat(legs, starts)
+
+    def add_skipped_values(self, jobs, chunk_size = 10000, modes = ALL_MODES):
+        """ Marks the modes that are not worth requesting for each row as known, with the status SKIPPED_DISTANCE, so that get_directions and add_matrix_values make no requests for them.
+
+        Arguments:
+            jobs - Iterable - (input_data, known_values) tuples as passed to add_matrix_values
+            chunk_size - Integer - The number of rows read ahead and checked together
+            modes - Iterable - The modes set for the whole run, only these (narrowed down by each row's Modes column) are skipped
+
+        Returns:
+            A generator of (input_data, known_values) tuples in input order, with the skipped modes added to known_values
+        """
+        filter_modes = [mode for mode in modes if mode in self.thresholds]
+        jobs = iter(jobs)
+
+        while True:
+            chunk = list(itertools.islice(jobs, chunk_size))
+            if not chunk:
+                return
+
+            distances = self.get_distances([input_data for input_data, known_values in chunk])
+
+            for (input_data, known_values), distance in zip(chunk, distances):
+                try:
+                    row_modes = get_row_modes(input_data, filter_modes)
+                except ValueError:
+                    row_modes = ()
+
+                skipped = [mode for mode in row_modes if distance > self.thresholds[mode] and not (known_values and MODE_COLUMNS[mode][2] in known_values)]
+                if skipped:
+                    known_values = dict(known_values or ())
+                    for mode in skipped:
+                        known_values[MODE_COLUMNS[mode][2]] = SKIPPED_DISTANCE
+                    with self._lock:
+                        for mode in skipped:
+                            self.skipped[mode] = self.skipped[mode] + 1
+
+                yield input_data, known_values
+
+    def summary(self):
+        """ Gets a line describing the number of rows each mode was skipped for """
+        return "Straight line distance filter skipped " + ", ".join("{} for {} rows".format(mode, self.skipped[mode]) for mode in sorted(self.skipped))
+
+def filter_from_settings(config, index):
+    """ Creates the straight line distance filter described by the optional [Prefilter] section of the settings file, which sets the longest distance in metres to request driving, bicycling or walking directions for.
+
+    Arguments:
+        config - ConfigParser - The parsed settings file
+        index - PostcodeIndex.PostcodeIndex - The postcode centroids to work out distances from
+
+    Returns:
+        A DistanceFilter, or None if no thresholds are set
+    """
+    thresholds = dict()
+    for mode in MODE_COLUMNS:
+        if config.has_option('Prefilter', mode):
+            thresholds[mode] = config.getfloat('Prefilter', mode)
+
+    if not thresholds:
+        return None
+
+    if index is None:
+        raise ValueError("The straight line distance filter needs a postcode index, set index in the [Postcodes] section")
+
+    return DistanceFilter(index, thresholds)
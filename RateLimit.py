@@ -0,0 +1,166 @@
+import threading
+import datetime
+import time
+
+import pytz
+
+#Google API quotas are reset at midnight Pacific Time
+QUOTA_TIMEZONE = pytz.timezone('US/Pacific')
+
+class DailyLimitReached(Exception):
+    """ Raised when a request would go over the daily request limit """
+    pass
+
+def get_quota_day(now = None):
+    """ Gets the date that requests made at the supplied time (default now) count towards the daily quota of """
+    if now is None:
+        now = time.time()
+    return datetime.datetime.fromtimestamp(now, QUOTA_TIMEZONE).date()
+
+class RateLimiter(object):
+    """ A token bucket limiting the rate at which requests are made, shared by every thread.
+
+    The rate adapts to the API using additive increase, multiplicative decrease: each OVER_QUERY_LIMIT response cuts the rate (at most once a second, so a burst of errors from requests already in flight only counts once) and each successful response raises it a little, until it is back at the configured maximum. A daily limit on the number of requests can also be set.
+    """
+
+    def __init__(self, qps = 50.0, daily_limit = None, min_qps = 0.5, increase = 1.0, decrease = 0.5, burst = None):
+        """ Creates the limiter, starting at the maximum rate with a full bucket.
+
+        Arguments:
+            qps - Float - The maximum number of requests per second
+            daily_limit - Integer - The maximum number of requests per day (Pacific Time, when Google resets quotas), None or zero for no limit
+            min_qps - Float - The rate is never cut below this many requests per second
+            increase - Float - Roughly how many requests per second the rate goes up by for each second of successful responses
+            decrease - Float - The rate is multiplied by this after an OVER_QUERY_LIMIT response
+            burst - Float - The most requests that can be made at once after a quiet period, by default one second's worth at the maximum rate
+        """
+        self.max_qps = qps
+        self.qps = qps
+        self.min_qps = min(min_qps, qps)
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst or max(1.0, qps)
+        self.daily_limit = daily_limit
+
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.last_decrease = 0.0
+
+        self.day = get_quota_day()
+        self.used_today = 0
+
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        """ Adds the tokens earned since the bucket was last updated, and starts a new day's count at midnight """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.qps)
+        self.updated = now
+
+        day = get_quota_day(now)
+        if day != self.day:
+            self.day = day
+            self.used_today = 0
+
+    def headroom(self):
+        """ Gets how much capacity the limiter has left.
+
+        Returns:
+            A tuple of the requests that could be made straight away (a float) and the requests left today (None if there is no daily limit)
+        """
+        with self._lock:
+            self._refill(time.time())
+
+            remaining = None
+            if self.daily_limit:
+                remaining = max(self.daily_limit - self.used_today, 0)
+
+            return self.tokens, remaining
+
+    def acquire(self):
+        """ Waits until a request can be made and counts it against the daily limit.
+
+        Returns:
+            The number of seconds spent waiting
+
+        Raises:
+            DailyLimitReached if the daily limit has already been used
+        """
+        waited = 0.0
+
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+
+                if self.daily_limit and self.used_today >= self.daily_limit:
+                    raise DailyLimitReached("Daily request limit of {} reached".format(self.daily_limit))
+
+                if self.tokens >= 1.0:
+                    self.tokens = self.tokens - 1.0
+                    self.used_today = self.used_today + 1
+                    return waited
+
+                wait = (1.0 - self.tokens) / self.qps
+
+            time.sleep(wait)
+            waited = waited + wait
+
+    def feedback(self, status):
+        """ Adjusts the rate after a response.
+
+        Arguments:
+            status - String - The API status of the response, None if no response was received (which leaves the rate unchanged)
+        """
+        if status is None:
+            return
+
+        with self._lock:
+            if status == "OVER_QUERY_LIMIT":
+                now = time.time()
+                if now - self.last_decrease >= 1.0:
+                    self.qps = max(self.min_qps, self.qps * self.decrease)
+                    self.tokens = min(self.tokens, 0.0)
+                    self.last_decrease = now
+            elif self.qps < self.max_qps:
+                self.qps = min(self.max_qps, self.qps + self.increase / self.qps)
+
+def split_limits(options, share, quota_share = None):
+    """ Divides the rate and burst limits in a dictionary of RateLimiter arguments between share processes running at the same time, and the daily limit between the quota_share processes that use it during the day (share if None), so together they stay within the limits """
+    if quota_share is None:
+        quota_share = share
+    if share <= 1 and quota_share <= 1:
+        return options
+
+    options = dict(options)
+    if share > 1:
+        options["qps"] = options.get("qps", 50.0) / share
+        if options.get("burst"):
+            options["burst"] = options["burst"] / share
+    if options.get("daily_limit") and quota_share > 1:
+        options["daily_limit"] = max(options["daily_limit"] // quota_share, 1)
+    return options
+
+def limiter_from_settings(config, share = 1, quota_share = None):
+    """ Creates the rate limiter described by the optional [RateLimit] section of the settings file.
+
+    Arguments:
+        config - ConfigParser - The parsed settings file
+        share - Integer - The number of processes running at the same time the rate is split between, eg when running shards with Shards.py
+        quota_share - Integer - The number of processes the daily limit is split between, share if None
+
+    Returns:
+        A RateLimiter using the defaults for any setting that is not present, or None if qps is set to zero
+    """
+    options = dict()
+
+    for name in ("qps", "min_qps", "increase", "decrease", "burst"):
+        if config.has_option('RateLimit', name):
+            options[name] = config.getfloat('RateLimit', name)
+
+    if config.has_option('RateLimit', 'daily_limit'):
+        options["daily_limit"] = config.getint('RateLimit', 'daily_limit')
+
+    if options.get("qps") == 0:
+        return None
+
+    return RateLimiter(**split_limits(options, share, quota_share))
@@ -0,0 +1,146 @@
+import sqlite3
+import threading
+import time
+import zlib
+
+class ResponseCache(object):
+    """ A persistent on-disk cache of API responses stored in a SQLite database.
+
+    Responses are stored compressed against a normalised request key (see Directions.get_cache_key). Entries older than the time to live are ignored and removed, and once the stored responses exceed the maximum size the least recently used entries are evicted. The cache can be shared between threads.
+    """
+
+    def __init__(self, filename, ttl = 30 * 24 * 60 * 60, max_size = 500 * 1024 * 1024):
+        """ Opens (creating if needed) the cache database.
+
+        Arguments:
+            filename - String - Path of the SQLite database file
+            ttl - Float - Number of seconds a response is kept for, None or zero keeps responses forever
+            max_size - Integer - Maximum total size in bytes of the stored (compressed) responses, None or zero for no limit
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+
+        #The time each hit was last used, kept in memory and only written with the next put or on close so reading from the cache never holds the database's write lock
+        self._accessed = dict()
+
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.text_factory = str
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, body BLOB, size INTEGER, created REAL, accessed REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+
+        #Remove anything that has expired since the cache was last used
+        if self.ttl:
+            self._db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+        self._db.commit()
+
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        """ Gets the stored response text for the supplied request key.
+
+        Arguments:
+            key - String - The normalised request key
+
+        Returns:
+            The response text, or None if the request is not in the cache or has expired
+        """
+        now = time.time()
+
+        with self._lock:
+            row = self._db.execute("SELECT body, created FROM responses WHERE key = ?", (key,)).fetchone()
+
+            if row is None or (self.ttl and row[1] < now - self.ttl):
+                self.misses = self.misses + 1
+                return None
+
+            self._accessed[key] = now
+            self.hits = self.hits + 1
+
+        return zlib.decompress(row[0])
+
+    def __contains__(self, key):
+        """ Checks if a request has a stored response that has not expired, without counting it as a hit or keeping it from being evicted """
+        with self._lock:
+            row = self._db.execute("SELECT created FROM responses WHERE key = ?", (key,)).fetchone()
+        return row is not None and not (self.ttl and row[0] < time.time() - self.ttl)
+
+    def put(self, key, text):
+        """ Stores the response text for the supplied request key, evicting the least recently used responses if the cache is over its maximum size.
+
+        Arguments:
+            key - String - The normalised request key
+            text - String - The raw response text
+        """
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+
+        body = zlib.compress(text)
+        now = time.time()
+
+        with self._lock:
+            self._write_accessed()
+
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old:
+                self._size = self._size - old[0]
+
+            self._db.execute("INSERT OR REPLACE INTO responses (key, body, size, created, accessed) VALUES (?, ?, ?, ?, ?)", (key, sqlite3.Binary(body), len(body), now, now))
+            self._size = self._size + len(body)
+
+            if self.max_size and self._size > self.max_size:
+                self._evict()
+
+            self._db.commit()
+
+    def _write_accessed(self):
+        """ Writes the times of the hits since the last write to the database, so the least recently used responses are evicted first. Must be called with the lock held and followed by a commit. """
+        if self._accessed:
+            self._db.executemany("UPDATE responses SET accessed = ? WHERE key = ?", [(accessed, key) for key, accessed in self._accessed.items()])
+            self._accessed = dict()
+
+    def _evict(self):
+        """ Removes the least recently used responses until the cache is back under 90% of its maximum size. Must be called with the lock held. """
+        target = self.max_size * 0.9
+
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            if self._size <= target:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._size = self._size - size
+
+    def close(self):
+        """ Saves any outstanding changes and closes the database. """
+        with self._lock:
+            self._write_accessed()
+            self._db.commit()
+            self._db.close()
+
+def cache_from_settings(config):
+    """ Creates the response cache described by the [Cache] section of the settings file.
+
+    Arguments:
+        config - ConfigParser - The parsed settings file
+
+    Returns:
+        A ResponseCache, or None if the settings file has no [Cache] section
+    """
+    if not config.has_section('Cache'):
+        return None
+
+    filename = config.get('Cache', 'path')
+
+    ttl = 30 * 24 * 60 * 60
+    if config.has_option('Cache', 'ttl_days'):
+        ttl = config.getfloat('Cache', 'ttl_days') * 24 * 60 * 60
+
+    max_size = 500 * 1024 * 1024
+    if config.has_option('Cache', 'max_size_mb'):
+        max_size = int(config.getfloat('Cache', 'max_size_mb') * 1024 * 1024)
+
+    return ResponseCache(filename, ttl, max_size)
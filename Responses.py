@@ -0,0 +1,111 @@
+try:
+    #ujson decodes large responses considerably faster than the standard library, use it if it is installed
+    import ujson as json
+except ImportError:
+    import json
+
+class DirectionsStep(object):
+    """ The fields used from one step of a Directions API leg.
+
+    Attributes:
+        travel_mode - String - eg "WALKING" or "TRANSIT"
+        distance - Integer - Length of the step in metres
+        line_name - String - The short name of the transit line for transit steps, None if there is not one
+    """
+    __slots__ = ("travel_mode", "distance", "line_name")
+
+    def __init__(self, travel_mode, distance, line_name):
+        self.travel_mode = travel_mode
+        self.distance = distance
+        self.line_name = line_name
+
+class DirectionsLeg(object):
+    """ The fields used from one leg of a Directions API route.
+
+    Attributes:
+        distance - Integer - Length of the leg in metres
+        duration - Integer - Duration of the leg in seconds
+        arrival_time - Integer - Arrival time in seconds since the epoch, only given for transit routes, otherwise None
+        steps - List - DirectionsStep objects for the leg
+    """
+    __slots__ = ("distance", "duration", "arrival_time", "steps")
+
+    def __init__(self, distance, duration, arrival_time, steps):
+        self.distance = distance
+        self.duration = duration
+        self.arrival_time = arrival_time
+        self.steps = steps
+
+class DirectionsResult(object):
+    """ The fields used from a Directions API response.
+
+    Attributes:
+        status - String - The status of the request, eg "OK" or "ZERO_RESULTS"
+        legs - List - DirectionsLeg objects for the first route, empty if there are no routes
+        polylines - List - The encoded polylines of every step of the first route in order (or its overview polyline if the steps do not have them), None unless they were asked for
+    """
+    __slots__ = ("status", "legs", "polylines")
+
+    def __init__(self, status, legs, polylines = None):
+        self.status = status
+        self.legs = legs
+        self.polylines = polylines
+
+def decode_json(text):
+    """ Decodes a JSON response into Python objects using the fastest decoder available.
+
+    Arguments:
+        text - String - The raw response text
+
+    Returns:
+        The decoded JSON
+    """
+    return json.loads(text)
+
+def decode_directions(text, keep_polylines = False):
+    """ Decodes a Directions API response, keeping only the fields used to build the output (leg distance, duration and arrival time, and step travel mode, distance and transit line name). Everything else, such as html instructions and unless they are asked for the polylines, is dropped as soon as the response is parsed rather than being kept with the result.
+
+    Arguments:
+        text - String - The raw response text
+        keep_polylines - Boolean - If True the encoded polylines of the route are kept for working out its shape (see Geometry.py), they are still left encoded
+
+    Returns:
+        A DirectionsResult
+    """
+    response = json.loads(text)
+
+    legs = list()
+    polylines = list() if keep_polylines else None
+    routes = response.get("routes")
+
+    if routes:
+        for leg in routes[0].get("legs", ()):
+            steps = list()
+
+            for step in leg.get("steps", ()):
+                if keep_polylines:
+                    polylines.append((step.get("polyline") or {}).get("points"))
+
+                line_name = None
+                transit_details = step.get("transit_details")
+                if transit_details:
+                    line_name = (transit_details.get("line") or {}).get("short_name")
+
+                steps.append(DirectionsStep(step.get("travel_mode"), (step.get("distance") or {}).get("value", 0), line_name))
+
+            arrival_time = leg.get("arrival_time")
+            if arrival_time:
+                arrival_time = arrival_time.get("value")
+
+            legs.append(DirectionsLeg(leg.get("distance").get("value"), leg.get("duration").get("value"), arrival_time, steps))
+
+        #The step polylines follow the route in more detail than the overview, which is only used if any step is missing its polyline
+        if keep_polylines and (not polylines or None in polylines):
+            overview = (routes[0].get("overview_polyline") or {}).get("points")
+            polylines = [overview] if overview else list()
+
+    return DirectionsResult(response.get("status"), legs, polylines)
+
+def decode_directions_polylines(text):
+    """ Decodes a Directions API response as decode_directions does, also keeping the encoded polylines of the route """
+    return decode_directions(text, True)
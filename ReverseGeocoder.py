@@ -0,0 +1,198 @@
+import numpy as np
+
+#Mean radius of the earth in metres
+EARTH_RADIUS = 6371008.8
+
+#Number of queries whose distances to the candidate points are worked out at once
+QUERY_BATCH = 256
+
+#Multiplier used to combine the x and y grid cell numbers into one key, larger than any cell number will be
+CELL_KEY_BASE = 1 << 24
+
+class GridGeocoder(object):
+    """ Finds the nearest postcodes to latitude and longitude points without using the API.
+
+    The postcode centroids are projected onto a flat grid in metres and bucketed into square cells. Queries are answered a whole cell of points at a time by searching outwards ring by ring from the query cell until the nearest postcodes are known for certain.
+    """
+
+    def __init__(self, postcodes, latitudes, longitudes, cell_size = 1000.0):
+        """ Builds the grid from arrays of postcodes and their centroids. Postcodes without a centroid (NaN) are left out.
+
+        Arguments:
+            postcodes - NumPy array - The postcode strings
+            latitudes - NumPy array - The latitude of each postcode centroid
+            longitudes - NumPy array - The longitude of each postcode centroid
+            cell_size - Float - The width of each grid cell in metres
+        """
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        has_centroid = ~(np.isnan(latitudes) | np.isnan(longitudes))
+
+        self.cell_size = float(cell_size)
+
+        #Project around the middle of the data so distances are accurate to well under 1% across the UK
+        self.reference_latitude = np.radians(np.mean(latitudes[has_centroid])) if has_centroid.any() else 0.0
+
+        x, y = self.project(latitudes[has_centroid], longitudes[has_centroid])
+        self.min_x = x.min() if len(x) else 0.0
+        self.min_y = y.min() if len(y) else 0.0
+
+        #Sort the points by cell so each cell is a contiguous run of the arrays
+        keys = self._cell_keys(*self._cells(x, y))
+        order = np.argsort(keys, kind="mergesort")
+
+        self.postcodes = np.asarray(postcodes)[has_centroid][order]
+        self.latitudes = latitudes[has_centroid][order]
+        self.longitudes = longitudes[has_centroid][order]
+        self.x = x[order]
+        self.y = y[order]
+
+        sorted_keys = keys[order]
+        self.cell_keys, self.cell_starts = np.unique(sorted_keys, return_index=True)
+        self.cell_ends = np.append(self.cell_starts[1:], len(sorted_keys))
+
+    @classmethod
+    def from_index(cls, index, cell_size = 1000.0):
+        """ Builds the grid from the centroids in a PostcodeIndex.
+
+        Arguments:
+            index - PostcodeIndex - The postcode index (see PostcodeIndex.py)
+            cell_size - Float - The width of each grid cell in metres
+
+        Returns:
+            A GridGeocoder
+        """
+        return cls(index.entries["postcode"], index.entries["latitude"], index.entries["longitude"], cell_size)
+
+    def project(self, latitudes, longitudes):
+        """ Projects latitudes and longitudes onto a flat grid measured in metres.
+
+        Arguments:
+            latitudes - NumPy array - Latitudes in degrees
+            longitudes - NumPy array - Longitudes in degrees
+
+        Returns:
+            A tuple of NumPy arrays of x and y positions in metres
+        """
+        x = EARTH_RADIUS * np.radians(longitudes) * np.cos(self.reference_latitude)
+        y = EARTH_RADIUS * np.radians(latitudes)
+        return x, y
+
+    def _cells(self, x, y):
+        """ Gets the grid cell numbers of points. """
+        return np.floor((x - self.min_x) / self.cell_size).astype(np.int64), np.floor((y - self.min_y) / self.cell_size).astype(np.int64)
+
+    def _cell_keys(self, cell_x, cell_y):
+        """ Combines grid cell numbers into a single key for each cell, shifting them so that cells just outside the data still get positive keys. """
+        return (cell_x + CELL_KEY_BASE // 2) * CELL_KEY_BASE + (cell_y + CELL_KEY_BASE // 2)
+
+    def _points_in_cells(self, cell_x, cell_y, ring):
+        """ Gets the positions of all points in the square of cells within ring cells of the supplied cell. """
+        offsets = np.arange(-ring, ring + 1)
+        keys = self._cell_keys((cell_x + offsets)[:, None], (cell_y + offsets)[None, :]).ravel()
+
+        #Find which of the cells in the square actually contain points
+        positions = np.searchsorted(self.cell_keys, keys)
+        in_range = positions < len(self.cell_keys)
+        positions = positions[in_range]
+        present = positions[self.cell_keys[positions] == keys[in_range]]
+
+        if len(present) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        return np.concatenate([np.arange(self.cell_starts[p], self.cell_ends[p]) for p in present])
+
+    def query(self, latitudes, longitudes, k = 1, max_distance = None):
+        """ Finds the k nearest postcodes to each of the supplied points.
+
+        Arguments:
+            latitudes - Iterable - Latitudes of the points in degrees
+            longitudes - Iterable - Longitudes of the points in degrees
+            k - Integer - The number of nearest postcodes to find for each point
+            max_distance - Float - Postcodes further than this many metres away are not returned, None for no limit
+
+        Returns:
+            A tuple of:
+                NumPy array of shape (points, k) of postcodes, nearest first, with empty strings where fewer than k postcodes were found
+                NumPy array of shape (points, k) of distances in metres, infinity where no postcode was found
+        """
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        n = len(latitudes)
+
+        found = np.full((n, k), -1, dtype=np.int64)
+        distances = np.full((n, k), np.inf)
+
+        if n == 0 or len(self.x) == 0:
+            return self._postcodes_for(found), distances
+
+        qx, qy = self.project(latitudes, longitudes)
+        valid = ~(np.isnan(qx) | np.isnan(qy))
+
+        cell_x = np.zeros(n, dtype=np.int64)
+        cell_y = np.zeros(n, dtype=np.int64)
+        cell_x[valid], cell_y[valid] = self._cells(qx[valid], qy[valid])
+
+        #Never search further out than is needed to reach max_distance, or than the whole grid if there is no limit
+        grid_span = max(self.x.max() - self.min_x, self.y.max() - self.min_y)
+        limit = grid_span if max_distance is None else min(grid_span, max_distance)
+        max_ring = int(np.ceil(limit / self.cell_size)) + 1
+
+        #Answer the queries a cell at a time, as every query in a cell shares the same candidate points
+        query_keys = self._cell_keys(cell_x, cell_y)
+        pending = np.flatnonzero(valid)
+
+        ring = 1
+        while len(pending) and ring <= max_ring:
+            unresolved = list()
+
+            order = np.argsort(query_keys[pending], kind="mergesort")
+            pending = pending[order]
+            unique_keys, starts = np.unique(query_keys[pending], return_index=True)
+            ends = np.append(starts[1:], len(pending))
+
+            for start, end in zip(starts, ends):
+                candidates = self._points_in_cells(cell_x[pending[start]], cell_y[pending[start]], ring)
+                if len(candidates) == 0:
+                    unresolved.append(pending[start:end])
+                    continue
+
+                m = min(k, len(candidates))
+
+                #Work through the queries in this cell in batches so the distance matrix stays a manageable size
+                for batch_start in range(start, end, QUERY_BATCH):
+                    queries = pending[batch_start:min(end, batch_start + QUERY_BATCH)]
+
+                    #Distance from every query to every candidate point
+                    dx = qx[queries][:, None] - self.x[candidates][None, :]
+                    dy = qy[queries][:, None] - self.y[candidates][None, :]
+                    d = np.sqrt(dx * dx + dy * dy)
+
+                    nearest = np.argsort(d, axis=1, kind="mergesort")[:, :m]
+
+                    found[queries, :m] = candidates[nearest]
+                    distances[queries, :m] = d[np.arange(len(queries))[:, None], nearest]
+
+                    #The answer is certain once the kth nearest point is closer than anything outside the searched square can be
+                    certain = distances[queries, k - 1] <= ring * self.cell_size
+                    if max_distance is not None:
+                        certain = certain | (ring * self.cell_size >= max_distance)
+                    if not certain.all():
+                        unresolved.append(queries[~certain])
+
+            pending = np.concatenate(unresolved) if unresolved else np.empty(0, dtype=np.int64)
+            ring = ring + 1
+
+        if max_distance is not None:
+            too_far = distances > max_distance
+            found[too_far] = -1
+            distances[too_far] = np.inf
+
+        return self._postcodes_for(found), distances
+
+    def _postcodes_for(self, found):
+        """ Turns an array of point positions into postcodes, with empty strings for -1. """
+        postcodes = np.full(found.shape, "", dtype=self.postcodes.dtype if len(self.postcodes) else "S8")
+        has_point = found >= 0
+        postcodes[has_point] = self.postcodes[found[has_point]]
+        return postcodes
@@ -0,0 +1,266 @@
+import ConfigParser
+import subprocess
+import zlib
+import json
+import time
+import csv
+import sys
+import os
+
+from Directions import read_postcode_csv, read_written_ids, get_setting, get_departure_times
+
+def get_shard(unique_id, count):
+    """ Gets the shard an input row belongs to from a stable hash of its UniqueID, so every process and machine puts each row in the same shard.
+
+    Arguments:
+        unique_id - String - The UniqueID of the input row
+        count - Integer - The number of shards
+
+    Returns:
+        Integer - The shard index, from 0 to count - 1
+    """
+    return (zlib.crc32(unique_id) & 0xffffffff) % count
+
+def get_part_filename(filename, index, count):
+    """ Gets the name of a shard's own copy of a file, eg output.csv becomes output.part-2-of-8.csv for shard 2 of 8 """
+    root, extension = os.path.splitext(filename)
+    return "{}.part-{}-of-{}{}".format(root, index, count, extension)
+
+def write_checkpoint(part_filename, rows, complete):
+    """ Records the progress of a shard next to its part file, replacing the checkpoint in one step.
+
+    Arguments:
+        part_filename - String - The shard's output part file
+        rows - Integer - The number of input rows written to the part file so far
+        complete - Boolean - True once every input row in the shard has been written
+    """
+    filename = part_filename + ".progress"
+    temp_filename = filename + ".tmp"
+    with open(temp_filename, "w") as f:
+        json.dump({"rows": rows, "complete": complete, "updated": time.time()}, f, indent=2, sort_keys=True)
+    os.rename(temp_filename, filename)
+
+def read_checkpoint(part_filename):
+    """ Gets the progress recorded for a shard, None if it has not been started """
+    filename = part_filename + ".progress"
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+def index_part(filename, slot_name = "Departure Slot"):
+    """ Finds where the rows for each UniqueID are in a part file, without holding the rows themselves in memory. Assumes no cell contains a line break.
+
+    Arguments:
+        filename - String - The part file, which must end with a complete row
+        slot_name - String - The column that tells apart the several rows a long sweep writes for each UniqueID
+
+    Returns:
+        A tuple of the header row as a list, a dictionary of UniqueID to the list of byte offsets of its rows, and a list of the UniqueIDs with a row (or time slot) written more than once
+    """
+    offsets = dict()
+    duplicates = list()
+    seen = set()
+
+    with open(filename, 'rb') as csvfile:
+        header = next(csv.reader([csvfile.readline()]))
+        if "UniqueID" not in header:
+            raise ValueError("{} does not have a UniqueID column".format(filename))
+        id_column = header.index("UniqueID")
+        slot_column = header.index(slot_name) if slot_name in header else None
+
+        while True:
+            offset = csvfile.tell()
+            line = csvfile.readline()
+            if not line:
+                break
+            row = next(csv.reader([line]))
+            if not row:
+                continue
+
+            unique_id = row[id_column]
+            key = (unique_id, row[slot_column]) if slot_column is not None else unique_id
+            if key in seen:
+                duplicates.append(unique_id)
+                continue
+            seen.add(key)
+            offsets.setdefault(unique_id, list()).append(offset)
+
+    return header, offsets, duplicates
+
+def merge_parts(input_filename, output_filename, count, rows_per_id = 1):
+    """ Merges the part files written by each shard into a single output file with the rows in the same order as the input file, checking that every UniqueID in the input was written exactly once.
+
+    Each part file is first indexed by UniqueID, so the rows are found wherever they are in it and memory use grows only with the number of UniqueIDs (not whole rows). The rows are copied across unchanged. The UniqueIDs in the input file are assumed to be unique, as for resuming.
+
+    Arguments:
+        input_filename - String - The input file the shards were run on
+        output_filename - String - The file the merged output is written to, the part files are named after it
+        count - Integer - The number of shards
+        rows_per_id - Integer - The number of rows written for each UniqueID, the number of time slots in a long sweep. A shard stopped part way through the rows of its last UniqueID has them removed so it is reported as missing
+
+    Returns:
+        A dictionary with the number of input rows ("Rows") and of rows merged ("Written"), lists of the UniqueIDs that no shard wrote ("Missing"), that were written more than once ("Duplicates") and that are in a part file but not in its shard of the input ("Unexpected"), and the indexes of the shards whose checkpoint does not say they finished ("Incomplete")
+    """
+    report = {"Rows": 0, "Written": 0, "Missing": list(), "Duplicates": list(), "Unexpected": list(), "Incomplete": list()}
+    header = None
+    parts = list()
+
+    for index in range(count):
+        part_filename = get_part_filename(output_filename, index, count)
+        checkpoint = read_checkpoint(part_filename)
+        if checkpoint is None or not checkpoint.get("complete"):
+            report["Incomplete"].append(index)
+
+        #Remove any half-written last row, or the rows of a UniqueID with time slots missing, left by a shard that was stopped
+        if read_written_ids(part_filename, rows_per_id)[0] is None:
+            parts.append((None, dict()))
+            continue
+
+        part_header, offsets, duplicates = index_part(part_filename)
+        if header is None:
+            header = part_header
+        elif part_header != header:
+            raise ValueError("The columns in {} do not match the other part files".format(part_filename))
+        report["Duplicates"].extend(duplicates)
+
+        parts.append((open(part_filename, 'rb'), offsets))
+
+    if header is None:
+        raise ValueError("None of the part files for {} contain any rows".format(output_filename))
+
+    temp_filename = output_filename + ".tmp"
+    try:
+        with open(temp_filename, 'wb') as csvfile:
+            csv.writer(csvfile).writerow(header)
+
+            for item in read_postcode_csv(input_filename):
+                unique_id = item["UniqueID"]
+                report["Rows"] = report["Rows"] + 1
+                part, offsets = parts[get_shard(unique_id, count)]
+
+                row_offsets = offsets.pop(unique_id, None)
+                if row_offsets is None:
+                    report["Missing"].append(unique_id)
+                    continue
+
+                #The shards write their rows in input order, so this is almost always a sequential read
+                for offset in row_offsets:
+                    part.seek(offset)
+                    csvfile.write(part.readline())
+                report["Written"] = report["Written"] + 1
+    finally:
+        for part, offsets in parts:
+            if part is not None:
+                part.close()
+
+    os.rename(temp_filename, output_filename)
+
+    #Anything not merged is in the wrong part file or is not in the input
+    for part, offsets in parts:
+        report["Unexpected"].extend(offsets)
+
+    return report
+
+def get_limit_shares(config, output_filename, count):
+    """ Gets how many ways the rate limits and the daily quota are split for a shard. The rate is split between the shards that run at the same time, at most processes of them, and the daily quota between the shards that have not finished yet, as a finished shard makes no more requests.
+
+    Arguments:
+        config - ConfigParser - The parsed settings file
+        output_filename - String - The output file the part files are named after
+        count - Integer - The number of shards
+
+    Returns:
+        A tuple of the number of shards the rate is split between and the number the daily quota is split between
+    """
+    unfinished = 0
+    for index in range(count):
+        checkpoint = read_checkpoint(get_part_filename(output_filename, index, count))
+        if checkpoint is None or not checkpoint.get("complete"):
+            unfinished = unfinished + 1
+
+    #The shard asking is always one of the unfinished shards, even if it has finished before and is being run again
+    unfinished = max(unfinished, 1)
+    processes = get_setting(config, 'Shards', 'processes', count)
+    return max(min(processes, unfinished), 1), unfinished
+
+def get_rows_per_id(config):
+    """ Gets the number of output rows GetData.py writes for each UniqueID: one for every time slot in a long departure time sweep, otherwise one """
+    if not config.has_option('Time', 'sweep_start') or get_setting(config, 'Time', 'sweep_format', 'long') != 'long':
+        return 1
+    return len(get_departure_times(config.get('Time', 'sweep_start'), config.get('Time', 'sweep_end'), get_setting(config, 'Time', 'sweep_step', 15), config.getint('Time', 'day')))
+
+def print_ids(description, ids, limit = 20):
+    """ Prints how many UniqueIDs are in a list and the first few of them """
+    if not ids:
+        return
+    print "{} {}: {}{}".format(len(ids), description, ", ".join(ids[:limit]), ", ..." if len(ids) > limit else "")
+
+def run_shards(count, processes):
+    """ Runs GetData.py on every shard, each in its own process with up to processes running at once.
+
+    Arguments:
+        count - Integer - The number of shards
+        processes - Integer - The maximum number of shards run at the same time
+
+    Returns:
+        A list of the indexes of the shards whose process failed
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "GetData.py")
+    waiting = range(count)
+    running = dict()
+    failed = list()
+
+    while waiting or running:
+        while waiting and len(running) < processes:
+            index = waiting.pop(0)
+            print "Starting shard {} of {}".format(index, count)
+            running[index] = subprocess.Popen([sys.executable, script, str(index)])
+
+        time.sleep(0.5)
+
+        for index, process in running.items():
+            if process.poll() is not None:
+                del running[index]
+                if process.returncode != 0:
+                    print "Shard {} failed with exit code {}".format(index, process.returncode)
+                    failed.append(index)
+                else:
+                    print "Shard {} finished".format(index)
+
+    return failed
+
+if __name__ == "__main__":
+    #Get the settings from the config file
+    config = ConfigParser.SafeConfigParser()
+    config.read("Settings.cfg")
+
+    input_filename = config.get('Files', 'input')
+    output_filename = config.get('Files', 'output')
+
+    count = get_setting(config, 'Shards', 'count', 1)
+    processes = get_setting(config, 'Shards', 'processes', count)
+    if count < 2:
+        sys.exit("Set count in the [Shards] section to the number of shards to split the input into")
+
+    #'run' (the default) runs every shard on this machine and then merges them, 'merge' only merges part files that have already been written, eg copied from other machines
+    command = sys.argv[1] if len(sys.argv) > 1 else "run"
+    if command not in ("run", "merge"):
+        sys.exit("Usage: python Shards.py [run|merge]")
+
+    if command == "run":
+        failed = run_shards(count, processes)
+        if failed:
+            sys.exit("Not merging: shards {} failed, run again to resume them".format(", ".join(str(index) for index in failed)))
+
+    report = merge_parts(input_filename, output_filename, count, get_rows_per_id(config))
+    print "Merged {} of {} input rows into {}".format(report["Written"], report["Rows"], output_filename)
+
+    print_ids("UniqueIDs missing", report["Missing"])
+    print_ids("UniqueIDs written more than once", report["Duplicates"])
+    print_ids("UniqueIDs not in their shard of the input", report["Unexpected"])
+    if report["Incomplete"]:
+        print "Shards not marked as finished: {}".format(", ".join(str(index) for index in report["Incomplete"]))
+
+    if report["Missing"] or report["Duplicates"] or report["Unexpected"]:
+        sys.exit(1)
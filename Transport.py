@@ -0,0 +1,159 @@
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from Responses import decode_json
+from RateLimit import DailyLimitReached
+
+#API statuses that mean the request may succeed if it is tried again later
+RETRY_STATUSES = ("OVER_QUERY_LIMIT", "UNKNOWN_ERROR")
+
+#The error recorded when the server answers with HTTP 429 Too Many Requests
+TOO_MANY_REQUESTS = "Request network error: HTTP 429"
+
+def get_status(data):
+    """ Gets the API status from a decoded response, which may be a dictionary or one of the records from Responses.py """
+    if isinstance(data, dict):
+        return data.get("status")
+    return getattr(data, "status", None)
+
+class TransportResponse(object):
+    """ The outcome of a request made through a transport.
+
+    Attributes:
+        data - Object - The decoded response (a dictionary or a record from Responses.py), None if no usable response was received
+        text - String - The raw response text, None if no usable response was received
+        retries - Integer - The number of times the request was retried
+        error - String - Description of why the request failed, None if a response was received
+        backoff - Float - The number of seconds spent waiting between retries
+        throttle - Float - The number of seconds spent waiting for the rate limiter
+        http_status - Integer - The HTTP status code of the response, None if no response was received
+    """
+    __slots__ = ("data", "text", "retries", "error", "backoff", "throttle", "http_status")
+
+    def __init__(self, data, text, retries, error = None, backoff = 0.0, throttle = 0.0, http_status = None):
+        self.data = data
+        self.text = text
+        self.retries = retries
+        self.error = error
+        self.backoff = backoff
+        self.throttle = throttle
+        self.http_status = http_status
+
+def is_retryable(response):
+    """ Checks if a failed request may succeed if it is tried again: a network error, a 429 or 5xx response, a response that could not be decoded or one of the RETRY_STATUSES. Other 4xx responses, such as 403 Forbidden, will fail the same way every time. """
+    if response.error is None:
+        return get_status(response.data) in RETRY_STATUSES
+    status = response.http_status
+    return status is None or status == 429 or not 400 <= status < 500
+
+class HttpTransport(object):
+    """ Makes requests to the Google APIs over a pool of keep-alive connections, with timeouts and retries.
+
+    Requests that fail with a network error, a 5xx (or 429) response or one of the RETRY_STATUSES are retried after a jittered exponential backoff (see is_retryable). Any other 4xx response is returned straight away as the error. If a rate limiter is supplied every attempt, including retries, waits for it. Other transports can be used in its place as long as they provide the same get method.
+    """
+
+    def __init__(self, pool_size = 10, connect_timeout = 5.0, read_timeout = 30.0, max_retries = 5, backoff = 0.5, max_backoff = 32.0):
+        """ Creates the transport and its connection pool.
+
+        Arguments:
+            pool_size - Integer - The maximum number of connections kept open to each host, this should be at least the number of requests that will be made at once
+            connect_timeout - Float - Seconds to wait for a connection to be made
+            read_timeout - Float - Seconds to wait for the response once connected
+            max_retries - Integer - The number of times a failed request is retried before giving up
+            backoff - Float - The base delay in seconds before the first retry, doubled for each retry after that
+            max_backoff - Float - The longest delay in seconds between retries
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, params, decode = decode_json, limiter = None):
+        """ Makes a GET request, retrying it if it fails in a way that may be temporary.
+
+        Arguments:
+            url - String - The API endpoint
+            params - Dictionary - The query parameters, these are URL encoded by the transport
+            decode - Function - Turns the raw response text into the decoded response, eg Responses.decode_directions
+            limiter - RateLimit.RateLimiter - Waited on before every attempt and told the status of every response, None for no limit
+
+        Returns:
+            A TransportResponse. If the API answered with one of the RETRY_STATUSES on every attempt the last of these responses is returned.
+        """
+        retries = 0
+        backoff = 0.0
+        throttle = 0.0
+
+        while True:
+            if limiter is not None:
+                try:
+                    throttle = throttle + limiter.acquire()
+                except DailyLimitReached as e:
+                    return TransportResponse(None, None, retries, str(e), backoff, throttle)
+
+            response = self._attempt(url, params, retries, decode)
+
+            if limiter is not None:
+                #Too Many Requests is the HTTP equivalent of OVER_QUERY_LIMIT
+                limiter.feedback("OVER_QUERY_LIMIT" if response.error == TOO_MANY_REQUESTS else get_status(response.data))
+
+            if not is_retryable(response) or retries >= self.max_retries:
+                response.backoff = backoff
+                response.throttle = throttle
+                return response
+
+            #Full jitter: wait a random time up to the exponential backoff for this retry
+            wait = random.uniform(0, min(self.max_backoff, self.backoff * (2 ** retries)))
+            time.sleep(wait)
+            backoff = backoff + wait
+            retries = retries + 1
+
+    def _attempt(self, url, params, retries, decode):
+        """ Makes a single request and turns the outcome into a TransportResponse. """
+        try:
+            r = self.session.get(url, params=params, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            return TransportResponse(None, None, retries, "Request network error: {}".format(type(e).__name__))
+
+        if r.status_code != 200:
+            return TransportResponse(None, None, retries, "Request network error: HTTP {}".format(r.status_code), http_status=r.status_code)
+
+        #Decode the raw bytes, the responses are always UTF-8 JSON so there is no need for requests to guess the encoding
+        try:
+            data = decode(r.content)
+        except (ValueError, AttributeError, TypeError):
+            return TransportResponse(None, None, retries, "Request network error: invalid JSON", http_status=r.status_code)
+
+        return TransportResponse(data, r.content, retries, http_status=r.status_code)
+
+def transport_from_settings(config, pool_size = None):
+    """ Creates the HTTP transport described by the optional [HTTP] section of the settings file.
+
+    Arguments:
+        config - ConfigParser - The parsed settings file
+        pool_size - Integer - The number of connections to keep open if pool_size is not set in the [HTTP] section, None for the HttpTransport default
+
+    Returns:
+        An HttpTransport, using the defaults for any setting that is not present
+    """
+    options = dict()
+    if pool_size is not None:
+        options["pool_size"] = pool_size
+
+    for name in ("connect_timeout", "read_timeout", "backoff", "max_backoff"):
+        if config.has_option('HTTP', name):
+            options[name] = config.getfloat('HTTP', name)
+
+    for name in ("pool_size", "max_retries"):
+        if config.has_option('HTTP', name):
+            options[name] = config.getint('HTTP', name)
+
+    return HttpTransport(**options)